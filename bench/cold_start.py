@@ -0,0 +1,68 @@
+"""Measure the cold start of an app: process start -> import -> first response.
+
+    python bench/cold_start.py shop2 --runs 5
+
+Each run is a fresh interpreter working on the same database file, so the
+first run creates the schema and the rest start against an existing one.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {app_dir!r})
+import main
+t1 = time.perf_counter()
+from fastapi.testclient import TestClient
+with TestClient(main.app) as client:
+    client.get({path!r})
+    t2 = time.perf_counter()
+print(json.dumps({{"import": t1 - t0, "first_request": t2 - t0}}))
+"""
+
+
+def run_once(app_dir: str, path: str, cwd: str) -> dict:
+    code = PROBE.format(app_dir=app_dir, path=path)
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("app", choices=["shop", "shop2"])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--app-dir", help="measure another checkout of the app")
+    parser.add_argument("--path", default="/products/")
+    args = parser.parse_args()
+    app_dir = os.path.abspath(args.app_dir or os.path.join(BASE_DIR, args.app))
+
+    with tempfile.TemporaryDirectory() as cwd:
+        runs = [run_once(app_dir, args.path, cwd) for _ in range(args.runs + 1)]
+    # the first run pays for creating the schema, report it separately
+    first, warm = runs[0], runs[1:]
+    print(f"empty database: first request after {first['first_request'] * 1000:.1f} ms")
+    for key in ("import", "first_request"):
+        values = [r[key] * 1000 for r in warm]
+        print(
+            f"{key}: median {statistics.median(values):.1f} ms, "
+            f"min {min(values):.1f} ms over {len(values)} runs"
+        )
+
+
+if __name__ == "__main__":
+    main()
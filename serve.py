@@ -0,0 +1,70 @@
+"""Production entry point for the shop apps.
+
+    python serve.py --app shop2 --workers 4 --host 0.0.0.0 --port 8000
+
+Every option can also be set from the environment (SHOP_APP, HOST, PORT,
+WEB_CONCURRENCY, GRACEFUL_TIMEOUT) which is how the container configures it.
+"""
+
+import argparse
+import importlib
+import os
+import sys
+
+import uvicorn
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# app name -> module holding the engine and create_db_and_tables
+APPS = {
+    "shop": "models.models",
+    "shop2": "models.model",
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="run a shop api")
+    parser.add_argument(
+        "--app", choices=sorted(APPS), default=os.getenv("SHOP_APP", "shop2")
+    )
+    parser.add_argument("--host", default=os.getenv("HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "1"))
+    )
+    parser.add_argument(
+        "--graceful-timeout",
+        type=int,
+        default=int(os.getenv("GRACEFUL_TIMEOUT", "30")),
+        help="seconds to wait for in-flight requests on shutdown",
+    )
+    parser.add_argument("--log-level", default=os.getenv("LOG_LEVEL", "info"))
+    return parser.parse_args(argv)
+
+
+def prepare(app: str):
+    """Run the one-time startup work in the parent before workers are spawned"""
+    models = importlib.import_module(APPS[app])
+    models.create_db_and_tables()
+    # the workers open their own connections, never share the parent's
+    models.get_engine().dispose()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    app_dir = os.path.join(BASE_DIR, args.app)
+    sys.path.insert(0, app_dir)
+    prepare(args.app)
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        app_dir=app_dir,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        log_level=args.log_level,
+    )
+
+
+if __name__ == "__main__":
+    main()
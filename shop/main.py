@@ -1,37 +1,125 @@
+from contextlib import asynccontextmanager
+from datetime import date, datetime, time, timedelta
 from typing import Sequence
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import (
+    FastAPI,
+    APIRouter,
+    Depends,
+    HTTPException,
+    Query,
+    Response,
+    status,
+)
 from models import ProductTable, Product, ProductPub
-from models import engine, create_db_and_tables
+from models import get_engine, create_db_and_tables
 from sqlmodel import Session, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import joinedload, selectinload
 from models.models import *
 from models.models import SaleTable
 from models.models import CustomerTable
 from models.models import PurchaseTable
 from models.models import LoanTable
 from fastapi.middleware.cors import CORSMiddleware
-import uvicorn
-
-app = FastAPI()
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Allows all origins
-    allow_credentials=True,
-    allow_methods=["*"],  # Allows all methods (GET, POST, PUT, DELETE, etc.)
-    allow_headers=["*"],  # Allows all headers
-)
 
 
 async def create_session():
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         yield session
 
 
-create_db_and_tables()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    create_db_and_tables()
+    yield
+    get_engine().dispose()
+
+
+router = APIRouter()
+
+# listings come in pages, the cursor of the next page is sent in this header
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+PAGE_LIMIT = 50
+MAX_PAGE_LIMIT = 500
+
+
+def create_app() -> FastAPI:
+    app = FastAPI(lifespan=lifespan)
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # Allows all origins
+        allow_credentials=True,
+        allow_methods=["*"],  # Allows all methods (GET, POST, PUT, DELETE, etc.)
+        allow_headers=["*"],  # Allows all headers
+        expose_headers=[NEXT_CURSOR_HEADER],
+    )
+    app.include_router(router)
+    return app
+
+
+def __getattr__(name: str):
+    # `main:app` is built on first access so importing this module stays cheap
+    if name == "app":
+        app = create_app()
+        globals()["app"] = app
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def paginate(query, key, cursor, limit, response, session, descending=False):
+    """one page of query in key order after cursor, a row more than the page
+    is read to tell whether there is a next one"""
+    if cursor is not None:
+        query = query.where(key < cursor if descending else key > cursor)
+    query = query.order_by(key.desc() if descending else key).limit(limit + 1)
+    rows = session.exec(query).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = str(rows[-1].id)
+    return rows
+
+
+def sales_page(query, since, until, cursor, limit, response, session):
+    """newest first, with the bills and their products in one more query"""
+    if since:
+        query = query.where(SaleTable.date >= datetime.combine(since, time.min))
+    if until:
+        end = datetime.combine(until + timedelta(days=1), time.min)
+        query = query.where(SaleTable.date < end)
+    query = query.options(selectinload(SaleTable.bills).joinedload(BillTable.product))
+    return paginate(
+        query, SaleTable.id, cursor, limit, response, session, descending=True
+    )
+
+
+def get_current_products(names, session) -> dict[str, ProductTable]:
+    """the latest version of every named product with its inventory"""
+    products = session.exec(
+        select(ProductTable)
+        .join(CurrentProductTable, CurrentProductTable.product_id == ProductTable.id)
+        .where(CurrentProductTable.name.in_(set(names)))
+        .options(joinedload(ProductTable.inventories))
+    ).all()
+    return {product.name: product for product in products}
+
+
+def set_current_products(products, session):
+    """make flushed products the latest version of their names"""
+    rows = {product.name: product.id for product in products}
+    if not rows:
+        return
+    stmt = insert(CurrentProductTable).values(
+        [{"name": name, "product_id": id} for name, id in rows.items()]
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["name"], set_={"product_id": stmt.excluded.product_id}
+    )
+    session.exec(stmt)
 
 
 # products endpoints
-@app.post("/products/", response_model=ProductPub)
+@router.post("/products/", response_model=ProductPub)
 async def save_product(
     product: ProductPurchase, session: Session = Depends(create_session)
 ):
@@ -39,28 +127,25 @@ async def save_product(
     product.inventories = inventory
     product_data = ProductTable.model_validate(product)
     session.add(product_data)
+    session.flush()
+    set_current_products([product_data], session)
     session.commit()
     session.refresh(product_data)
     return product_data
 
 
-@app.get("/products/", response_model=list[ProductInventory])
+@router.get("/products/", response_model=list[ProductInventory])
 async def get_all_products(session: Session = Depends(create_session)):
-    seen = set()
     products = session.exec(
-        select(ProductTable).order_by(ProductTable.created_at.desc())
+        select(ProductTable)
+        .join(CurrentProductTable, CurrentProductTable.product_id == ProductTable.id)
+        .options(joinedload(ProductTable.inventories))
+        .order_by(ProductTable.created_at.desc())
     ).all()
-    productsout = []
+    return products
 
-    for product in products:
-        if product.name not in seen:
-            productsout.append(product)
-            seen.add(product.name)
-
-    return productsout
 
-
-@app.get("/products/{id}", response_model=ProductInventory)
+@router.get("/products/{id}", response_model=ProductInventory)
 async def get_product(
     id: int, session: Session = Depends(create_session)
 ) -> ProductTable:
@@ -70,7 +155,7 @@ async def get_product(
     return product
 
 
-@app.post("/products/{product_id}/inventories/", response_model=InventoryPub)
+@router.post("/products/{product_id}/inventories/", response_model=InventoryPub)
 async def add_product_inventory(
     product_id: int, inventory: Inventory, session: Session = Depends(create_session)
 ):
@@ -90,7 +175,7 @@ async def add_product_inventory(
     return dbinventory
 
 
-@app.get("/products/{product_id}/inventories/", response_model=InventoryPub)
+@router.get("/products/{product_id}/inventories/", response_model=InventoryPub)
 async def get_product_inventory(
     product_id: int, session: Session = Depends(create_session)
 ):
@@ -107,19 +192,16 @@ async def get_product_inventory(
 # purchase endpoints
 
 
-@app.post("/purchases/", response_model=PurchasePub)
+@router.post("/purchases/", response_model=PurchasePub)
 async def add_purchases_item(
     purchase: PurchaseProduct, session: Session = Depends(create_session)
 ) -> PurchaseTable:
     productm = []
+    current = get_current_products([p.name for p in purchase.products], session)
     for product in purchase.products:
-        prodresuslt = session.exec(
-            select(ProductTable)
-            .where(ProductTable.name == product.name)
-            .order_by(ProductTable.created_at.desc())
-        ).all()
-        if prodresuslt:
-            prev_stock = prodresuslt[0].inventories.stock
+        prodresuslt = current.get(product.name)
+        if prodresuslt and prodresuslt.inventories:
+            prev_stock = prodresuslt.inventories.stock
         else:
             prev_stock = 0
         product.inventories = InventoryTable.model_validate(
@@ -135,12 +217,14 @@ async def add_purchases_item(
     purchasedb.products = productm
 
     session.add(purchasedb)
+    session.flush()
+    set_current_products(productm, session)
     session.commit()
     session.refresh(purchasedb)
     return purchasedb
 
 
-@app.get("/purchases/", response_model=list[PurchasePub])
+@router.get("/purchases/", response_model=list[PurchasePub])
 async def get_all_purchases(session: Session = Depends(create_session)):
     purchases = session.exec(
         select(PurchaseTable).order_by(PurchaseTable.date.desc())
@@ -148,7 +232,7 @@ async def get_all_purchases(session: Session = Depends(create_session)):
     return purchases
 
 
-@app.get("/purchases/{id}", response_model=PurchasePub)
+@router.get("/purchases/{id}", response_model=PurchasePub)
 async def get_purchase(id: int, session: Session = Depends(create_session)):
     purchase = session.get(PurchaseTable, id)
     if not purchase:
@@ -156,7 +240,7 @@ async def get_purchase(id: int, session: Session = Depends(create_session)):
     return purchase
 
 
-@app.get("/purchases/{id}/products", response_model=PurchaseProduct)
+@router.get("/purchases/{id}/products", response_model=PurchaseProduct)
 async def get_purchase_products(id: int, session: Session = Depends(create_session)):
     purchase = session.get(PurchaseTable, id)
     if not purchase:
@@ -164,7 +248,7 @@ async def get_purchase_products(id: int, session: Session = Depends(create_sessi
     return purchase
 
 
-@app.get("/purchases/{id}/products/{product_id}", response_model=ProductPurchase)
+@router.get("/purchases/{id}/products/{product_id}", response_model=ProductPurchase)
 async def get_purchase_product(
     id: int, product_id: int, session: Session = Depends(create_session)
 ):
@@ -177,7 +261,7 @@ async def get_purchase_product(
     return product
 
 
-@app.delete("/purchases/{id}", status_code=status.HTTP_204_NO_CONTENT)
+@router.delete("/purchases/{id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_purchase(id: int, session: Session = Depends(create_session)):
     purchase = session.get(PurchaseTable, id)
     if not purchase:
@@ -193,15 +277,10 @@ async def delete_purchase(id: int, session: Session = Depends(create_session)):
 def prepare_sale(products, session) -> SaleTable:
     """This is a helper fuction for preparing SaleTable before it  can be saved"""
     bills = []
+    current = get_current_products([product.name for product in products], session)
     for product in products:
-        data = session.exec(
-            select(ProductTable)
-            .where(ProductTable.name == product.name)
-            .order_by(ProductTable.created_at.desc())
-        ).all()
-        print(data)
+        data = current.get(product.name)
         if data:
-            data = data[0]
             if data.inventories.stock > product.quantity:
                 data.inventories.stock = data.inventories.stock - product.quantity
             else:
@@ -219,7 +298,7 @@ def prepare_sale(products, session) -> SaleTable:
     return sale
 
 
-@app.post("/sales/", response_model=SalePub)
+@router.post("/sales/", response_model=SalePub)
 async def add_sale_item(
     products: list[ProductSale], session: Session = Depends(create_session)
 ) -> SaleTable:
@@ -230,18 +309,25 @@ async def add_sale_item(
     return sale
 
 
-@app.get("/sales/", response_model=list[SalePub])
+@router.get("/sales/", response_model=list[SalePub])
 async def get_all_sales(
+    response: Response,
+    since: date | None = Query(None, alias="from"),
+    until: date | None = Query(None, alias="to"),
+    cursor: int | None = None,
+    limit: int = Query(PAGE_LIMIT, gt=0, le=MAX_PAGE_LIMIT),
     session: Session = Depends(create_session),
 ) -> Sequence[SaleTable]:
-    sales = session.exec(select(SaleTable).order_by(SaleTable.date.desc())).all()
+    sales = sales_page(
+        select(SaleTable), since, until, cursor, limit, response, session
+    )
     if not sales:
         raise HTTPException(status.HTTP_404_NOT_FOUND, "there is no sale data found")
     return sales
 
 
 # Customer endpoints
-@app.post("/customers", response_model=User)
+@router.post("/customers", response_model=User)
 async def add_customer(
     user: User, session: Session = Depends(create_session)
 ) -> CustomerTable:
@@ -252,18 +338,23 @@ async def add_customer(
     return customer
 
 
-@app.get("/customers/", response_model=list[User])
+@router.get("/customers/", response_model=list[User])
 async def get_all_customers(
+    response: Response,
+    cursor: int | None = None,
+    limit: int = Query(PAGE_LIMIT, gt=0, le=MAX_PAGE_LIMIT),
     session: Session = Depends(create_session),
 ) -> Sequence[CustomerTable]:
-    customers = session.exec(select(CustomerTable)).all()
+    customers = paginate(
+        select(CustomerTable), CustomerTable.id, cursor, limit, response, session
+    )
     if not customers:
         raise HTTPException(status.HTTP_404_NOT_FOUND, "there are no customers found")
     return customers
 
 
 # loan endpoints
-@app.post("/loans", response_model=LoanPub)
+@router.post("/loans", response_model=LoanPub)
 async def add_loan(
     products: list[ProductSale],
     user_id: int,
@@ -287,13 +378,17 @@ async def add_loan(
     return loan
 
 
-@app.get("/loans", response_model=LoanPub)
+@router.get("/loans", response_model=LoanPub)
 def get_all_loan(
-    user_id: int, session: Session = Depends(create_session)
-) -> Sequence[LoanTable]:
-    print(user_id)
+    user_id: int,
+    response: Response,
+    since: date | None = Query(None, alias="from"),
+    until: date | None = Query(None, alias="to"),
+    cursor: int | None = None,
+    limit: int = Query(PAGE_LIMIT, gt=0, le=MAX_PAGE_LIMIT),
+    session: Session = Depends(create_session),
+):
     customer = session.get(CustomerTable, user_id)
-    print(customer)
     if not customer:
         raise HTTPException(
             status.HTTP_404_NOT_FOUND, "there is no such customer found"
@@ -303,11 +398,21 @@ def get_all_loan(
     ).one_or_none()
     if not loan:
         raise HTTPException(status.HTTP_404_NOT_FOUND, "this customer has no loan")
-    # print(loan.sales)
-    return loan
+    sales = sales_page(
+        select(SaleTable).where(SaleTable.loan_id == loan.id),
+        since,
+        until,
+        cursor,
+        limit,
+        response,
+        session,
+    )
+    return {"customer": customer, "sales": sales}
 
 
 if __name__ == "__main__":
+    import uvicorn
+
     config = uvicorn.Config("main:app", host="127.0.0.1", port=8000, log_level="info")
     server = uvicorn.Server(config)
     server.run()
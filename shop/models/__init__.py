@@ -1,3 +1,3 @@
 from .models import Product,ProductPub,ProductTable
-from .models import engine, create_db_and_tables
+from .models import get_engine, create_db_and_tables
 from .models import Inventory, InventoryTable,InventoryPub
\ No newline at end of file
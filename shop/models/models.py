@@ -1,4 +1,7 @@
+import os
 from sqlmodel import SQLModel, Session, Field, Relationship, create_engine
+from sqlalchemy import event
+from functools import cache
 from datetime import datetime, UTC
 from enum import StrEnum
 from typing import Optional
@@ -51,6 +54,18 @@ class ProductTable(Product, table=True):
     created_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
 
 
+class CurrentProductTable(SQLModel, table=True):
+    """the latest version of every product name
+
+    A purchase adds a new ProductTable row for every product it brings in,
+    this table points each name at the newest one so sales and stock look
+    it up by name instead of sorting all of the versions.
+    """
+
+    name: str = Field(primary_key=True)
+    product_id: int = Field(foreign_key="producttable.id")
+
+
 class ProductSale(SQLModel):
     name: str
     quantity: float
@@ -71,13 +86,15 @@ class ProductPurchase(Product):
     inventories: "Inventory"
 
 
+# the default is taken per row, datetime.now() as a default would stamp
+# every row with the time the module was imported
 class Common(SQLModel):
-    date: datetime = Field(default=datetime.now())
+    date: datetime = Field(default_factory=datetime.now)
     quantity: float
 
 
 class Sale(SQLModel):
-    date: datetime = Field(default=datetime.now())
+    date: datetime = Field(default_factory=datetime.now, index=True)
 
 
 class SaleTable(Sale, table=True):
@@ -93,7 +110,7 @@ class SalePub(Sale):
 
 
 class Purchase(SQLModel):
-    date: datetime = Field(default=datetime.now())
+    date: datetime = Field(default_factory=datetime.now)
 
 
 class PurchaseTable(Purchase, table=True):
@@ -181,14 +198,71 @@ class PurchasePub(PurchaseProduct):
 
 # fuction for initializing database
 
-sqlite_file_name = "database.db"
+sqlite_file_name = os.getenv("SQLITE_FILE", "database.db")
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 
-engine = create_engine(sqlite_url, echo=True)
+
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # every worker process opens its own connections, so the pragmas are
+    # applied per connection: WAL lets readers run alongside the single writer
+    # and busy_timeout makes a writer wait for the lock instead of failing
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.close()
 
 
-def create_db_and_tables():
+def make_engine(url: str):
+    engine = create_engine(
+        url,
+        echo=True,
+        connect_args={"check_same_thread": False, "timeout": 30},
+    )
+    event.listen(engine, "connect", set_sqlite_pragma)
+    return engine
+
+
+@cache
+def get_engine():
+    """return the engine, it is only created the first time it is needed"""
+    return make_engine(sqlite_url)
+
+
+def schema_is_current(engine) -> bool:
+    """check with a single catalog query that every table and index exists"""
+    with engine.connect() as conn:
+        names = set(
+            conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type IN ('table', 'index')"
+            ).scalars()
+        )
+    for table in SQLModel.metadata.sorted_tables:
+        if table.name not in names:
+            return False
+        if any(index.name not in names for index in table.indexes):
+            return False
+    return True
+
+
+def create_db_and_tables(engine=None):
+    engine = engine or get_engine()
+    if schema_is_current(engine):
+        return
     SQLModel.metadata.create_all(engine)
+    # create_all skips the indexes of tables that already exist
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        # point the names of products saved before the table existed at
+        # their newest version
+        conn.exec_driver_sql(
+            "INSERT OR IGNORE INTO currentproducttable (name, product_id)"
+            " SELECT name, id FROM (SELECT name, id, row_number() OVER"
+            " (PARTITION BY name ORDER BY created_at DESC, id DESC) AS version"
+            " FROM producttable) WHERE version = 1"
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,510 @@
+"""In-memory column snapshot of the sales, invoice and expense history.
+
+The analytical reports scan whole tables. Here every table is held as one
+numpy array per column and the reports are array arithmetic over them,
+away from the ORM and from the database the tills are writing to.
+
+A snapshot refreshes before it answers. Rows above the id watermark are
+appended in one range scan; rows at or below it that the change log saw
+inserted, updated or deleted since the last refresh are read again by id,
+or dropped. Nothing moved costs one small query.
+
+Both read the archive along with the hot table. A row an archive run moved
+is logged as deleted, read again it is found in the archive and stays.
+
+Query API: frame() filters a table to a Frame of column arrays, group()
+sums values per key.
+
+    frame = snapshot.frame("saleitem", since=start)
+    keys, sums, counts = group(frame["weekday"], revenue=frame["revenue"])
+"""
+
+import os
+import threading
+from datetime import date, datetime, time, timezone
+
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+from core import changelog
+from models.model import (
+    CategoryExpense,
+    ChangeLog,
+    Customer,
+    Debtor,
+    Loan,
+    Product,
+    ProductMargin,
+    Status,
+    WeekdaySales,
+    current_tenant,
+)
+
+# ids read back per statement when the change log asks for a reload
+ANALYTICS_RELOAD_BATCH = int(os.getenv("ANALYTICS_RELOAD_BATCH", "500"))
+# dead rows are squeezed out once they are this share of a table
+ANALYTICS_COMPACT_RATIO = 0.25
+
+# created_at as unix seconds, the tz-less column is stored in utc
+EPOCH = "CAST(strftime('%s', created_at) AS INTEGER)"
+
+# table -> select list and column dtypes, nullable ids read as -1; columns
+# in `encoded` come back as text and are stored as codes into a dictionary
+TABLES = {
+    "saleitem": {
+        "select": "id, coalesce(product_id, -1), coalesce(invoice_id, -1),"
+        f" coalesce(sale_id, -1), quantity, amount, coalesce(unit_cost, 0), {EPOCH}",
+        "dtype": [
+            ("id", "i8"),
+            ("product_id", "i8"),
+            ("invoice_id", "i8"),
+            ("sale_id", "i8"),
+            ("quantity", "f8"),
+            ("amount", "f8"),
+            ("unit_cost", "f8"),
+            ("created_at", "i8"),
+        ],
+        "encoded": (),
+    },
+    "invoice": {
+        "select": "id, coalesce(loan_id, -1),"
+        f" CASE status WHEN '{Status.paid.name}' THEN 1 ELSE 0 END,"
+        f" invoice_amount, paid_amount, {EPOCH}",
+        "dtype": [
+            ("id", "i8"),
+            ("loan_id", "i8"),
+            ("paid", "i1"),
+            ("invoice_amount", "f8"),
+            ("paid_amount", "f8"),
+            ("created_at", "i8"),
+        ],
+        "encoded": (),
+    },
+    "expense": {
+        "select": f"id, category, amount, {EPOCH}",
+        "dtype": [
+            ("id", "i8"),
+            ("category", "i4"),
+            ("amount", "f8"),
+            ("created_at", "i8"),
+        ],
+        "encoded": ("category",),
+    },
+}
+
+WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday")
+WEEKDAYS += ("Sunday",)
+
+
+def scan(name: str, where: str) -> str:
+    """select of a table's rows in the hot file and the archive, the
+    placeholders of `where` are bound once per file"""
+    columns = TABLES[name]["select"]
+    # a crash in an archive batch can leave a row in both files
+    return (
+        f"SELECT {columns} FROM main.{name} WHERE {where} UNION ALL"
+        f" SELECT {columns} FROM archive.{name} WHERE {where}"
+        f" AND id NOT IN (SELECT id FROM main.{name})"
+    )
+
+
+def epoch(day: date) -> int:
+    return int(datetime.combine(day, time.min, timezone.utc).timestamp())
+
+
+class ColumnTable:
+    """one table as numpy columns that grow in place like a list"""
+
+    def __init__(self, name: str):
+        import numpy as np
+
+        spec = TABLES[name]
+        self.name = name
+        self.dtype = np.dtype(spec["dtype"])
+        self.encoded = spec["encoded"]
+        # code -> text and back, for every encoded column
+        self.values: dict[str, list[str]] = {column: [] for column in self.encoded}
+        self.codes: dict[str, dict[str, int]] = {column: {} for column in self.encoded}
+        self.columns = {
+            column: np.empty(0, self.dtype[column]) for column in self.dtype.names
+        }
+        self.alive = np.empty(0, bool)
+        self.size = 0
+        self.dead = 0
+
+    def column(self, name: str):
+        return self.columns[name][: self.size]
+
+    def max_id(self) -> int:
+        return int(self.columns["id"][self.size - 1]) if self.size else 0
+
+    def read(self, cursor, sql: str, params=()):
+        """rows of a query as a record array, text columns encoded"""
+        import numpy as np
+
+        cursor.execute(sql, params)
+        if not self.encoded:
+            return np.fromiter(cursor, dtype=self.dtype)
+        positions = [self.dtype.names.index(column) for column in self.encoded]
+
+        def encode(row):
+            row = list(row)
+            for column, position in zip(self.encoded, positions):
+                codes = self.codes[column]
+                code = codes.get(row[position])
+                if code is None:
+                    code = codes[row[position]] = len(codes)
+                    self.values[column].append(row[position])
+                row[position] = code
+            return tuple(row)
+
+        return np.fromiter(map(encode, cursor), dtype=self.dtype)
+
+    def append(self, rows):
+        import numpy as np
+
+        needed = self.size + len(rows)
+        if needed > len(self.alive):
+            # grow by a quarter, appends stay amortized O(rows) and the
+            # slack stays small next to the table
+            capacity = max(needed, self.size + self.size // 4, 1024)
+            for name, column in self.columns.items():
+                grown = np.empty(capacity, column.dtype)
+                grown[: self.size] = column[: self.size]
+                self.columns[name] = grown
+            alive = np.zeros(capacity, bool)
+            alive[: self.size] = self.alive[: self.size]
+            self.alive = alive
+        for name in self.dtype.names:
+            self.columns[name][self.size : needed] = rows[name]
+        self.alive[self.size : needed] = True
+        self.size = needed
+
+    def reload(self, ids, rows):
+        """put rows read again by id in place, ids without a row died"""
+        import numpy as np
+
+        ids = np.asarray(sorted(ids), dtype=np.int64)
+        current = self.column("id")
+        positions = np.searchsorted(current, ids)
+        known = positions < self.size
+        known[known] = current[positions[known]] == ids[known]
+
+        found = np.isin(ids, rows["id"])
+        gone = positions[known & ~found]
+        self.dead += int(self.alive[gone].sum())
+        self.alive[gone] = False
+
+        if len(rows):
+            rows = np.sort(rows, order="id")
+            at = np.searchsorted(current, rows["id"])
+            inside = at < self.size
+            inside[inside] = current[at[inside]] == rows["id"][inside]
+            self.dead -= int((~self.alive[at[inside]]).sum())
+            for name in self.dtype.names:
+                self.columns[name][at[inside]] = rows[name][inside]
+            self.alive[at[inside]] = True
+            if not inside.all():
+                # an id reused below the watermark, rare enough to re-sort
+                self.append(rows[~inside])
+                order = np.argsort(self.column("id"), kind="stable")
+                for name in self.dtype.names:
+                    self.columns[name][: self.size] = self.column(name)[order]
+                self.alive[: self.size] = self.alive[: self.size][order]
+
+    def compact(self):
+        keep = self.alive[: self.size]
+        size = int(keep.sum())
+        for name in self.dtype.names:
+            self.columns[name][:size] = self.column(name)[keep]
+        self.alive[:size] = True
+        self.alive[size:] = False
+        self.size = size
+        self.dead = 0
+
+    def nbytes(self) -> int:
+        return sum(column.nbytes for column in self.columns.values()) + (
+            self.alive.nbytes
+        )
+
+
+class Frame(dict):
+    """filtered column arrays of a table, plus a few derived columns"""
+
+    def __missing__(self, name: str):
+        import numpy as np
+
+        if name == "revenue":
+            value = self["quantity"] * self["amount"]
+        elif name == "cost":
+            value = self["quantity"] * self["unit_cost"]
+        elif name == "due":
+            value = self["invoice_amount"] - self["paid_amount"]
+        elif name == "day":
+            value = self["created_at"] // 86400
+        elif name == "weekday":
+            # 1970-01-01 was a Thursday, Monday is 0
+            value = (self["day"] + 3) % 7
+        elif name == "month":
+            value = self["created_at"].astype("datetime64[s]").astype("datetime64[M]")
+            value = value.astype(np.int64)
+        else:
+            raise KeyError(name)
+        self[name] = value
+        return value
+
+
+def group(keys, **values):
+    """unique keys with the sum of every value and the row count per key"""
+    import numpy as np
+
+    if keys.dtype.kind == "i" and len(keys) and 0 <= keys.min():
+        if keys.max() < 4 * len(keys) + 1024:
+            # ids and small codes index the sums directly, no sort needed
+            counts = np.bincount(keys)
+            unique = np.flatnonzero(counts)
+            sums = {
+                name: np.bincount(keys, weights=value, minlength=len(counts))[unique]
+                for name, value in values.items()
+            }
+            return unique, sums, counts[unique]
+    unique, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(unique))
+    sums = {
+        name: np.bincount(inverse, weights=value, minlength=len(unique))
+        for name, value in values.items()
+    }
+    return unique, sums, counts
+
+
+class Snapshot:
+    def __init__(self):
+        self.tables = {name: ColumnTable(name) for name in TABLES}
+        self.seq = 0
+        self.loaded = False
+        self.refreshes = 0
+        self.reloaded = 0
+        self.lock = threading.RLock()
+
+    def watermark(self, session: Session) -> tuple:
+        """newest id of every table and newest change log seq among them"""
+        sql = ", ".join(f"(SELECT max(id) FROM {name})" for name in TABLES)
+        ids = session.connection().exec_driver_sql(f"SELECT {sql}").one()
+        seq = session.exec(
+            select(func.max(ChangeLog.seq)).where(
+                ChangeLog.table_name.in_(list(TABLES))
+            )
+        ).one()
+        return tuple(i or 0 for i in ids), seq or 0
+
+    def refresh(self, session: Session):
+        ids, seq = self.watermark(session)
+        if self.loaded and seq == self.seq:
+            if ids == tuple(table.max_id() for table in self.tables.values()):
+                return
+        if self.loaded and seq > self.seq:
+            if not changelog.complete(session, self.seq, seq):
+                # the changes since the last refresh were purged, start over
+                self.tables = {name: ColumnTable(name) for name in TABLES}
+                self.loaded = False
+        cursor = session.connection().connection.cursor()
+        try:
+            for table in self.tables.values():
+                below = table.max_id()
+                if self.loaded and seq > self.seq:
+                    self._reload(table, cursor, below, seq, session)
+                rows = table.read(
+                    cursor, scan(table.name, "id > ?") + " ORDER BY id", (below,) * 2
+                )
+                table.append(rows)
+                if table.dead > ANALYTICS_COMPACT_RATIO * max(table.size, 1):
+                    table.compact()
+        finally:
+            cursor.close()
+        self.seq = seq
+        self.loaded = True
+        self.refreshes += 1
+
+    def _reload(self, table: ColumnTable, cursor, below: int, seq: int, session):
+        # rows above the watermark come with the range scan, they are read
+        # after the seq so they already hold these changes
+        ids = session.exec(
+            select(ChangeLog.row_id)
+            .where(
+                ChangeLog.table_name == table.name,
+                ChangeLog.seq > self.seq,
+                ChangeLog.seq <= seq,
+                ChangeLog.row_id <= below,
+            )
+            .distinct()
+        ).all()
+        for start in range(0, len(ids), ANALYTICS_RELOAD_BATCH):
+            batch = ids[start : start + ANALYTICS_RELOAD_BATCH]
+            marks = ", ".join("?" * len(batch))
+            rows = table.read(cursor, scan(table.name, f"id IN ({marks})"), batch * 2)
+            table.reload(batch, rows)
+        self.reloaded += len(ids)
+
+    def frame(
+        self,
+        name: str,
+        since: date | None = None,
+        until: date | None = None,
+        **equals,
+    ) -> Frame:
+        """live rows of a table created in [since, until], as columns"""
+        table = self.tables[name]
+        mask = table.alive[: table.size].copy()
+        created = table.column("created_at")
+        if since:
+            mask &= created >= epoch(since)
+        if until:
+            mask &= created < epoch(until) + 86400
+        for column, value in equals.items():
+            mask &= table.column(column) == value
+        return Frame({column: table.column(column)[mask] for column in table.columns})
+
+    def stats(self) -> dict:
+        return {
+            "seq": self.seq,
+            "refreshes": self.refreshes,
+            "reloaded": self.reloaded,
+            "tables": {
+                table.name: {
+                    "rows": table.size - table.dead,
+                    "dead": table.dead,
+                    "bytes": table.nbytes(),
+                }
+                for table in self.tables.values()
+            },
+        }
+
+
+# tenant -> its snapshot, None for the default database
+_snapshots: dict[str | None, Snapshot] = {}
+
+
+class AnalyticsControler:
+    @classmethod
+    def snapshot(cls, session: Session) -> Snapshot:
+        """the current tenant's snapshot, refreshed"""
+        tenant = current_tenant.get()
+        snapshot = _snapshots.get(tenant)
+        if snapshot is None:
+            snapshot = _snapshots.setdefault(tenant, Snapshot())
+        with snapshot.lock:
+            snapshot.refresh(session)
+        return snapshot
+
+    @classmethod
+    def margin_by_product(
+        cls,
+        session: Session,
+        since: date | None = None,
+        until: date | None = None,
+        limit: int = 50,
+    ) -> list[ProductMargin]:
+        """revenue, cost of goods as charged at sale and margin per product"""
+        import numpy as np
+
+        snapshot = cls.snapshot(session)
+        with snapshot.lock:
+            items = snapshot.frame("saleitem", since, until)
+            keys, sums, _ = group(
+                items["product_id"],
+                quantity=items["quantity"],
+                revenue=items["revenue"],
+                cost=items["cost"],
+            )
+        names = dict(session.exec(select(Product.id, Product.name)).all())
+        cost = sums["cost"]
+        margin = sums["revenue"] - cost
+        top = np.argsort(-margin, kind="stable")[:limit]
+        return [
+            ProductMargin(
+                product_id=keys[i],
+                name=names.get(int(keys[i]), ""),
+                quantity=sums["quantity"][i],
+                revenue=sums["revenue"][i],
+                cost=cost[i],
+                margin=margin[i],
+            )
+            for i in top
+        ]
+
+    @classmethod
+    def sales_by_weekday(
+        cls, session: Session, since: date | None = None, until: date | None = None
+    ) -> list[WeekdaySales]:
+        snapshot = cls.snapshot(session)
+        with snapshot.lock:
+            items = snapshot.frame("saleitem", since, until)
+            keys, sums, counts = group(
+                items["weekday"],
+                quantity=items["quantity"],
+                revenue=items["revenue"],
+            )
+        return [
+            WeekdaySales(
+                weekday=day,
+                name=WEEKDAYS[day],
+                lines=counts[i],
+                quantity=sums["quantity"][i],
+                revenue=sums["revenue"][i],
+            )
+            for i, day in enumerate(keys.tolist())
+        ]
+
+    @classmethod
+    def top_debtors(cls, session: Session, limit: int = 20) -> list[Debtor]:
+        """loans with the most outstanding on their unpaid invoices"""
+        import numpy as np
+
+        snapshot = cls.snapshot(session)
+        with snapshot.lock:
+            invoices = snapshot.frame("invoice", paid=0)
+            keys, sums, counts = group(invoices["loan_id"], due=invoices["due"])
+        top = np.argsort(-sums["due"], kind="stable")[:limit]
+        top = top[sums["due"][top] > 0]
+        loans = [int(keys[i]) for i in top]
+        customers = {
+            row[0]: (row[1], row[2])
+            for row in session.exec(
+                select(Loan.id, Customer.id, Customer.name)
+                .outerjoin(Customer, Customer.id == Loan.customer_id)
+                .where(Loan.id.in_(loans))
+            ).all()
+        }
+        return [
+            Debtor(
+                loan_id=loan,
+                customer_id=customers.get(loan, (None, ""))[0],
+                name=customers.get(loan, (None, ""))[1] or "",
+                open_invoices=counts[i],
+                due=sums["due"][i],
+            )
+            for loan, i in zip(loans, top)
+        ]
+
+    @classmethod
+    def expenses_by_category(
+        cls, session: Session, since: date | None = None, until: date | None = None
+    ) -> list[CategoryExpense]:
+        import numpy as np
+
+        snapshot = cls.snapshot(session)
+        with snapshot.lock:
+            expenses = snapshot.frame("expense", since, until)
+            keys, sums, counts = group(expenses["category"], amount=expenses["amount"])
+            names = snapshot.tables["expense"].values["category"]
+            order = np.argsort(-sums["amount"], kind="stable")
+            return [
+                CategoryExpense(
+                    category=names[keys[i]], count=counts[i], amount=sums["amount"][i]
+                )
+                for i in order
+            ]
+
+    @classmethod
+    def stats(cls, session: Session) -> dict:
+        return cls.snapshot(session).stats()
@@ -0,0 +1,173 @@
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
+from sqlalchemy import delete, func, insert, text
+from sqlmodel import Session, select
+
+from core import changelog
+from models.model import (
+    Expense,
+    Invoice,
+    PayItem,
+    SaleItem,
+    SaleItemPub,
+    Status,
+    archive_tables,
+)
+
+# rows older than this are archived, it stays beyond the forecast history
+ARCHIVE_DAYS = int(os.getenv("ARCHIVE_DAYS", "730"))
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "2000"))
+
+
+class ArchiveControler:
+    """Moves settled history into the attached archive and reads it back.
+
+    Each batch copies its rows into the archive and deletes them from the
+    hot table in one transaction, a crash can at worst leave a row in both
+    files; the copy replaces on id, so the next run finishes the move.
+    """
+
+    @classmethod
+    def _move(cls, model, ids: list[int], session: Session, column: str = "id"):
+        table = model.__table__
+        columns = [c.name for c in table.columns]
+        rows = select(*table.c).where(table.c[column].in_(ids))
+        session.exec(
+            insert(archive_tables[model])
+            .prefix_with("OR REPLACE")
+            .from_select(columns, rows)
+        )
+        moved = session.exec(
+            delete(table).where(table.c[column].in_(ids)).returning(table.c.id)
+        ).scalars()
+        # readers of the log, the result cache among them, see the rows leave
+        changelog.record(session, table.name, "delete", moved)
+
+    @classmethod
+    def _newest(cls, model):
+        """the highest id of a hot table, its row stays behind
+
+        SQLite gives a new row the highest id plus one, with that row gone
+        a new row would take the id of one in the archive.
+        """
+        return select(func.max(model.id)).scalar_subquery()
+
+    @classmethod
+    def _batches(cls, query, session: Session):
+        """ids of the next batch until the query matches nothing"""
+        while True:
+            ids = session.exec(query.limit(ARCHIVE_BATCH)).all()
+            if not ids:
+                return
+            yield ids
+
+    @classmethod
+    def run(
+        cls,
+        session: Session,
+        days: int = ARCHIVE_DAYS,
+        progress: Callable[[str], None] | None = None,
+    ) -> dict[str, int]:
+        """archive paid invoices and sale items, pay items and expenses
+
+        Only invoices that are Paid go, together with their sale items.
+        Sale items of invoices still open stay with their invoice.
+        """
+        cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+        free_before = session.exec(text("PRAGMA freelist_count")).one()[0]
+        moved = {"invoice": 0, "saleitem": 0, "payitem": 0, "expense": 0}
+
+        invoices = (
+            select(Invoice.id)
+            .where(
+                Invoice.status == Status.paid,
+                Invoice.created_at < cutoff,
+                Invoice.id != cls._newest(Invoice),
+                # nor the invoice the newest sale item belongs to
+                Invoice.id
+                != func.coalesce(
+                    select(SaleItem.invoice_id)
+                    .where(SaleItem.id == cls._newest(SaleItem))
+                    .scalar_subquery(),
+                    0,
+                ),
+            )
+            .order_by(Invoice.id)
+        )
+        for ids in cls._batches(invoices, session):
+            cls._move(SaleItem, ids, session, column="invoice_id")
+            cls._move(Invoice, ids, session)
+            session.commit()
+            moved["invoice"] += len(ids)
+            if progress:
+                progress(f"{moved['invoice']} invoices")
+
+        others = {
+            "saleitem": (
+                SaleItem,
+                select(SaleItem.id).where(
+                    SaleItem.created_at < cutoff, SaleItem.invoice_id.is_(None)
+                ),
+            ),
+            "payitem": (PayItem, select(PayItem.id).where(PayItem.created_at < cutoff)),
+            "expense": (Expense, select(Expense.id).where(Expense.created_at < cutoff)),
+        }
+        for name, (model, query) in others.items():
+            query = query.where(model.id != cls._newest(model)).order_by(model.id)
+            for ids in cls._batches(query, session):
+                cls._move(model, ids, session)
+                session.commit()
+                moved[name] += len(ids)
+                if progress:
+                    progress(f"{moved[name]} {name} rows")
+
+        free_after = session.exec(text("PRAGMA freelist_count")).one()[0]
+        # pages the hot tables gave back, reused by new rows before the file grows
+        moved["pages_freed"] = free_after - free_before
+        return moved
+
+    @classmethod
+    def get_invoice(cls, id: int, session: Session) -> Invoice | None:
+        table = archive_tables[Invoice]
+        row = session.exec(select(*table.c).where(table.c.id == id)).first()
+        return Invoice.model_validate(row._mapping) if row else None
+
+    @classmethod
+    def get_loan_invoices(cls, loan_id: int, session: Session) -> list[Invoice]:
+        table = archive_tables[Invoice]
+        rows = session.exec(
+            select(*table.c).where(table.c.loan_id == loan_id).order_by(table.c.id)
+        ).all()
+        return [Invoice.model_validate(row._mapping) for row in rows]
+
+    @classmethod
+    def get_invoice_salesitems(cls, id: int, session: Session) -> list[SaleItemPub]:
+        table = archive_tables[SaleItem]
+        rows = session.exec(
+            select(*table.c).where(table.c.invoice_id == id).order_by(table.c.id)
+        ).all()
+        return [SaleItemPub.model_validate(row._mapping) for row in rows]
+
+    @classmethod
+    def get_sale_salesitems(cls, id: int, session: Session) -> list[SaleItemPub]:
+        table = archive_tables[SaleItem]
+        rows = session.exec(
+            select(*table.c).where(table.c.sale_id == id).order_by(table.c.id)
+        ).all()
+        return [SaleItemPub.model_validate(row._mapping) for row in rows]
+
+    @classmethod
+    def get_payitems(cls, loan_id: int, session: Session) -> list[PayItem]:
+        table = archive_tables[PayItem]
+        rows = session.exec(
+            select(*table.c).where(table.c.loan_id == loan_id).order_by(table.c.id)
+        ).all()
+        return [PayItem.model_validate(row._mapping) for row in rows]
+
+    @classmethod
+    def get_expense(cls, id: int, session: Session) -> Expense | None:
+        table = archive_tables[Expense]
+        row = session.exec(select(*table.c).where(table.c.id == id)).first()
+        return Expense.model_validate(row._mapping) if row else None
@@ -0,0 +1,154 @@
+from datetime import datetime, timezone
+from typing import Any, Generic, Iterable, Sequence, TypeVar
+
+from sqlalchemy import delete, insert, update
+from sqlmodel import Session, SQLModel, select
+
+from core import changelog, timing
+from models.model import Tombstone
+
+ModelT = TypeVar("ModelT", bound=SQLModel)
+
+
+class BaseControler(Generic[ModelT]):
+    """Shared crud for a table model.
+
+    Every write takes ``commit``; with ``commit=False`` the changes are only
+    flushed so the caller can group several writes in its own transaction.
+    The ``*_many`` methods run a single statement whatever the number of rows.
+    """
+
+    model: type[ModelT]
+    delete_message = "successful"
+    # deletes leave a tombstone for the delta sync of offline clients
+    track_deletes = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        timing.instrument(cls)
+
+    @classmethod
+    def _finish(cls, session: Session, commit: bool):
+        if commit:
+            session.commit()
+        else:
+            session.flush()
+
+    @classmethod
+    def tombstone(cls, ids: Iterable[int], session: Session):
+        rows = [{"table_name": cls.model.__tablename__, "row_id": id} for id in ids]
+        if rows:
+            session.exec(insert(Tombstone), params=rows)
+
+    @classmethod
+    def save(cls, model: SQLModel, session: Session, commit: bool = True) -> ModelT:
+        item = cls.model.model_validate(model)
+        session.add(item)
+        cls._finish(session, commit)
+        if commit:
+            session.refresh(item)
+        return item
+
+    @classmethod
+    def save_many(
+        cls, models: Iterable[SQLModel], session: Session, commit: bool = True
+    ) -> Sequence[ModelT]:
+        rows = []
+        for model in models:
+            row = cls.model.model_validate(model).model_dump()
+            if row.get("id") is None:
+                row.pop("id", None)
+            rows.append(row)
+        if not rows:
+            return []
+        stmt = insert(cls.model).returning(cls.model.id)
+        ids = session.exec(stmt, params=rows).scalars().all()
+        changelog.record(session, cls.model.__tablename__, "insert", ids)
+        cls._finish(session, commit)
+        return cls.get_many(ids, session)
+
+    @classmethod
+    def get_all(cls, offset: int, limit: int, session: Session) -> Sequence[ModelT]:
+        return session.exec(select(cls.model).offset(offset).limit(limit)).all()
+
+    @classmethod
+    def get_one(cls, id: int, session: Session) -> ModelT | None:
+        return session.get(cls.model, id)
+
+    @classmethod
+    def get_many(cls, ids: Iterable[int], session: Session) -> Sequence[ModelT]:
+        ids = list(ids)
+        if not ids:
+            return []
+        query = select(cls.model).where(cls.model.id.in_(ids)).order_by(cls.model.id)
+        return session.exec(query).all()
+
+    @classmethod
+    def update(
+        cls, id: int, model: SQLModel, session: Session, commit: bool = True
+    ) -> ModelT | None:
+        item = cls.get_one(id, session)
+        if not item:
+            return None
+        for k, v in model.model_dump(exclude_unset=True).items():
+            setattr(item, k, v)
+        item.updated_at = datetime.now(timezone.utc)
+        session.add(item)
+        cls._finish(session, commit)
+        if commit:
+            session.refresh(item)
+        return item
+
+    @classmethod
+    def update_many(
+        cls,
+        ids: Iterable[int],
+        values: dict[str, Any],
+        session: Session,
+        commit: bool = True,
+    ) -> int:
+        """set the same values on every row in ids, return the number updated"""
+        ids = list(ids)
+        if not ids:
+            return 0
+        stmt = (
+            update(cls.model)
+            .where(cls.model.id.in_(ids))
+            .values(**values, updated_at=datetime.now(timezone.utc))
+            .returning(cls.model.id)
+        )
+        ids = session.exec(stmt).scalars().all()
+        changelog.record(
+            session, cls.model.__tablename__, "update", ids, [*values, "updated_at"]
+        )
+        cls._finish(session, commit)
+        return len(ids)
+
+    @classmethod
+    def delete(cls, id: int, session: Session, commit: bool = True):
+        item = cls.get_one(id, session)
+        if not item:
+            return None
+        session.delete(item)
+        if cls.track_deletes:
+            cls.tombstone([id], session)
+        cls._finish(session, commit)
+        return cls.delete_message
+
+    @classmethod
+    def delete_many(
+        cls, ids: Iterable[int], session: Session, commit: bool = True
+    ) -> int:
+        ids = list(ids)
+        if not ids:
+            return 0
+        stmt = delete(cls.model).where(cls.model.id.in_(ids)).returning(cls.model.id)
+        ids = session.exec(stmt).scalars().all()
+        if cls.track_deletes:
+            cls.tombstone(ids, session)
+        changelog.record(session, cls.model.__tablename__, "delete", ids)
+        cls._finish(session, commit)
+        return len(ids)
+
+
+timing.instrument(BaseControler)
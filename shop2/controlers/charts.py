@@ -0,0 +1,143 @@
+import asyncio
+import io
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import func, union_all
+from sqlmodel import Session, select
+
+from models.model import Expense, Invoice, Sale, archive_tables, current_tenant
+
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "1"))
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", "64"))
+
+CHART_TABLES = {
+    "revenue": (Sale,),
+    "expenses": (Expense,),
+    "margin": (Sale, Expense),
+    "receivables": (Invoice,),
+}
+
+# key -> png, least recently used first
+_chart_cache: OrderedDict[tuple, bytes] = OrderedDict()
+_pool: ProcessPoolExecutor | None = None
+
+
+def render_chart(title: str, days: list[date], series: dict[str, list[float]]):
+    """png of daily series, runs in the chart process pool"""
+    # a bare Figure draws with Agg and keeps no pyplot state in the worker
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(8, 4), dpi=100)
+    axes = figure.subplots()
+    width = 0.8 / len(series)
+    for i, (label, values) in enumerate(series.items()):
+        offset = timedelta(days=(i - (len(series) - 1) / 2) * width)
+        axes.bar([day + offset for day in days], values, width, label=label)
+    axes.set_title(title)
+    axes.axhline(0, color="black", linewidth=0.5)
+    axes.legend(loc="upper left")
+    axes.grid(axis="y", alpha=0.3)
+    figure.autofmt_xdate()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+class ChartControler:
+    @classmethod
+    def watermark(cls, kind: str, session: Session) -> tuple:
+        """latest update and row count of every table the chart reads"""
+        columns = []
+        for table in CHART_TABLES[kind]:
+            columns.append(select(func.max(table.updated_at)).scalar_subquery())
+            columns.append(select(func.count(table.id)).scalar_subquery())
+        return tuple(session.exec(select(*columns)).one())
+
+    @classmethod
+    def _daily(cls, column, amount, start, end, session: Session):
+        """sums per day, archived rows of the table count on their day too"""
+        pairs = [(column, amount)]
+        archive = archive_tables.get(column.class_)
+        if archive is not None:
+            pairs.append((archive.c[column.key], archive.c[amount.key]))
+        arms = [
+            select(created.label("created_at"), value.label("amount")).where(
+                created >= datetime.combine(start, time.min),
+                created < datetime.combine(end + timedelta(days=1), time.min),
+            )
+            for created, value in pairs
+        ]
+        rows = union_all(*arms).subquery()
+        day = func.date(rows.c.created_at).label("day")
+        rows = session.exec(select(day, func.sum(rows.c.amount)).group_by("day")).all()
+        return {date.fromisoformat(day): total for day, total in rows}
+
+    @classmethod
+    def series(cls, kind: str, start: date, end: date, session: Session):
+        """chart title and the per day series, days without rows are zero"""
+        days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+        def daily(column, amount):
+            totals = cls._daily(column, amount, start, end, session)
+            return [totals.get(day, 0) for day in days]
+
+        if kind == "revenue":
+            series = {
+                "revenue": daily(Sale.created_at, Sale.revenue),
+                "cost of goods": daily(Sale.created_at, Sale.cost_of_goods),
+            }
+            title = "Revenue"
+        elif kind == "expenses":
+            series = {"expenses": daily(Expense.created_at, Expense.amount)}
+            title = "Expenses"
+        elif kind == "margin":
+            revenue = daily(Sale.created_at, Sale.revenue - Sale.cost_of_goods)
+            expenses = daily(Expense.created_at, Expense.amount)
+            series = {
+                "gross margin": revenue,
+                "net margin": [r - e for r, e in zip(revenue, expenses)],
+            }
+            title = "Margin"
+        else:
+            series = {
+                "invoiced": daily(Invoice.created_at, Invoice.invoice_amount),
+                "paid": daily(Invoice.created_at, Invoice.paid_amount),
+            }
+            title = "Receivables"
+        return f"{title} {start} to {end}", days, series
+
+    @classmethod
+    async def render(cls, kind: str, start: date, end: date, session: Session):
+        """png bytes and the cache key they are stored under
+
+        The key carries the chart tables' watermark, a dashboard reloading
+        an unchanged chart costs one small query and a dict lookup.
+        """
+        global _pool
+        key = (current_tenant.get(), kind, start, end, cls.watermark(kind, session))
+        png = _chart_cache.get(key)
+        if png is not None:
+            _chart_cache.move_to_end(key)
+            return png, key
+
+        title, days, series = cls.series(kind, start, end, session)
+        if _pool is None:
+            context = multiprocessing.get_context("spawn")
+            _pool = ProcessPoolExecutor(CHART_WORKERS, mp_context=context)
+        png = await asyncio.wrap_future(_pool.submit(render_chart, title, days, series))
+
+        _chart_cache[key] = png
+        while len(_chart_cache) > CHART_CACHE_SIZE:
+            _chart_cache.popitem(last=False)
+        return png, key
+
+    @classmethod
+    def shutdown(cls):
+        global _pool
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
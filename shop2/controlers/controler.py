@@ -1,8 +1,13 @@
 from models.model import *
+from controlers.base import BaseControler
+from controlers.valuation import ValuationControler
 from sqlmodel import Session, select
-from sqlalchemy import func
+from sqlalchemy import case, func, insert, union_all, update
+from core import changelog
 from fastapi import Depends
+from collections import defaultdict
 from datetime import datetime, timezone
+from typing import Sequence
 import copy
 
 
@@ -10,87 +15,27 @@ class NotFound(Exception):
     pass
 
 
-class AdminControler:
-    @classmethod
-    def save(cls, admin: User, session: Session):
-        model = Admin.model_validate(admin)
-        session.add(model)
-        session.commit()
-        session.refresh(model)
-        return model
+class InvalidLines(Exception):
+    """lines of a bulk write that can not be applied, nothing was written"""
 
-    @classmethod
-    def get_all(cls, offset: int, limit: int, session: Session):
-        query = select(Admin).offset(offset).limit(limit)
-        admins = session.exec(query).all()
-        return admins
+    def __init__(self, errors: list[dict]):
+        super().__init__(errors)
+        self.errors = errors
 
-    @classmethod
-    def get_one(cls, id: int, session: Session):
-        admin = session.get(Admin, id)
-        return admin
 
-    @classmethod
-    def delete(cls, id: int, session: Session):
-        admin = session.get(Admin, id)
-        if admin:
-            session.delete(admin)
-            return "sucessful"
-        return None
+class AdminControler(BaseControler[Admin]):
+    model = Admin
+    delete_message = "sucessful"
 
 
-class CustomerControler:
-    @classmethod
-    def save(cls, model: User, session: Session):
-        model = Customer.model_validate(model)
-        session.add(model)
-        session.commit()
-        session.refresh(model)
-        return model
+class CustomerControler(BaseControler[Customer]):
+    model = Customer
+    track_deletes = True
+    delete_message = "successfull"
 
-    @classmethod
-    def get_all(cls, offset: int, limit: int, session: Session):
-        query = select(Customer).offset(offset).limit(limit)
-        customers = session.exec(query)
-        return customers.all()
 
-    @classmethod
-    def get_one(cls, id: int, session: Session):
-        customer = session.get(Customer, id)
-        return customer
-
-    @classmethod
-    def update(cls, id: int, model: User, session: Session):
-        customer = session
-
-    @classmethod
-    def delete(cls, id: int, session: Session):
-        customer = cls.get_one(id, session)
-        if customer:
-            session.delete(customer)
-            return "successfull"
-        return None
-
-
-class SaleControler:
-    @classmethod
-    def save(cls, model: Sale, session: Session):
-        model = Sale.model_validate(model)
-        session.add(model)
-        session.commit()
-        session.refresh(model)
-        return model
-
-    @classmethod
-    def get_all(cls, offset: int, limit: int, session: Session):
-        query = select(Sale).offset(offset).limit(limit)
-        sales = session.exec(query).all()
-        return sales
-
-    @classmethod
-    def get_one(cls, id: int, session: Session):
-        sale = session.get(Sale, id)
-        return sale
+class SaleControler(BaseControler[Sale]):
+    model = Sale
 
     @classmethod
     def get_today_sale(cls, session: Session):
@@ -101,32 +46,58 @@ class SaleControler:
         return sale
 
     @classmethod
-    def delete(cls, id: int, session: Session):
+    def delete(cls, id: int, session: Session, commit: bool = True):
         sale = cls.get_one(id, session)
         if sale:
             return "successfull"
         return None
 
 
-class ProductControler:
+class SaleItemControler(BaseControler[SaleItem]):
+    """line items carry their product's name, a listing is one query"""
+
+    model = SaleItem
+
     @classmethod
-    def save(cls, model: ProductsIn, session: Session):
-        model = Product.model_validate(model)
-        session.add(model)
-        session.commit()
-        session.refresh(model)
-        return model
+    def get_by_sale(cls, sale_id: int, session: Session) -> Sequence[SaleItem]:
+        query = select(SaleItem).where(SaleItem.sale_id == sale_id)
+        return session.exec(query.order_by(SaleItem.id)).all()
 
     @classmethod
-    def get_all(cls, offset: int, limit: int, session: Session):
-        products = session.exec(select(Product).offset(offset).limit(limit)).all()
-        return products
+    def get_by_invoice(cls, invoice_id: int, session: Session) -> Sequence[SaleItem]:
+        query = select(SaleItem).where(SaleItem.invoice_id == invoice_id)
+        return session.exec(query.order_by(SaleItem.id)).all()
+
+
+class ProductControler(BaseControler[Product]):
+    model = Product
+    track_deletes = True
+    delete_message = "success"
 
     @classmethod
-    def get_one(cls, id: int, session: Session):
-        product = session.get(Product, id)
+    def save(cls, model: ProductsIn, session: Session, commit: bool = True):
+        # the opening stock is valued at the buying price it was entered with
+        product = super().save(model, session, commit=False)
+        ValuationControler.receive(
+            product.id, product.stock, product.buying_price, session
+        )
+        cls._finish(session, commit)
+        if commit:
+            session.refresh(product)
         return product
 
+    @classmethod
+    def save_many(cls, models: list[ProductsIn], session: Session, commit: bool = True):
+        products = super().save_many(models, session, commit=False)
+        for product in products:
+            ValuationControler.receive(
+                product.id, product.stock, product.buying_price, session
+            )
+        cls._finish(session, commit)
+        if commit:
+            return cls.get_many([product.id for product in products], session)
+        return products
+
     @classmethod
     def get_by_name(cls, name: str, session: Session):
         product = session.exec(select(Product).where(Product.name == name)).all()
@@ -135,7 +106,7 @@ class ProductControler:
         return False
 
     @classmethod
-    def update(cls, model: ProductsIn, id: int, session: Session):
+    def update(cls, id: int, model: ProductsIn, session: Session, commit: bool = True):
         productdb = cls.get_one(id, session)
         today = datetime.now(timezone.utc)
         if not productdb:
@@ -147,69 +118,29 @@ class ProductControler:
             setattr(productdb, k, v)
             setattr(productdb, "updated_at", today)
         productdb.stock += product_stock
+        ValuationControler.receive(id, model.stock, model.buying_price, session)
         session.add(productdb)
-        session.commit()
-        session.refresh(productdb)
+        cls._finish(session, commit)
+        if commit:
+            session.refresh(productdb)
         return productdb
 
-    @classmethod
-    def delete(cls, id: int, session: Session):
-        product = cls.get_one(id, session)
-        if product:
-            session.delete(product)
-            return "success"
-        return None
-
-
-class LoanControler:
-    @classmethod
-    def save(cls, model: LoanIn, session: Session):
-        loan = Loan.model_validate(model)
-        session.add(loan)
-        session.commit()
-        session.refresh(loan)
-        return loan
-
-    @classmethod
-    def get_all(cls, offset: int, limit: int, session: Session):
-        loans = session.exec(select(Loan).offset(offset).limit(limit)).all()
-        return loans
-
-    @classmethod
-    def get_one(cls, id: int, session: Session):
-        loan = session.get(Loan, id)
-        return loan
-
-    @classmethod
-    def delete(cls, id: int, session: Session):
-        loan = cls.get_one(id, session)
-        if loan:
-            session.delete(loan)
-            return "deleted successful"
-        return None
 
+class LoanControler(BaseControler[Loan]):
+    model = Loan
+    track_deletes = True
+    delete_message = "deleted successful"
 
-class InvoiceControler:
-    @classmethod
-    def save(cls, model: InvoiceIn, session: Session):
-        invoice = Invoice.model_validate(model)
-        session.add(invoice)
-        session.commit()
-        session.refresh(invoice)
-        return invoice
 
-    @classmethod
-    def get_all(cls, offset: int, limit: int, session: Session):
-        invoiceses = session.exec(select(Invoice).offset(offset).limit(limit)).all()
-        return invoiceses
-
-    @classmethod
-    def get_one(cls, id: int, session: Session):
-        invoice = session.get(Invoice, id)
-        return invoice
+class InvoiceControler(BaseControler[Invoice]):
+    model = Invoice
+    track_deletes = True
+    delete_message = "successful deleted"
 
     @classmethod
-    def update_amount(cls, id: int, amount: float, session: Session):
+    def update_amount(
+        cls, id: int, amount: float, session: Session, commit: bool = True
+    ):
         date = datetime.now(timezone.utc)
         invoice = cls.get_one(id, session)
         if not invoice:
@@ -221,195 +152,135 @@ class InvoiceControler:
         invoice.paid_amount += amount
         invoice.updated_at = date
         session.add(invoice)
-        session.commit()
-        session.refresh(invoice)
+        cls._finish(session, commit)
+        if commit:
+            session.refresh(invoice)
         return invoice
 
-    @classmethod
-    def delete(cls, id: int, session: Session):
-        invoice = cls.get_one(id, session)
-        if invoice:
-            session.delete(invoice)
-            return "successful deleted"
-        return None
 
+class PayItemControler(BaseControler[PayItem]):
+    model = PayItem
+    delete_message = "successful deleted"
 
-class PayItemControler:
-    @classmethod
-    def save(cls, model: PayItem, session: Session):
-        pay = PayItem.model_validate(model)
-        session.add(pay)
-        session.commit()
-        session.refresh(pay)
-        return pay
 
-    @classmethod
-    def get_all(cls, offset: int, limit: int, session: Session):
-        payitems = session.exec(select(PayItem).offset(offset).limit(limit)).all()
-        return payitems
+class PurchaseControler(BaseControler[Purchase]):
+    model = Purchase
 
-    @classmethod
-    def get_one(cls, id: int, session: Session):
-        payitem = session.get(PayItem, id)
-        return payitem
 
-    @classmethod
-    def update(cls, id: int, model: PayItemIn, session: Session):
-        pay = cls.get_one(id, session)
-        today = datetime.now(timezone.utc)
-        if not pay:
-            return None
-        for k, v in model.model_dump(exclude_unset=True).items():
-            setattr(pay, k, v)
-            setattr(pay, "updated_at", today)
-        session.add(pay)
-        session.commit()
-        session.refresh(pay)
-        return pay
+class PurchaseItemControler(BaseControler[PurchaseItem]):
+    model = PurchaseItem
 
     @classmethod
-    def delete(cls, id: int, session: Session):
-        payitem = cls.get_one(id, session)
-        if payitem:
-            session.delete(payitem)
-            return "successful deleted"
-        return None
-
-
-class PurchaseControler:
-    @classmethod
-    def save(cls, model: ParchaseIn, session: Session):
-        purchase = Purchase.model_validate(model)
-        session.add(purchase)
-        session.commit()
-        session.refresh(purchase)
-        return purchase
-
-    @classmethod
-    def get_all(cls, offset: int, limit: int, session: Session):
-        purchases = session.exec(select(Purchase).offset(offset).limit(limit)).all()
-        return purchases
-
-    @classmethod
-    def get_one(cls, id: int, session: Session):
-        purchase = session.get(Purchase, id)
-        return purchase
-
-    @classmethod
-    def update(cls, id: int, model: ParchaseIn, session: Session):
-        purchase = cls.get_one(id, session)
-        today = datetime.now(timezone.utc)
-        if not purchase:
-            return None
-        for k, v in model.model_dump(exclude_unset=True).items():
-            setattr(purchase, k, v)
-            setattr(purchase, "updated_at", today)
-        session.add(purchase)
-        session.commit()
-        session.refresh(purchase)
-        return purchase
+    def save_list(
+        cls,
+        purchase_id: int,
+        items: list[PurchaseItemIn],
+        session: Session,
+        commit: bool = True,
+    ):
+        """receive a delivery, all of its lines or none of them
 
-    @classmethod
-    def delete(cls, id: int, session: Session):
-        purchase = cls.get_one(id, session)
-        if purchase:
-            session.delete(purchase)
-            return "successful"
-        return None
-
-
-class PurchaseItemControler:
-    @classmethod
-    def save(cls, model: PurchaseItemIn, session: Session):
-        item = PurchaseItem.model_validate(model)
-        session.add(item)
-        session.commit()
-        session.refresh(item)
-        return item
-
-    @classmethod
-    def save_list(cls, purchase_id: int, items: list[PurchaseItemIn], session: Session):
+        The products come in one query, the lines go in with one insert and
+        the stock of every product is raised by one update. The purchase
+        amount is summed up again from its lines in the same transaction.
+        Raises InvalidLines with the reason of every line that can not be
+        received.
+        """
         purchase = PurchaseControler.get_one(purchase_id, session)
         if not purchase:
             return None
+        products = {
+            product.id: product
+            for product in ProductControler.get_many(
+                {item.product_id for item in items}, session
+            )
+        }
+        errors = []
+        for line, item in enumerate(items):
+            if item.product_id not in products:
+                detail = f"product with id {item.product_id} was not found"
+            elif item.quantity <= 0:
+                detail = "quantity must be more than 0"
+            else:
+                continue
+            errors.append(
+                {"line": line, "product_id": item.product_id, "detail": detail}
+            )
+        if errors:
+            raise InvalidLines(errors)
+        if not items:
+            return []
+
+        now = datetime.now(timezone.utc)
+        rows = []
+        received = defaultdict(float)
         for item in items:
-            product = ProductControler.get_one(item.product_id, session)
-            if not product:
-                raise NotFound(f"product with id {id} not found")
-            item = PurchaseItem.model_validate(item)
-            product.stock += item.quantity
-            item.purchase_id = purchase_id
-            session.add(item)
-        session.commit()
-
-        return purchase.purchaseitems
-
-    @classmethod
-    def get_one(cls, id: int, session: Session):
-        item = session.get(PurchaseItem, id)
-        return item
-
-    @classmethod
-    def get_all(cls, offset: int, limit: int, session: Session):
-        items = session.exec(select(PurchaseItem).offset(offset).limit(limit)).all()
-        return items
-
-    @classmethod
-    def delete(cls, id: int, session: Session):
-        item = cls.get_one(id, session)
-        if item:
-            session.delete(item)
-            return "successful"
-        return None
-
-
-class ExpenseControler:
-    @classmethod
-    def save(cls, model: Expense, session: Session):
-        expense = Expense.model_validate(model)
-        session.add(expense)
-        session.commit()
-        session.refresh(expense)
-        return expense
+            product = products[item.product_id]
+            rows.append(
+                {
+                    **item.model_dump(),
+                    "purchase_id": purchase_id,
+                    "product_name": product.name,
+                    "units": product.units,
+                    "created_at": now,
+                    "updated_at": now,
+                }
+            )
+            received[item.product_id] += item.quantity
+        # the returned rows carry what the cost layers need, their order
+        # does not matter and the insert can go in batches of many rows
+        stmt = insert(PurchaseItem).returning(
+            PurchaseItem.id,
+            PurchaseItem.product_id,
+            PurchaseItem.quantity,
+            PurchaseItem.amount,
+        )
+        inserted = session.exec(stmt, params=rows).mappings().all()
+        ids = [row["id"] for row in inserted]
+        changelog.record(session, "purchaseitem", "insert", ids)
+        ValuationControler.receive_many(inserted, session)
+
+        stmt = (
+            update(Product)
+            .where(Product.id.in_(received))
+            .values(
+                stock=Product.stock + case(received, value=Product.id),
+                updated_at=now,
+            )
+            .returning(Product.id)
+        )
+        updated = session.exec(stmt).scalars().all()
+        changelog.record(session, "product", "update", updated, ["stock", "updated_at"])
+
+        purchase.amount = session.exec(
+            select(
+                func.coalesce(func.sum(PurchaseItem.amount * PurchaseItem.quantity), 0)
+            ).where(PurchaseItem.purchase_id == purchase_id)
+        ).one()
+        purchase.updated_at = now
+        session.add(purchase)
+        cls._finish(session, commit)
+        return cls.get_many(ids, session)
 
     @classmethod
-    def save_list(cls, items: list[ExpenseIn], session: Session):
-        dbitem: list[Expense] = []
-        for item in items:
-            item = Expense.model_validate(item)
-            dbitem.append(item)
-            session.add(item)
-        session.commit()
-        for item in dbitem:
-            session.refresh(item)
-        return dbitem
+    def get_by_purchase(
+        cls, purchase_id: int, session: Session
+    ) -> Sequence[PurchaseItem]:
+        query = select(PurchaseItem).where(PurchaseItem.purchase_id == purchase_id)
+        return session.exec(query.order_by(PurchaseItem.id)).all()
 
-    @classmethod
-    def get_all(cls, offset: int, limit: int, session: Session):
-        expense = session.exec(select(Expense).offset(offset).limit(limit)).all()
-        return expense
 
-    @classmethod
-    def get_one(cls, id: int, session: Session):
-        expense = session.get(Expense, id)
-        return expense
+class ExpenseControler(BaseControler[Expense]):
+    model = Expense
 
     @classmethod
-    def update(cls, id: int, model: ExpenseIn, session: Session):
-        expense = cls.get_one(id, session)
-        today = datetime.now(timezone.utc)
-        for k, v in model.model_dump(exclude_unset=True).items():
-            setattr(expense, k, v)
-            setattr(expense, "updated_at", today)
-        session.add(expense)
-        session.commit()
-        session.refresh(expense)
-        return expense
+    def get_all(cls, offset: int, limit: int, session: Session) -> list[Expense]:
+        """hot and archived expenses in id order, the archived ones are older"""
+        hot, archive = Expense.__table__, archive_tables[Expense]
+        query = union_all(select(*hot.c), select(*archive.c)).order_by("id")
+        rows = session.exec(query.offset(offset).limit(limit)).all()
+        return [Expense.model_validate(row._mapping) for row in rows]
 
     @classmethod
-    def delete(cls, id: int, session: Session):
-        expense = cls.get_one(id, session)
-        if expense:
-            session.delete(expense)
-            return "successful"
-        return None
+    def save_list(cls, items: list[ExpenseIn], session: Session, commit: bool = True):
+        return cls.save_many(items, session, commit)
@@ -0,0 +1,163 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, time, timedelta, timezone
+
+from sqlmodel import Session, select
+
+from controlers.inventory import InventoryControler
+from models.model import ForecastRow, Product, current_tenant
+
+# catalogs with more products than this are split across a process pool
+FORECAST_PARALLEL_MIN = int(os.getenv("FORECAST_PARALLEL_MIN", "100000"))
+FORECAST_WORKERS = int(os.getenv("FORECAST_WORKERS", "1"))
+# products per dense block, bounds the memory of one block of the matrix
+FORECAST_CHUNK = 10000
+FORECAST_CACHE_SIZE = 16
+
+# params -> (watermark, product ids, names, daily forecast)
+_forecast_cache: dict[tuple, tuple] = {}
+
+
+def forecast_block(rows, days, quantities, n_rows, n_days, method, alpha, window):
+    """daily demand forecast for a block of products
+
+    rows/days/quantities are the sales of the block as product x day cells,
+    the dense matrix is built here so a block can be handed to another
+    process as three flat arrays.
+    """
+    import numpy as np
+
+    matrix = np.bincount(
+        rows * n_days + days, weights=quantities, minlength=n_rows * n_days
+    ).reshape(n_rows, n_days)
+    if method == "moving_average":
+        window = min(window, n_days)
+        return matrix[:, -window:].mean(axis=1)
+    # simple exponential smoothing unrolled into one matrix vector product:
+    # level = sum(alpha * (1 - alpha) ** age * x) + (1 - alpha) ** n * x[0]
+    ages = np.arange(n_days - 1, -1, -1, dtype=np.float64)
+    weights = alpha * (1 - alpha) ** ages
+    weights[0] += (1 - alpha) ** n_days
+    return matrix @ weights
+
+
+class ForecastControler:
+    @classmethod
+    def _compute(cls, session, history_days, method, alpha, window, workers):
+        import numpy as np
+
+        products = session.exec(
+            select(Product.id, Product.name).order_by(Product.id)
+        ).all()
+        ids = np.fromiter((row[0] for row in products), dtype=np.int64)
+        names = [row[1] for row in products]
+        n = len(ids)
+        if not n:
+            return ids, names, np.zeros(0)
+
+        today = datetime.now(timezone.utc).date()
+        # the last column of the matrix is today
+        start = datetime.combine(today - timedelta(days=history_days - 1), time.min)
+        start = start.strftime("%Y-%m-%d %H:%M:%S.%f")
+        # the history is millions of rows, they are streamed from the DBAPI
+        # cursor straight into a numpy record array and summed per day there
+        cursor = session.connection().connection.cursor()
+        try:
+            cursor.execute(
+                "SELECT product_id,"
+                " CAST(julianday(created_at) - julianday(?) AS INTEGER), quantity"
+                " FROM saleitem WHERE created_at >= ? AND product_id IS NOT NULL",
+                (start, start),
+            )
+            cells = np.fromiter(
+                cursor, dtype=[("product", "i8"), ("day", "i8"), ("quantity", "f8")]
+            )
+        finally:
+            cursor.close()
+        daily = np.zeros(n)
+        if not len(cells):
+            return ids, names, daily
+
+        rows = np.searchsorted(ids, cells["product"])
+        keep = (rows < n) & (cells["day"] >= 0) & (cells["day"] < history_days)
+        keep &= ids[np.minimum(rows, n - 1)] == cells["product"]
+        rows, cell_days, cell_qty = (
+            rows[keep],
+            cells["day"][keep],
+            cells["quantity"][keep],
+        )
+
+        order = np.argsort(rows, kind="stable")
+        rows, cell_days, cell_qty = rows[order], cell_days[order], cell_qty[order]
+        bounds = list(range(0, n, FORECAST_CHUNK)) + [n]
+        cuts = np.searchsorted(rows, bounds)
+        blocks = [
+            (
+                rows[cuts[i] : cuts[i + 1]] - bounds[i],
+                cell_days[cuts[i] : cuts[i + 1]],
+                cell_qty[cuts[i] : cuts[i + 1]],
+                bounds[i + 1] - bounds[i],
+                history_days,
+                method,
+                alpha,
+                window,
+            )
+            for i in range(len(bounds) - 1)
+        ]
+        if workers > 1 and n >= FORECAST_PARALLEL_MIN:
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(workers, mp_context=context) as pool:
+                results = list(pool.map(forecast_block, *zip(*blocks)))
+        else:
+            results = [forecast_block(*block) for block in blocks]
+        return ids, names, np.concatenate(results)
+
+    @classmethod
+    def forecast(
+        cls,
+        session: Session,
+        horizon: int = 7,
+        method: str = "ses",
+        alpha: float = 0.3,
+        history_days: int = 730,
+        window: int = 28,
+        offset: int = 0,
+        limit: int = 100,
+        workers: int | None = None,
+    ) -> list[ForecastRow]:
+        """next `horizon` days of demand for every product
+
+        The whole catalog is forecast at once and cached until new sales,
+        purchases or product changes arrive, pages are cut from the cached
+        arrays.
+        """
+        params = (current_tenant.get(), method, alpha, history_days, window)
+        # the history window ends today, a new day needs a new forecast
+        today = datetime.now(timezone.utc).date()
+        watermark = (*InventoryControler.watermark(session), today)
+        cached = _forecast_cache.get(params)
+        if not cached or cached[0] != watermark:
+            ids, names, daily = cls._compute(
+                session,
+                history_days,
+                method,
+                alpha,
+                window,
+                workers or FORECAST_WORKERS,
+            )
+            if len(_forecast_cache) >= FORECAST_CACHE_SIZE:
+                _forecast_cache.clear()
+            cached = (watermark, ids, names, daily)
+            _forecast_cache[params] = cached
+
+        _, ids, names, daily = cached
+        return [
+            ForecastRow(
+                product_id=int(ids[i]),
+                name=names[i],
+                daily=float(daily[i]),
+                total=float(daily[i]) * horizon,
+            )
+            for i in range(offset, min(offset + limit, len(ids)))
+        ]
@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+from models.model import Product, PurchaseItem, ReorderRow, SaleItem, current_tenant
+
+REORDER_CACHE_SIZE = 32
+
+# params -> (watermark, rows), a watermark changes with every new sale
+# item, purchase item or product update and with the utc date
+_reorder_cache: dict[tuple, tuple[tuple, list[ReorderRow]]] = {}
+
+
+class InventoryControler:
+    @classmethod
+    def watermark(cls, session: Session) -> tuple:
+        """one cheap query telling whether the reorder inputs have changed"""
+        return session.exec(
+            select(
+                select(func.max(SaleItem.id)).scalar_subquery(),
+                select(func.max(PurchaseItem.id)).scalar_subquery(),
+                select(func.max(Product.updated_at)).scalar_subquery(),
+                select(func.count(Product.id)).scalar_subquery(),
+            )
+        ).one()
+
+    @classmethod
+    def reorder(
+        cls,
+        session: Session,
+        window_days: int = 30,
+        lead_time_days: float = 7,
+        cover_days: float = 14,
+        service_z: float = 1.65,
+        only_low: bool = True,
+    ) -> list[ReorderRow]:
+        """reorder points and days of cover for the whole catalog
+
+        SQL reduces the window to the sum and sum of squares of daily sales
+        per product, those land in dense arrays aligned with the catalog and
+        everything after that is array arithmetic over all products:
+
+            reorder point = velocity * lead time + z * std * sqrt(lead time)
+        """
+        params = (
+            current_tenant.get(),
+            window_days,
+            lead_time_days,
+            cover_days,
+            service_z,
+            only_low,
+        )
+        # the window moves with the day even when nothing was written
+        today = datetime.now(timezone.utc).date()
+        watermark = (*cls.watermark(session), today)
+        cached = _reorder_cache.get(params)
+        if cached and cached[0] == watermark:
+            return cached[1]
+
+        # numpy is only needed here, keep it off the import path of the app
+        import numpy as np
+
+        products = session.exec(
+            select(Product.id, Product.name, Product.stock).order_by(Product.id)
+        ).all()
+        if not products:
+            return []
+        ids = np.fromiter((row[0] for row in products), dtype=np.int64)
+        stock = np.fromiter((row[2] for row in products), dtype=np.float64)
+
+        since = datetime.now(timezone.utc) - timedelta(days=window_days)
+        per_day = (
+            select(
+                SaleItem.product_id,
+                func.sum(SaleItem.quantity).label("quantity"),
+            )
+            .where(SaleItem.created_at >= since, SaleItem.product_id.is_not(None))
+            .group_by(SaleItem.product_id, func.date(SaleItem.created_at))
+            .subquery()
+        )
+        sold = session.exec(
+            select(
+                per_day.c.product_id,
+                func.sum(per_day.c.quantity),
+                func.sum(per_day.c.quantity * per_day.c.quantity),
+            ).group_by(per_day.c.product_id)
+        ).all()
+        n = len(ids)
+        total = np.zeros(n)
+        squares = np.zeros(n)
+        if sold:
+            sold_ids = np.fromiter((row[0] for row in sold), dtype=np.int64)
+            index = np.searchsorted(ids, sold_ids)
+            # sale items of deleted products have no row to land in
+            known = (index < n) & (ids[np.minimum(index, n - 1)] == sold_ids)
+            total[index[known]] = np.fromiter((row[1] for row in sold), float)[known]
+            squares[index[known]] = np.fromiter((row[2] for row in sold), float)[known]
+
+        # days without sales count as zero demand
+        velocity = total / window_days
+        variance = np.maximum(squares / window_days - velocity * velocity, 0)
+        safety = service_z * np.sqrt(variance) * np.sqrt(lead_time_days)
+        reorder_point = velocity * lead_time_days + safety
+        target = velocity * (lead_time_days + cover_days) + safety
+        order_quantity = np.ceil(np.maximum(target - stock, 0))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cover = np.where(velocity > 0, stock / velocity, np.inf)
+        needs_reorder = (stock <= reorder_point) & (velocity > 0)
+
+        selected = np.flatnonzero(needs_reorder) if only_low else np.arange(n)
+        selected = selected[np.argsort(cover[selected], kind="stable")]
+        rows = [
+            ReorderRow(
+                product_id=int(ids[i]),
+                name=products[i][1],
+                stock=float(stock[i]),
+                daily_velocity=float(velocity[i]),
+                reorder_point=float(reorder_point[i]),
+                days_of_cover=float(cover[i]) if np.isfinite(cover[i]) else None,
+                order_quantity=float(order_quantity[i]),
+                needs_reorder=bool(needs_reorder[i]),
+            )
+            for i in selected.tolist()
+        ]
+
+        if len(_reorder_cache) >= REORDER_CACHE_SIZE:
+            _reorder_cache.clear()
+        _reorder_cache[params] = (watermark, rows)
+        return rows
@@ -0,0 +1,169 @@
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta, timezone
+
+from sqlalchemy import case, func, union_all
+from sqlmodel import Session, select
+
+from models.model import (
+    AgingBuckets,
+    AgingReport,
+    AgingRow,
+    CategoryExpense,
+    Customer,
+    Expense,
+    ExpenseSummary,
+    Invoice,
+    Loan,
+    Status,
+    archive_tables,
+)
+
+# first day of the period a timestamp falls in, weeks start on monday
+PERIODS = {
+    "day": lambda created: func.date(created),
+    "week": lambda created: func.date(created, "weekday 0", "-6 days"),
+    "month": lambda created: func.date(created, "start of month"),
+}
+
+
+class ReportControler:
+    @classmethod
+    def aging(
+        cls,
+        session: Session,
+        as_of: datetime | None = None,
+        offset: int = 0,
+        limit: int = 100,
+    ) -> AgingReport:
+        """outstanding invoice amounts per customer bucketed by invoice age
+
+        A single grouped query over the open invoices; the grand totals and
+        the number of customers are window functions over the same groups so
+        they cover every customer, not only the returned page.
+        """
+        as_of = as_of or datetime.now(timezone.utc)
+        # comparing created_at with cut-off dates keeps the per row work to
+        # string comparisons instead of date arithmetic
+        cut_30, cut_60, cut_90 = (as_of - timedelta(days=d) for d in (30, 60, 90))
+        due = Invoice.invoice_amount - Invoice.paid_amount
+        created = Invoice.created_at
+        buckets = {
+            "current": func.sum(case((created > cut_30, due), else_=0)),
+            "days_30": func.sum(
+                case(((created <= cut_30) & (created > cut_60), due), else_=0)
+            ),
+            "days_60": func.sum(
+                case(((created <= cut_60) & (created > cut_90), due), else_=0)
+            ),
+            "days_90_plus": func.sum(case((created <= cut_90, due), else_=0)),
+            "total": func.sum(due),
+        }
+        # aggregate per loan walking ix_invoice_aging in loan order, a loan
+        # belongs to one customer so only the returned page is joined
+        per_loan = (
+            select(
+                Invoice.loan_id,
+                *(column.label(name) for name, column in buckets.items()),
+                *(
+                    func.sum(column).over().label(f"all_{name}")
+                    for name, column in buckets.items()
+                ),
+                func.count().over().label("customers_count"),
+            )
+            .where(Invoice.status != Status.paid, due > 0)
+            .group_by(Invoice.loan_id)
+            .order_by(buckets["total"].desc(), Invoice.loan_id)
+            .offset(offset)
+            .limit(limit)
+            .subquery()
+        )
+        query = (
+            select(Customer.id, Customer.name, per_loan)
+            .join(Loan, Loan.id == per_loan.c.loan_id)
+            .join(Customer, Customer.id == Loan.customer_id)
+            .order_by(per_loan.c.total.desc(), per_loan.c.loan_id)
+        )
+        rows = session.exec(query).all()
+
+        totals = AgingBuckets()
+        customers_count = 0
+        if rows:
+            first = rows[0]._mapping
+            totals = AgingBuckets(**{name: first[f"all_{name}"] for name in buckets})
+            customers_count = first["customers_count"]
+        return AgingReport(
+            as_of=as_of,
+            customers_count=customers_count,
+            totals=totals,
+            customers=[
+                AgingRow(
+                    customer_id=row.id,
+                    name=row.name,
+                    **{name: row._mapping[name] for name in buckets},
+                )
+                for row in rows
+            ],
+        )
+
+    @classmethod
+    def expense_summary(
+        cls,
+        session: Session,
+        since: date,
+        until: date,
+        period: str = "month",
+        top: int = 5,
+        category: str | None = None,
+    ) -> ExpenseSummary:
+        """expenses per category and period over [since, until]
+
+        One grouped query over the covering (category, created_at, amount)
+        index, plus the archived expenses of the range. A single category
+        is a range seek on the index, all of them a scan of the index
+        only. The top categories are summed up from the same rows.
+        """
+        start = datetime.combine(since, time.min)
+        end = datetime.combine(until + timedelta(days=1), time.min)
+        arms = []
+        for table in (Expense.__table__, archive_tables[Expense]):
+            arm = select(table.c.category, table.c.created_at, table.c.amount).where(
+                table.c.created_at >= start, table.c.created_at < end
+            )
+            if category is not None:
+                arm = arm.where(table.c.category == category)
+            arms.append(arm)
+        rows = union_all(*arms).subquery()
+        key = PERIODS[period](rows.c.created_at).label("period")
+        query = (
+            select(
+                rows.c.category,
+                key,
+                func.count().label("count"),
+                func.sum(rows.c.amount).label("amount"),
+            )
+            # by the label, a repeated expression would bind its modifiers
+            # again and sqlite could not tell it is the same one
+            .group_by(rows.c.category, "period").order_by(rows.c.category, "period")
+        )
+        # plain rows, the summary validates them all in one go, a year of
+        # days would spend longer in model constructors than in sqlite
+        periods = [row._asdict() for row in session.exec(query)]
+        totals = defaultdict(lambda: [0, 0.0])
+        for row in periods:
+            totals[row["category"]][0] += row["count"]
+            totals[row["category"]][1] += row["amount"]
+        categories = sorted(
+            (
+                CategoryExpense(category=category, count=count, amount=amount)
+                for category, (count, amount) in totals.items()
+            ),
+            key=lambda row: -row.amount,
+        )
+        return ExpenseSummary(
+            since=since,
+            until=until,
+            period=period,
+            total=sum(row.amount for row in categories),
+            categories=categories[:top],
+            periods=periods,
+        )
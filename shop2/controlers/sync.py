@@ -0,0 +1,115 @@
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete
+from sqlmodel import Session, select
+
+from models.model import (
+    Customer,
+    Invoice,
+    Loan,
+    Product,
+    SyncBatch,
+    SyncChanges,
+    Tombstone,
+    get_engine,
+)
+
+# rows committed while a sync was reading can carry an earlier updated_at
+# than its token, the next sync looks back this far to pick them up
+SYNC_OVERLAP = timedelta(seconds=int(os.getenv("SYNC_OVERLAP_SECONDS", "30")))
+# tombstones are kept this long, older tokens get a full snapshot
+SYNC_TOMBSTONE_DAYS = int(os.getenv("SYNC_TOMBSTONE_DAYS", "90"))
+
+SYNC_TABLES = {
+    "products": Product,
+    "customers": Customer,
+    "loans": Loan,
+    "invoices": Invoice,
+}
+
+
+class BatchSession(Session):
+    """session whose commits only flush, the batch commits once at the end
+
+    Lets the regular write handlers run unchanged inside one transaction.
+    """
+
+    def commit(self):
+        self.flush()
+
+    def commit_batch(self):
+        super().commit()
+
+
+def encode_token(moment: datetime) -> str:
+    return str(int(moment.timestamp() * 1_000_000))
+
+
+def decode_token(token: str) -> datetime:
+    return datetime.fromtimestamp(int(token) / 1_000_000, timezone.utc)
+
+
+class SyncControler:
+    @classmethod
+    def changes(cls, session: Session, since: str | None = None) -> SyncChanges:
+        """rows created, updated or deleted since a token of an earlier sync
+
+        Without a token, or with one older than the tombstones reach, the
+        answer is a full snapshot with reset set, the client then replaces
+        its data instead of merging into it.
+        """
+        now = datetime.now(timezone.utc)
+        start = decode_token(since) if since else None
+        reset = start is None or start < now - timedelta(days=SYNC_TOMBSTONE_DAYS)
+        lower = None if reset else start - SYNC_OVERLAP
+
+        changed = {}
+        for name, model in SYNC_TABLES.items():
+            query = select(model).order_by(model.id)
+            if lower is not None:
+                query = query.where(model.updated_at >= lower)
+            changed[name] = session.exec(query).all()
+
+        deleted = {name: [] for name in SYNC_TABLES}
+        if lower is not None:
+            tables = {model.__tablename__: name for name, model in SYNC_TABLES.items()}
+            tombstones = session.exec(
+                select(Tombstone.table_name, Tombstone.row_id)
+                .where(Tombstone.deleted_at >= lower)
+                .order_by(Tombstone.id)
+            ).all()
+            # sqlite may hand a deleted id to a new row, the new row wins
+            alive = {name: {row.id for row in rows} for name, rows in changed.items()}
+            for table_name, row_id in tombstones:
+                name = tables.get(table_name)
+                if name and row_id not in alive[name]:
+                    deleted[name].append(row_id)
+
+        return SyncChanges(
+            token=encode_token(now), reset=reset, deleted=deleted, **changed
+        )
+
+    @classmethod
+    def batch_session(cls) -> BatchSession:
+        return BatchSession(get_engine())
+
+    @classmethod
+    def get_batch(cls, id: str, session: Session) -> list[dict] | None:
+        """results of a batch that was already applied"""
+        batch = session.get(SyncBatch, id)
+        return json.loads(batch.result) if batch else None
+
+    @classmethod
+    def save_batch(cls, id: str, results: list[dict], session: Session):
+        session.add(SyncBatch(id=id, result=json.dumps(results)))
+
+    @classmethod
+    def purge(cls, session: Session, days: int = SYNC_TOMBSTONE_DAYS) -> int:
+        """drop tombstones and batch records older than the sync horizon"""
+        horizon = datetime.now(timezone.utc) - timedelta(days=days)
+        deleted = session.exec(delete(Tombstone).where(Tombstone.deleted_at < horizon))
+        session.exec(delete(SyncBatch).where(SyncBatch.created_at < horizon))
+        session.commit()
+        return deleted.rowcount
@@ -0,0 +1,120 @@
+import csv
+from datetime import datetime
+
+from sqlalchemy import func, union_all
+from sqlmodel import Session, select
+
+from core import backup
+from core.jobs import JobContext, job
+from controlers.archive import ARCHIVE_DAYS, ArchiveControler
+from controlers.forecast import ForecastControler
+from controlers.valuation import ValuationControler
+from models.model import SaleItem, archive_tables
+
+EXPORT_CHUNK = 5000
+
+
+@job("sales-export")
+def export_sales(
+    ctx: JobContext,
+    session: Session,
+    since: str | None = None,
+    until: str | None = None,
+):
+    """sale items with their product names as csv, read in id ordered chunks
+
+    Archived items are exported with the hot ones, in the same id order.
+    """
+    items = union_all(
+        *(
+            select(
+                table.c.id,
+                table.c.created_at,
+                table.c.sale_id,
+                table.c.invoice_id,
+                table.c.product_id,
+                table.c.product_name,
+                table.c.quantity,
+                table.c.amount,
+            )
+            for table in (SaleItem.__table__, archive_tables[SaleItem])
+        )
+    ).subquery()
+    filters = []
+    if since:
+        filters.append(items.c.created_at >= datetime.fromisoformat(since))
+    if until:
+        filters.append(items.c.created_at < datetime.fromisoformat(until))
+    total = session.exec(select(func.count()).select_from(items).where(*filters)).one()
+
+    written = 0
+    last_id = 0
+    with open(ctx.output("sales.csv", "text/csv"), "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(
+            ["id", "created_at", "sale_id", "invoice_id", "product_id", "product"]
+            + ["quantity", "amount"]
+        )
+        while True:
+            rows = session.exec(
+                select(*items.c)
+                .where(items.c.id > last_id, *filters)
+                .order_by(items.c.id)
+                .limit(EXPORT_CHUNK)
+            ).all()
+            if not rows:
+                break
+            writer.writerows(rows)
+            written += len(rows)
+            last_id = rows[-1][0]
+            # ends the read transaction, the export does not pin the WAL
+            session.rollback()
+            ctx.progress(written / max(total, 1), f"{written} of {total} rows")
+    return f"{written} rows"
+
+
+@job("valuation-rebuild", cpu=True)
+def rebuild_valuation(ctx: JobContext, session: Session):
+    return ValuationControler.rebuild(session)
+
+
+@job("forecast-export", cpu=True)
+def export_forecast(
+    ctx: JobContext,
+    session: Session,
+    horizon: int = 7,
+    method: str = "ses",
+    history_days: int = 730,
+):
+    rows = ForecastControler.forecast(
+        session, horizon, method, history_days=history_days, limit=10**9
+    )
+    with open(ctx.output("forecast.csv", "text/csv"), "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["product_id", "name", "daily", "total"])
+        writer.writerows(
+            (row.product_id, row.name, row.daily, row.total) for row in rows
+        )
+    return f"{len(rows)} products"
+
+
+@job("backup")
+def run_backup(ctx: JobContext, session: Session):
+    record = backup.backup(session, lambda done: ctx.progress(done, "copying"))
+    return f"{record.bytes} bytes, {record.pages} pages in {record.seconds:.2f}s"
+
+
+def check_archive(days: int | None = None):
+    if days is not None and days < 0:
+        raise ValueError("days can not be negative")
+
+
+@job("archive", check=check_archive)
+def run_archive(ctx: JobContext, session: Session, days: int | None = None):
+    # days=0 archives everything settled, only None means the default
+    moved = ArchiveControler.run(
+        session,
+        ARCHIVE_DAYS if days is None else days,
+        lambda message: ctx.progress(0, message),
+    )
+    return ", ".join(f"{count} {name}" for name, count in moved.items())
@@ -0,0 +1,346 @@
+import os
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+
+from sqlalchemy import String, cast, delete, func, insert, literal, text, union_all
+from sqlmodel import Session, select
+
+from models.model import (
+    CostLayer,
+    InventoryValuation,
+    Product,
+    ProductValuationPub,
+    PurchaseItem,
+    SaleItem,
+    archive_tables,
+)
+
+# which cost a sale is charged with: "fifo" or "average"
+COSTING_METHOD = os.getenv("COSTING_METHOD", "fifo")
+
+# how many open layers are fetched at a time while a sale consumes them
+LAYER_BATCH = 8
+
+EPSILON = 1e-9
+
+
+class ValuationControler:
+    """Cost layers per product built from purchases and consumed by sales.
+
+    Every receipt adds a FIFO layer and updates the running weighted average
+    of the product, a sale takes quantity from the oldest open layers and
+    returns its cost by COSTING_METHOD. Selling only reads the layers it
+    touches through the partial index on open layers.
+    """
+
+    @classmethod
+    def _average(cls, product_id: int, session: Session) -> InventoryValuation:
+        valuation = session.get(InventoryValuation, product_id)
+        if not valuation:
+            valuation = InventoryValuation(product_id=product_id)
+            session.add(valuation)
+        return valuation
+
+    @classmethod
+    def receive(
+        cls,
+        product_id: int,
+        quantity: float,
+        unit_cost: float,
+        session: Session,
+        purchase_item_id: int | None = None,
+    ) -> CostLayer | None:
+        if quantity <= 0:
+            return None
+        layer = CostLayer(
+            product_id=product_id,
+            purchase_item_id=purchase_item_id,
+            quantity=quantity,
+            remaining=quantity,
+            unit_cost=unit_cost,
+        )
+        session.add(layer)
+        valuation = cls._average(product_id, session)
+        valuation.quantity += quantity
+        valuation.value += quantity * unit_cost
+        valuation.updated_at = datetime.now(timezone.utc)
+        return layer
+
+    @classmethod
+    def receive_many(cls, items: list[dict], session: Session):
+        """receive the purchase item rows of a delivery, a layer per row
+
+        The layers go in with one insert and the averages of all products
+        are read with one query.
+        """
+        now = datetime.now(timezone.utc)
+        layer_rows = [
+            {
+                "created_at": now,
+                "product_id": item["product_id"],
+                "purchase_item_id": item["id"],
+                "quantity": item["quantity"],
+                "remaining": item["quantity"],
+                "unit_cost": item["amount"],
+            }
+            for item in items
+            if item["quantity"] > 0
+        ]
+        if not layer_rows:
+            return
+        session.exec(insert(CostLayer), params=layer_rows)
+        product_ids = {row["product_id"] for row in layer_rows}
+        valuations = {
+            valuation.product_id: valuation
+            for valuation in session.exec(
+                select(InventoryValuation).where(
+                    InventoryValuation.product_id.in_(product_ids)
+                )
+            )
+        }
+        for row in layer_rows:
+            valuation = valuations.get(row["product_id"])
+            if valuation is None:
+                valuation = InventoryValuation(product_id=row["product_id"])
+                valuations[row["product_id"]] = valuation
+                session.add(valuation)
+            valuation.quantity += row["quantity"]
+            valuation.value += row["quantity"] * row["unit_cost"]
+            valuation.updated_at = now
+
+    @classmethod
+    def consume(cls, product: Product, quantity: float, session: Session) -> float:
+        """take quantity out of stock and return the cost of goods sold
+
+        Quantity that no layer covers (stock that was never received through
+        a purchase) is charged at the product's buying price.
+        """
+        fifo_cost = 0.0
+        left = quantity
+        while left > EPSILON:
+            layers = session.exec(
+                select(CostLayer)
+                .where(CostLayer.product_id == product.id, text("remaining > 0"))
+                .order_by(CostLayer.id)
+                .limit(LAYER_BATCH)
+            ).all()
+            if not layers:
+                break
+            for layer in layers:
+                taken = min(layer.remaining, left)
+                layer.remaining -= taken
+                if layer.remaining < EPSILON:
+                    layer.remaining = 0
+                fifo_cost += taken * layer.unit_cost
+                left -= taken
+                if left <= EPSILON:
+                    break
+            # the updated layers must leave the index before the next batch
+            session.flush()
+        if left > EPSILON:
+            fifo_cost += left * product.buying_price
+
+        valuation = cls._average(product.id, session)
+        if valuation.quantity > EPSILON:
+            average_cost = valuation.value / valuation.quantity
+        else:
+            average_cost = product.buying_price
+        average_total = average_cost * quantity
+        valuation.quantity = max(valuation.quantity - quantity, 0)
+        valuation.value = max(valuation.value - average_total, 0)
+        valuation.updated_at = datetime.now(timezone.utc)
+
+        if COSTING_METHOD == "average":
+            return average_total
+        return fifo_cost
+
+    @classmethod
+    def stock_value(
+        cls,
+        session: Session,
+        offset: int = 0,
+        limit: int = 100,
+        product_id: int | None = None,
+    ) -> list[ProductValuationPub]:
+        fifo = (
+            select(
+                CostLayer.product_id,
+                func.sum(CostLayer.remaining).label("quantity"),
+                func.sum(CostLayer.remaining * CostLayer.unit_cost).label("value"),
+            )
+            .where(text("remaining > 0"))
+            .group_by(CostLayer.product_id)
+            .subquery()
+        )
+        query = (
+            select(
+                Product.id,
+                Product.name,
+                Product.buying_price,
+                fifo.c.quantity,
+                fifo.c.value,
+                InventoryValuation.quantity,
+                InventoryValuation.value,
+            )
+            .outerjoin(fifo, fifo.c.product_id == Product.id)
+            .outerjoin(InventoryValuation, InventoryValuation.product_id == Product.id)
+            .order_by(Product.id)
+            .offset(offset)
+            .limit(limit)
+        )
+        if product_id is not None:
+            query = query.where(Product.id == product_id)
+        result = []
+        for row in session.exec(query):
+            id, name, buying_price, fifo_qty, fifo_value, avg_qty, avg_value = row
+            avg_qty = avg_qty or 0
+            avg_value = avg_value or 0
+            if avg_qty > EPSILON:
+                average_cost = avg_value / avg_qty
+            else:
+                average_cost = buying_price
+            result.append(
+                ProductValuationPub(
+                    product_id=id,
+                    name=name,
+                    quantity=fifo_qty or 0,
+                    fifo_value=fifo_value or 0,
+                    average_cost=average_cost,
+                    average_value=avg_value,
+                )
+            )
+        return result
+
+    @classmethod
+    def rebuild(cls, session: Session) -> dict:
+        """replay the purchase and sale history into fresh layers
+
+        Stock that products hold beyond what their purchases and sales explain
+        becomes an opening layer at the product's buying price. SQLite orders
+        the history and hands it over as plain tuples with the timestamps left
+        as text, the surviving layers are written in one bulk insert.
+        """
+        purchased = dict(
+            session.exec(
+                select(PurchaseItem.product_id, func.sum(PurchaseItem.quantity))
+                .where(PurchaseItem.product_id.is_not(None))
+                .group_by(PurchaseItem.product_id)
+            ).all()
+        )
+        # sales that an archive run moved were still taken from the layers
+        sales = [
+            select(
+                cast(table.c.created_at, String).label("created_at"),
+                table.c.id,
+                table.c.product_id,
+                table.c.quantity,
+            ).where(table.c.product_id.is_not(None))
+            for table in (SaleItem.__table__, archive_tables[SaleItem])
+        ]
+        sale_rows = union_all(*sales).subquery()
+        sold = dict(
+            session.exec(
+                select(sale_rows.c.product_id, func.sum(sale_rows.c.quantity)).group_by(
+                    sale_rows.c.product_id
+                )
+            ).all()
+        )
+        products = session.exec(
+            select(Product.id, Product.stock, Product.buying_price, Product.created_at)
+        ).all()
+        history = union_all(
+            select(
+                cast(PurchaseItem.created_at, String).label("created_at"),
+                literal(1).label("kind"),
+                PurchaseItem.id,
+                PurchaseItem.product_id,
+                PurchaseItem.quantity,
+                PurchaseItem.amount,
+            ).where(PurchaseItem.product_id.is_not(None)),
+            select(
+                sale_rows.c.created_at,
+                literal(2),
+                sale_rows.c.id,
+                sale_rows.c.product_id,
+                -sale_rows.c.quantity,
+                literal(None),
+            ),
+        ).order_by("created_at", "kind", "id")
+
+        layers: dict[int, deque] = defaultdict(deque)
+        averages: dict[int, list[float]] = defaultdict(lambda: [0.0, 0.0])
+        buying_price = {}
+        for product_id, stock, price, created_at in products:
+            buying_price[product_id] = price
+            opening = stock + sold.get(product_id, 0) - purchased.get(product_id, 0)
+            if opening > EPSILON:
+                layers[product_id].append([created_at, None, opening, opening, price])
+                averages[product_id] = [opening, opening * price]
+
+        events = session.exec(history).all()
+        for created_at, kind, id, product_id, quantity, unit_cost in events:
+            average = averages[product_id]
+            if kind == 1:
+                layers[product_id].append(
+                    [created_at, id, quantity, quantity, unit_cost]
+                )
+                average[0] += quantity
+                average[1] += quantity * unit_cost
+                continue
+            left = -quantity
+            open_layers = layers[product_id]
+            while left > EPSILON and open_layers:
+                layer = open_layers[0]
+                taken = min(layer[3], left)
+                layer[3] -= taken
+                left -= taken
+                if layer[3] <= EPSILON:
+                    open_layers.popleft()
+            if average[0] > EPSILON:
+                cost = average[1] / average[0] * -quantity
+            else:
+                cost = buying_price.get(product_id, 0) * -quantity
+            average[0] += quantity
+            average[1] -= cost
+            if average[0] < EPSILON or average[1] < 0:
+                average[0] = max(average[0], 0.0)
+                average[1] = max(average[1], 0.0)
+
+        now = datetime.now(timezone.utc)
+        layer_rows = [
+            {
+                "created_at": (
+                    datetime.fromisoformat(created_at)
+                    if isinstance(created_at, str)
+                    else created_at
+                ),
+                "product_id": product_id,
+                "purchase_item_id": item_id,
+                "quantity": quantity,
+                "remaining": remaining,
+                "unit_cost": unit_cost,
+            }
+            for product_id, open_layers in layers.items()
+            for created_at, item_id, quantity, remaining, unit_cost in open_layers
+        ]
+        valuation_rows = [
+            {
+                "product_id": product_id,
+                "quantity": qty,
+                "value": value,
+                "updated_at": now,
+            }
+            for product_id, (qty, value) in averages.items()
+        ]
+        session.exec(delete(CostLayer))
+        session.exec(delete(InventoryValuation))
+        if layer_rows:
+            session.exec(insert(CostLayer), params=layer_rows)
+        if valuation_rows:
+            session.exec(insert(InventoryValuation), params=valuation_rows)
+        session.commit()
+        return {
+            "events": len(events),
+            "layers": len(layer_rows),
+            "products": len(valuation_rows),
+        }
@@ -0,0 +1,196 @@
+"""Admission control in front of the request handlers.
+
+Writes and reads pass separate gates. A gate lets a fixed number of
+requests run and queues a bounded number more, a request that finds the
+queue full, or waits in it longer than the queue timeout, is answered
+with 503 and Retry-After right away instead of adding to the pile up
+behind SQLite's single writer. The write gate defaults to one request at
+a time per worker, the database serializes writers anyway and a second
+one would only wait inside SQLite holding the event loop.
+
+Every tenant database has a writer of its own, so every tenant gets its
+own write gate; reads of all tenants share one gate.
+
+The gates are per worker process. Writers of different workers still
+meet in SQLite, a write that outwaits the busy timeout there is turned
+into the same 503 by database_busy().
+"""
+
+import asyncio
+import json
+import os
+import time
+from collections import deque
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from sqlalchemy.exc import OperationalError
+from starlette._utils import get_route_path
+
+from models.model import current_tenant
+
+READ_LIMIT = int(os.getenv("ADMISSION_READ_LIMIT", "8"))
+READ_QUEUE = int(os.getenv("ADMISSION_READ_QUEUE", "32"))
+WRITE_LIMIT = int(os.getenv("ADMISSION_WRITE_LIMIT", "1"))
+WRITE_QUEUE = int(os.getenv("ADMISSION_WRITE_QUEUE", "16"))
+QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2"))
+RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+# long lived streams would hold a slot for their whole life
+EXEMPT_PATHS = ("/events", "/admission")
+
+READ_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+# queue times kept for the percentiles in the stats
+WAIT_SAMPLES = 1000
+
+
+class Gate:
+    def __init__(self, name: str, limit: int, queue_size: int, timeout: float):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiters: deque[asyncio.Future] = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.queued = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.waits: deque[float] = deque(maxlen=WAIT_SAMPLES)
+
+    async def acquire(self) -> bool:
+        """take a slot, False when the request should be turned away"""
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            self.admitted += 1
+            self.waits.append(0.0)
+            return True
+        if len(self.waiters) >= self.queue_size:
+            self.rejected += 1
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        self.queued += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except BaseException as exc:
+            if future.done() and not future.cancelled():
+                # the slot was handed over as the wait ended, give it back
+                self.release()
+            else:
+                future.cancel()
+                self.waiters.remove(future)
+            if isinstance(exc, asyncio.TimeoutError):
+                self.timed_out += 1
+                return False
+            raise
+        waited = time.perf_counter() - start
+        self.admitted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.waits.append(waited)
+        return True
+
+    def release(self):
+        # a freed slot goes straight to the oldest waiter, active stays
+        while self.waiters:
+            future = self.waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> dict:
+        waits = sorted(self.waits)
+
+        def percentile(p: float) -> float:
+            return waits[min(len(waits) - 1, int(p * len(waits)))] if waits else 0.0
+
+        return {
+            "limit": self.limit,
+            "queue_size": self.queue_size,
+            "active": self.active,
+            "waiting": len(self.waiters),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_total": self.wait_total,
+            "wait_max": self.wait_max,
+            "wait_p50": percentile(0.5),
+            "wait_p99": percentile(0.99),
+        }
+
+
+read_gate = Gate("read", READ_LIMIT, READ_QUEUE, QUEUE_TIMEOUT)
+# tenant -> its write gate, None for the default database
+write_gates: dict[str | None, Gate] = {}
+
+
+def write_gate(tenant: str | None) -> Gate:
+    gate = write_gates.get(tenant)
+    if gate is None:
+        gate = write_gates[tenant] = Gate(
+            "write", WRITE_LIMIT, WRITE_QUEUE, QUEUE_TIMEOUT
+        )
+    return gate
+
+
+def stats() -> dict:
+    return {
+        "read": read_gate.stats(),
+        "write": {
+            tenant or "default": gate.stats() for tenant, gate in write_gates.items()
+        },
+    }
+
+
+class AdmissionMiddleware:
+    """asgi middleware passing every http request through its gate"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # the route path, /t/north/events is /events once tenancy moved the prefix
+        if scope["type"] != "http" or get_route_path(scope).startswith(EXEMPT_PATHS):
+            await self.app(scope, receive, send)
+            return
+        if scope["method"] in READ_METHODS:
+            gate = read_gate
+        else:
+            gate = write_gate(current_tenant.get())
+        if not await gate.acquire():
+            detail = f"too many {gate.name} requests, retry later"
+            body = json.dumps({"detail": detail}).encode()
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 503,
+                    "headers": [
+                        (b"content-type", b"application/json"),
+                        (b"content-length", str(len(body)).encode()),
+                        (b"retry-after", str(RETRY_AFTER).encode()),
+                    ],
+                }
+            )
+            await send({"type": "http.response.body", "body": body})
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            gate.release()
+
+
+async def database_busy(request: Request, exc: OperationalError):
+    """503 for a write that gave up on the database lock, others re-raise"""
+    if "locked" not in str(exc.orig) and "busy" not in str(exc.orig):
+        raise exc
+    return JSONResponse(
+        {"detail": "the database is busy, retry later"},
+        status_code=503,
+        headers={"Retry-After": str(RETRY_AFTER)},
+    )
@@ -0,0 +1,190 @@
+"""Online backups of the SQLite database.
+
+The copy goes through sqlite3's backup API a few pages per step with a
+pause in between, so requests keep the disk and the CPU. The source
+connection holds one read transaction for the whole copy: in WAL mode that
+pins a point-in-time snapshot, writers carry on into the WAL and the copy
+is neither blocked by them nor restarted by their commits. The WAL cannot
+be checkpointed past the snapshot until the copy is done.
+
+The archive database is copied in the same read transaction, the two
+files of a backup show the same moment and sit side by side under the
+names the app attaches them by. Backups are written next to their final
+name and renamed when complete, only the newest BACKUP_KEEP are kept.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
+from sqlmodel import Session, select
+
+from models.model import (
+    Backup,
+    Job,
+    JobStatus,
+    archive_path,
+    current_tenant,
+    get_engine,
+    tenants,
+)
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR = os.path.abspath(os.getenv("BACKUP_DIR", "backups"))
+BACKUP_PAGES = int(os.getenv("BACKUP_PAGES", "256"))
+BACKUP_SLEEP = float(os.getenv("BACKUP_SLEEP", "0.005"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+# 0 turns the schedule off, backups then only run on request
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "0"))
+
+
+def database_path() -> str:
+    return get_engine().url.database
+
+
+def copy(
+    source_path: str,
+    target_path: str,
+    progress: Callable[[float], None] | None = None,
+    archive_target: str | None = None,
+) -> int:
+    """copy a snapshot of a live database file, returns the pages copied
+
+    With archive_target the source's archive is copied there as well.
+    """
+    pages = 0
+    copied = 0
+    share = 1.0
+    if archive_target:
+        main_size = os.path.getsize(source_path)
+        archive_size = os.path.getsize(archive_path(source_path))
+        share = main_size / (main_size + archive_size or 1)
+
+    def step(status, remaining, total):
+        nonlocal pages
+        pages = copied + total
+        if progress:
+            done = (total - remaining) / total if total else 1
+            progress(done * share if not copied else share + done * (1 - share))
+        # sqlite3 only sleeps between steps on SQLITE_BUSY, the pause that
+        # leaves room for requests is taken here
+        if remaining:
+            time.sleep(BACKUP_SLEEP)
+
+    source = sqlite3.connect(source_path, timeout=30, isolation_level=None)
+    targets = [sqlite3.connect(target_path)]
+    try:
+        if archive_target:
+            source.execute("ATTACH DATABASE ? AS archive", (archive_path(source_path),))
+            targets.append(sqlite3.connect(archive_target))
+        source.execute("BEGIN")
+        # the first read starts the transaction that pins the snapshot, one
+        # per attached database
+        source.execute("SELECT count(*) FROM sqlite_master").fetchone()
+        if archive_target:
+            source.execute("SELECT count(*) FROM archive.sqlite_master").fetchone()
+        source.backup(targets[0], pages=BACKUP_PAGES, progress=step)
+        if archive_target:
+            copied = pages
+            source.backup(targets[1], pages=BACKUP_PAGES, progress=step, name="archive")
+        source.execute("COMMIT")
+    finally:
+        for target in targets:
+            target.close()
+        source.close()
+    return pages
+
+
+def backup(session: Session, progress: Callable[[float], None] | None = None) -> Backup:
+    """snapshot the database and its archive into BACKUP_DIR, prune old ones"""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    source = database_path()
+    stem = os.path.splitext(os.path.basename(source))[0]
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(BACKUP_DIR, f"{stem}-{stamp}.db")
+    archive = archive_path(path) if os.path.exists(archive_path(source)) else None
+    partials = [path + ".partial"]
+    if archive:
+        partials.append(archive + ".partial")
+
+    start = time.perf_counter()
+    try:
+        pages = copy(source, partials[0], progress, archive and partials[1])
+        if archive:
+            os.replace(partials[1], archive)
+        os.replace(partials[0], path)
+    except BaseException:
+        for partial in partials:
+            if os.path.exists(partial):
+                os.remove(partial)
+        raise
+    record = Backup(
+        path=path,
+        bytes=os.path.getsize(path),
+        pages=pages,
+        seconds=time.perf_counter() - start,
+        archive_path=archive,
+        archive_bytes=os.path.getsize(archive) if archive else None,
+    )
+    session.add(record)
+    session.commit()
+    session.refresh(record)
+    prune(session)
+    return record
+
+
+def prune(session: Session, keep: int = BACKUP_KEEP) -> int:
+    """remove all but the newest keep backups, returns how many went"""
+    old = session.exec(select(Backup).order_by(Backup.id.desc()).offset(keep)).all()
+    for record in old:
+        for path in (record.path, record.archive_path):
+            if path and os.path.exists(path):
+                os.remove(path)
+        session.delete(record)
+    session.commit()
+    return len(old)
+
+
+def due(session: Session) -> bool:
+    """whether the schedule wants a backup now"""
+    running = session.exec(
+        select(Job.id).where(
+            Job.kind == "backup",
+            Job.status.in_((JobStatus.queued, JobStatus.running)),
+        )
+    ).first()
+    if running:
+        return False
+    last = session.exec(select(Backup.created_at).order_by(Backup.id.desc())).first()
+    if last is None:
+        return True
+    interval = timedelta(hours=BACKUP_INTERVAL_HOURS)
+    return last.replace(tzinfo=timezone.utc) + interval <= datetime.now(timezone.utc)
+
+
+async def schedule(submit: Callable[[Session], object]):
+    """submit backups every BACKUP_INTERVAL_HOURS from a running app
+
+    The default database and every tenant database are checked on each
+    round, submit runs with current_tenant set to the database it backs up.
+    Every web worker runs the loop, the checks are jittered and skip while
+    another worker's backup is queued or running.
+    """
+    while True:
+        await asyncio.sleep(60 + random.uniform(0, 30))
+        for tenant in (None, *tenants.names()):
+            token = current_tenant.set(tenant)
+            try:
+                with Session(get_engine()) as session:
+                    if due(session):
+                        submit(session)
+            except Exception:
+                logger.exception("scheduling a backup of %s failed", tenant)
+            finally:
+                current_tenant.reset(token)
@@ -0,0 +1,142 @@
+"""Result cache for the read endpoints that aggregate or join.
+
+An entry holds the JSON body of a response together with the change log
+position of every table it was computed from. A hit re-reads those
+positions, one indexed max() per table, and is only served while none of
+them moved, so writes from other workers and from job processes are seen
+on the next request. Commits in this process also drop the entries of the
+tables they touched straight away, a Session listener collects the tables
+the change log recorded during the transaction. Keys carry the tenant,
+shops never see each other's entries.
+
+The cache is bounded by entry count and by the bytes of the stored bodies,
+the least recently used entries go first.
+"""
+
+import os
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Callable, Iterable
+
+from fastapi.responses import Response
+from pydantic import TypeAdapter
+from sqlalchemy import event, func
+from sqlmodel import Session, select
+
+from models.model import ChangeLog, current_tenant
+
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "256"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+
+@lru_cache
+def adapter(model) -> TypeAdapter:
+    return TypeAdapter(model)
+
+
+def watermark(tables: tuple[str, ...], session: Session) -> tuple[int, ...]:
+    """newest change log seq of each table, 0 for a table never written"""
+    columns = [
+        select(func.max(ChangeLog.seq))
+        .where(ChangeLog.table_name == table)
+        .scalar_subquery()
+        for table in tables
+    ]
+    row = session.connection().execute(select(*columns)).one()
+    return tuple(seq or 0 for seq in row)
+
+
+class QueryCache:
+    def __init__(self, size: int = CACHE_SIZE, max_bytes: int = CACHE_MAX_BYTES):
+        self.size = size
+        self.max_bytes = max_bytes
+        # key -> (tables, watermark, body), least recently used first
+        self.entries: OrderedDict[tuple, tuple[tuple, tuple, bytes]] = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def _drop(self, key: tuple):
+        _, _, body = self.entries.pop(key)
+        self.bytes -= len(body)
+
+    def response(
+        self,
+        key: tuple,
+        tables: Iterable[str],
+        compute: Callable[[], Any],
+        session: Session,
+        model: Any,
+    ) -> Response:
+        """cached json body of compute() serialized as model
+
+        compute() only runs on a miss; an HTTPException it raises is not
+        cached. The watermark is read before computing, a write landing in
+        between makes the entry look stale and costs one extra miss.
+        """
+        key = (current_tenant.get(), *key)
+        tables = tuple(sorted(tables))
+        current = watermark(tables, session)
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] == current:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return Response(entry[2], media_type="application/json")
+
+        self.misses += 1
+        if entry is not None:
+            self._drop(key)
+        type_adapter = adapter(model)
+        value = type_adapter.validate_python(compute(), from_attributes=True)
+        body = type_adapter.dump_json(value)
+        if len(body) <= self.max_bytes:
+            self.entries[key] = (tables, current, body)
+            self.bytes += len(body)
+            while len(self.entries) > self.size or self.bytes > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+        return Response(body, media_type="application/json")
+
+    def invalidate(self, tables: Iterable[str], tenant: str | None = None):
+        """drop every entry of a tenant computed from one of tables"""
+        tables = set(tables)
+        stale = [
+            key
+            for key, entry in self.entries.items()
+            if key[0] == tenant and tables & set(entry[0])
+        ]
+        for key in stale:
+            self._drop(key)
+        self.invalidations += len(stale)
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+        }
+
+
+cache = QueryCache()
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_committed(session):
+    tables = session.info.pop("changed_tables", None)
+    if tables:
+        cache.invalidate(tables, current_tenant.get())
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_rolled_back(session):
+    session.info.pop("changed_tables", None)
@@ -0,0 +1,177 @@
+"""Append-only log of every change to the business tables.
+
+Rows land in the ChangeLog table inside the transaction of the write that
+caused them, so a change is logged exactly when it commits. ORM writes are
+picked up by a flush listener on every Session; the bulk statements of the
+controllers log their ids through record(). seq only grows, a consumer
+keeps the last seq it processed and reads on from there. The names of the
+tables a transaction logged are kept in session.info["changed_tables"].
+
+purge() drops the changes every named cursor has acknowledged, the
+newest change of each table stays so latest() does not move back.
+"""
+
+from datetime import datetime, timezone
+from typing import Iterable
+
+from sqlalchemy import delete, event, func, insert, inspect
+from sqlmodel import Session, select
+
+from models.model import ChangeCursor, ChangeLog
+
+# derived and bookkeeping tables stay out of the log
+LOGGED_TABLES = frozenset(
+    {
+        "customer",
+        "sale",
+        "saleitem",
+        "product",
+        "loan",
+        "invoice",
+        "payitem",
+        "purchase",
+        "purchaseitem",
+        "expense",
+    }
+)
+
+
+def record(
+    session: Session,
+    table_name: str,
+    op: str,
+    ids: Iterable[int],
+    columns: Iterable[str] | None = None,
+):
+    """log op on rows of a table, for writes that bypass the orm"""
+    if table_name not in LOGGED_TABLES:
+        return
+    columns = ",".join(sorted(columns)) if columns else None
+    now = datetime.now(timezone.utc)
+    rows = [
+        {
+            "table_name": table_name,
+            "row_id": id,
+            "op": op,
+            "columns": columns,
+            "created_at": now,
+        }
+        for id in ids
+    ]
+    if rows:
+        session.connection().execute(insert(ChangeLog), rows)
+        session.info.setdefault("changed_tables", set()).add(table_name)
+
+
+@event.listens_for(Session, "after_flush")
+def record_flush(session, flush_context):
+    # pending, dirty and deleted still hold what this flush wrote, and
+    # inserted rows already have their ids
+    now = datetime.now(timezone.utc)
+    rows = []
+
+    def add(item, op, columns=None):
+        table_name = item.__tablename__
+        if table_name in LOGGED_TABLES:
+            rows.append(
+                {
+                    "table_name": table_name,
+                    "row_id": item.id,
+                    "op": op,
+                    "columns": columns,
+                    "created_at": now,
+                }
+            )
+
+    for item in session.new:
+        add(item, "insert")
+    for item in session.dirty:
+        state = inspect(item)
+        changed = [
+            attr.key
+            for attr in state.mapper.column_attrs
+            if state.attrs[attr.key].history.has_changes()
+        ]
+        # relationship only changes leave the row itself untouched
+        if changed:
+            add(item, "update", ",".join(sorted(changed)))
+    for item in session.deleted:
+        add(item, "delete")
+    if rows:
+        session.connection().execute(insert(ChangeLog), rows)
+        changed = session.info.setdefault("changed_tables", set())
+        changed.update(row["table_name"] for row in rows)
+
+
+def read(
+    session: Session,
+    after: int = 0,
+    limit: int = 1000,
+    tables: Iterable[str] | None = None,
+) -> list[ChangeLog]:
+    """changes with seq above after, oldest first"""
+    query = select(ChangeLog).where(ChangeLog.seq > after)
+    if tables:
+        query = query.where(ChangeLog.table_name.in_(list(tables)))
+    return session.exec(query.order_by(ChangeLog.seq).limit(limit)).all()
+
+
+def latest(session: Session, table_name: str | None = None) -> int:
+    """seq of the newest change, of one table when given"""
+    query = select(func.max(ChangeLog.seq))
+    if table_name:
+        query = query.where(ChangeLog.table_name == table_name)
+    return session.exec(query).one() or 0
+
+
+def complete(session: Session, after: int, upto: int) -> bool:
+    """whether the log still holds every change with seq in (after, upto]"""
+    count = session.exec(
+        select(func.count())
+        .select_from(ChangeLog)
+        .where(ChangeLog.seq > after, ChangeLog.seq <= upto)
+    ).one()
+    return count == upto - after
+
+
+def purge(session: Session) -> int:
+    """delete the changes at or below the lowest cursor, nothing without cursors
+
+    A consumer reading without a cursor may find the changes it missed
+    gone, complete() tells it so.
+    """
+    cutoff = session.exec(select(func.min(ChangeCursor.seq))).one()
+    if not cutoff:
+        return 0
+    newest = select(func.max(ChangeLog.seq)).group_by(ChangeLog.table_name)
+    deleted = session.exec(
+        delete(ChangeLog).where(ChangeLog.seq <= cutoff, ChangeLog.seq.not_in(newest))
+    )
+    session.commit()
+    return deleted.rowcount
+
+
+class ChangeReader:
+    """named consumer of the log that resumes where it left off
+
+    poll() hands out the next changes, ack() stores the position once they
+    are processed. A consumer that dies before ack() sees them again.
+    """
+
+    def __init__(self, name: str, tables: Iterable[str] | None = None):
+        self.name = name
+        self.tables = list(tables) if tables else None
+
+    def position(self, session: Session) -> int:
+        cursor = session.get(ChangeCursor, self.name)
+        return cursor.seq if cursor else 0
+
+    def poll(self, session: Session, limit: int = 1000) -> list[ChangeLog]:
+        return read(session, self.position(session), limit, self.tables)
+
+    def ack(self, session: Session, seq: int):
+        cursor = session.get(ChangeCursor, self.name) or ChangeCursor(name=self.name)
+        cursor.seq = max(cursor.seq, seq)
+        cursor.updated_at = datetime.now(timezone.utc)
+        session.add(cursor)
+        session.commit()
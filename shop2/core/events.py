@@ -0,0 +1,141 @@
+"""In-process publish/subscribe for live sales and stock updates.
+
+Write handlers publish small events after they commit, the /events endpoint
+streams them to dashboards and tills as Server-Sent Events. Each subscriber
+has a bounded buffer, a consumer that falls behind is dropped instead of
+making the buffer grow. The bus lives in one worker process, a client sees
+the events of the worker its stream is connected to, and only those of
+its own tenant. A sync batch commits once at its end, the events of its
+operations are held back until then and dropped if it rolls back.
+"""
+
+import asyncio
+import json
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Iterable
+
+from models.model import current_tenant
+
+EVENT_BUFFER = int(os.getenv("EVENT_BUFFER", "256"))
+HEARTBEAT_SECONDS = 15
+
+TOPICS = ("sales", "invoices", "payments", "stock", "products")
+
+# events published inside deferred(), they wait for the transaction to commit
+_deferred: ContextVar[list | None] = ContextVar("deferred_events", default=None)
+
+
+class Subscriber:
+    def __init__(self, topics: Iterable[str], maxsize: int):
+        self.topics = frozenset(topics)
+        self.tenant = current_tenant.get()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.dropped = False
+
+    def wants(self, topic: str, tenant: str | None) -> bool:
+        return tenant == self.tenant and (not self.topics or topic in self.topics)
+
+
+class EventBus:
+    def __init__(self, buffer_size: int = EVENT_BUFFER):
+        self.buffer_size = buffer_size
+        self.subscribers: set[Subscriber] = set()
+        self.published = 0
+        self.dropped = 0
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def subscribe(self, topics: Iterable[str] = ()) -> Subscriber:
+        self._loop = asyncio.get_running_loop()
+        subscriber = Subscriber(topics, self.buffer_size)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    def publish(self, topic: str, data: dict[str, Any]):
+        """queue an event for every subscriber of topic, never blocks
+
+        Safe to call from worker threads, delivery then hops onto the loop
+        the subscribers are served from.
+        """
+        held = _deferred.get()
+        if held is not None:
+            held.append((topic, data))
+            return
+        if not self.subscribers or self._loop is None:
+            return
+        tenant = current_tenant.get()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._deliver(topic, data, tenant)
+        else:
+            self._loop.call_soon_threadsafe(self._deliver, topic, data, tenant)
+
+    @contextmanager
+    def deferred(self):
+        """hold back the events published in the block until it ends
+
+        They are published when the block ends normally and dropped when it
+        raises, end the block right after the commit.
+        """
+        events: list[tuple[str, dict[str, Any]]] = []
+        token = _deferred.set(events)
+        try:
+            yield
+        finally:
+            _deferred.reset(token)
+        for topic, data in events:
+            self.publish(topic, data)
+
+    def _deliver(self, topic: str, data: dict[str, Any], tenant: str | None):
+        self.published += 1
+        event = (topic, data)
+        for subscriber in list(self.subscribers):
+            if not subscriber.wants(topic, tenant):
+                continue
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # a slow consumer loses its stream, not the process its memory
+                self.dropped += 1
+                subscriber.dropped = True
+                self.unsubscribe(subscriber)
+                while not subscriber.queue.empty():
+                    subscriber.queue.get_nowait()
+                subscriber.queue.put_nowait(None)
+
+    async def stream(self, subscriber: Subscriber) -> AsyncIterator[str]:
+        """server-sent events for a subscriber until it is dropped"""
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        subscriber.queue.get(), HEARTBEAT_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event is None:
+                    yield "event: dropped\ndata: {}\n\n"
+                    return
+                topic, data = event
+                yield f"event: {topic}\ndata: {json.dumps(data, default=str)}\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "dropped": self.dropped,
+        }
+
+
+bus = EventBus()
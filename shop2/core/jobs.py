@@ -0,0 +1,290 @@
+"""Background jobs for work that is too slow to run inside a request.
+
+A job is a row in the Job table and a function registered for its kind
+with @job. Submitting stores the row and hands the function to a thread
+pool, or to a process pool when it was registered with cpu=True. From
+then on the worker owns the row: it marks the job running, reports
+progress into it and records the result file when it finishes. Clients
+poll the row, so every web worker can answer for every job. There is no
+broker, SQLite is the only shared state.
+
+A job runs against the database of the tenant that submitted it.
+
+Cancelling a queued job stops it from starting. A running job is asked to
+stop, and it does so at its next progress report.
+"""
+
+import inspect
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable
+
+from sqlmodel import Session, select, update
+
+from models.model import Job, JobStatus, current_tenant, get_engine
+
+JOB_THREADS = int(os.getenv("JOB_THREADS", "4"))
+JOB_PROCESSES = int(os.getenv("JOB_PROCESSES", "2"))
+# jobs a web worker accepts before refusing new ones, running ones included
+JOB_QUEUE_LIMIT = int(os.getenv("JOB_QUEUE_LIMIT", "32"))
+JOB_DIR = os.path.abspath(os.getenv("JOB_DIR", "jobs"))
+PROGRESS_INTERVAL = 0.5
+
+UNFINISHED = (JobStatus.queued, JobStatus.running, JobStatus.cancelling)
+
+# kind -> (function, runs in the process pool)
+JOB_KINDS: dict[str, tuple[Callable, bool]] = {}
+# kind -> checks of its params beyond the signature
+JOB_CHECKS: dict[str, Callable] = {}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+def job(kind: str, cpu: bool = False, check: Callable | None = None):
+    """register fn(ctx, session, **params) as the function of a job kind
+
+    The return value becomes the message of the finished job. Functions of
+    cpu jobs are pickled by reference, they have to be module level.
+    check(**params) runs at submit and raises ValueError for bad values.
+    """
+
+    def register(fn):
+        JOB_KINDS[kind] = (fn, cpu)
+        if check:
+            JOB_CHECKS[kind] = check
+        return fn
+
+    return register
+
+
+def now():
+    return datetime.now(timezone.utc)
+
+
+class JobContext:
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+        self.result_path: str | None = None
+        self.media_type: str | None = None
+        self._reported = 0.0
+
+    def progress(self, fraction: float, message: str | None = None):
+        """record progress, raises JobCancelled once a cancel was requested
+
+        Writes go through their own short transaction, call it between the
+        job's own write transactions, not inside one.
+        """
+        reported = time.monotonic()
+        if reported - self._reported < PROGRESS_INTERVAL:
+            return
+        self._reported = reported
+        with Session(get_engine()) as session:
+            # only a running job takes progress, a cancelling one matches no row
+            result = session.exec(
+                update(Job)
+                .where(Job.id == self.job_id, Job.status == JobStatus.running)
+                .values(progress=min(fraction, 1), message=message, updated_at=now())
+            )
+            session.commit()
+        if not result.rowcount:
+            raise JobCancelled()
+
+    def output(self, filename: str, media_type: str) -> str:
+        """path the job writes its downloadable result to"""
+        os.makedirs(JOB_DIR, exist_ok=True)
+        # job ids are per database, the tenant keeps the files apart
+        tenant = current_tenant.get()
+        prefix = f"{tenant}-{self.job_id}" if tenant else str(self.job_id)
+        self.result_path = os.path.join(JOB_DIR, f"{prefix}-{filename}")
+        self.media_type = media_type
+        return self.result_path
+
+
+def worker_alive(pid: int | None) -> bool:
+    if pid is None or pid == os.getpid():
+        # our own pid at startup belonged to an earlier run
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def finish(job_id: int, status: JobStatus, **values):
+    with Session(get_engine()) as session:
+        session.exec(
+            update(Job)
+            .where(Job.id == job_id)
+            .values(status=status, finished_at=now(), updated_at=now(), **values)
+        )
+        session.commit()
+
+
+def run_job(
+    fn: Callable, job_id: int, params: dict[str, Any], tenant: str | None = None
+):
+    """body of a job inside a pool worker, thread or process"""
+    token = current_tenant.set(tenant)
+    try:
+        _run_job(fn, job_id, params)
+    finally:
+        current_tenant.reset(token)
+
+
+def _run_job(fn: Callable, job_id: int, params: dict[str, Any]):
+    with Session(get_engine()) as session:
+        started = session.exec(
+            update(Job)
+            .where(Job.id == job_id, Job.status == JobStatus.queued)
+            .values(status=JobStatus.running, updated_at=now())
+        )
+        session.commit()
+        if not started.rowcount:
+            # cancelled while it was queued
+            return
+        ctx = JobContext(job_id)
+        try:
+            message = fn(ctx, session, **params)
+        except BaseException as exc:
+            session.rollback()
+            if ctx.result_path and os.path.exists(ctx.result_path):
+                os.remove(ctx.result_path)
+            if isinstance(exc, JobCancelled):
+                finish(job_id, JobStatus.cancelled, message="cancelled")
+            else:
+                finish(job_id, JobStatus.failed, message=f"{type(exc).__name__}: {exc}")
+            if not isinstance(exc, Exception):
+                raise
+            return
+    finish(
+        job_id,
+        JobStatus.done,
+        progress=1,
+        message=None if message is None else str(message),
+        result_path=ctx.result_path,
+        media_type=ctx.media_type,
+    )
+
+
+class JobRunner:
+    def __init__(
+        self,
+        threads: int = JOB_THREADS,
+        processes: int = JOB_PROCESSES,
+        queue_limit: int = JOB_QUEUE_LIMIT,
+    ):
+        self.threads = threads
+        self.processes = processes
+        self.queue_limit = queue_limit
+        self._pools: dict[bool, Executor] = {}
+        self._futures: dict[tuple[str | None, int], Future] = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, cpu: bool) -> Executor:
+        # pools start on first use, a worker that never runs a job pays nothing
+        pool = self._pools.get(cpu)
+        if pool is None:
+            if cpu:
+                context = multiprocessing.get_context("spawn")
+                pool = ProcessPoolExecutor(self.processes, mp_context=context)
+            else:
+                pool = ThreadPoolExecutor(self.threads, thread_name_prefix="job")
+            self._pools[cpu] = pool
+        return pool
+
+    def submit(self, kind: str, params: dict[str, Any], session: Session) -> Job:
+        """store a job and queue it, KeyError for bad kinds, TypeError or
+        ValueError for bad params"""
+        fn, cpu = JOB_KINDS[kind]
+        inspect.signature(fn).bind(None, None, **params)
+        if kind in JOB_CHECKS:
+            JOB_CHECKS[kind](**params)
+        with self._lock:
+            if len(self._futures) >= self.queue_limit:
+                raise JobQueueFull(f"{len(self._futures)} jobs are already queued")
+            job = Job(kind=kind, params=json.dumps(params), worker=os.getpid())
+            session.add(job)
+            session.commit()
+            session.refresh(job)
+            # job ids repeat across tenant databases
+            key = (current_tenant.get(), job.id)
+            future = self._pool(cpu).submit(run_job, fn, job.id, params, key[0])
+            self._futures[key] = future
+        future.add_done_callback(lambda _, key=key: self._futures.pop(key, None))
+        return job
+
+    def cancel(self, id: int, session: Session) -> Job | None:
+        job = session.get(Job, id)
+        if not job or job.status not in UNFINISHED:
+            return job
+        session.exec(
+            update(Job)
+            .where(Job.id == id, Job.status == JobStatus.queued)
+            .values(
+                status=JobStatus.cancelled,
+                message="cancelled",
+                finished_at=now(),
+                updated_at=now(),
+            )
+        )
+        session.exec(
+            update(Job)
+            .where(Job.id == id, Job.status == JobStatus.running)
+            .values(status=JobStatus.cancelling, updated_at=now())
+        )
+        session.commit()
+        future = self._futures.get((current_tenant.get(), id))
+        if future:
+            future.cancel()
+        session.refresh(job)
+        return job
+
+    def recover(self, session: Session) -> int:
+        """fail jobs whose web worker is gone, returns how many
+
+        Runs when a worker starts. Jobs of the workers still alive are left
+        alone, they are running or queued there.
+        """
+        workers = session.exec(
+            select(Job.worker).where(Job.status.in_(UNFINISHED)).distinct()
+        ).all()
+        gone = [worker for worker in workers if not worker_alive(worker)]
+        if not gone:
+            return 0
+        result = session.exec(
+            update(Job)
+            .where(Job.status.in_(UNFINISHED), Job.worker.in_(gone))
+            .values(
+                status=JobStatus.failed,
+                message="interrupted by a restart",
+                finished_at=now(),
+                updated_at=now(),
+            )
+        )
+        session.commit()
+        return result.rowcount
+
+    def stats(self) -> dict[str, int]:
+        return {"queued_or_running": len(self._futures), "limit": self.queue_limit}
+
+    def shutdown(self):
+        for pool in self._pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        self._pools.clear()
+
+
+runner = JobRunner()
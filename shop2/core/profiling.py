@@ -0,0 +1,162 @@
+"""On-demand profiles of single requests.
+
+A request is profiled when it is picked by PROFILE_SAMPLE_RATE, or when it
+carries the X-Profile header with the PROFILE_TOKEN value. Its profile is a
+cProfile of the handler plus every SQL statement it ran with its time, the
+newest PROFILE_KEEP profiles are kept in memory.
+
+With neither a sample rate nor a token configured the middleware is not
+installed and no SQL listener is registered, requests run as if the module
+did not exist.
+
+cProfile sees the whole event loop thread, so a profile also holds the
+work of requests interleaved with it at await points. Only one request is
+profiled at a time.
+"""
+
+import cProfile
+import io
+import itertools
+import marshal
+import os
+import pstats
+import random
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models.model import ProfileDetail, ProfilePub, ProfileQuery
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+# functions listed in a profile's report
+PROFILE_FUNCTIONS = 40
+
+PROFILE_HEADER = b"x-profile"
+
+# statements of the request being profiled, None outside of one
+_statements: ContextVar[list | None] = ContextVar("profile_statements", default=None)
+
+
+class Profile:
+    def __init__(self, id: int, method: str, path: str):
+        self.id = id
+        self.created_at = datetime.now(timezone.utc)
+        self.method = method
+        self.path = path
+        self.status: int | None = None
+        self.seconds = 0.0
+        self.statements: list[tuple[str, float]] = []
+        self.stats: dict = {}
+
+    def pub(self) -> ProfilePub:
+        return ProfilePub(
+            id=self.id,
+            created_at=self.created_at,
+            method=self.method,
+            path=self.path,
+            status=self.status,
+            seconds=self.seconds,
+            queries=len(self.statements),
+            sql_seconds=sum(seconds for _, seconds in self.statements),
+        )
+
+    def detail(self) -> ProfileDetail:
+        report = io.StringIO()
+        stats = pstats.Stats(self, stream=report)
+        # pstats takes the dict over from the object it loads, hand it back
+        self.stats = stats.stats
+        stats.sort_stats("cumulative").print_stats(PROFILE_FUNCTIONS)
+        return ProfileDetail(
+            **self.pub().model_dump(),
+            sql=[
+                ProfileQuery(statement=statement, seconds=seconds)
+                for statement, seconds in self.statements
+            ],
+            functions=report.getvalue(),
+        )
+
+    def create_stats(self):
+        # pstats.Stats reads the collected stats through this method
+        pass
+
+    def dump(self) -> bytes:
+        """the stats in the format of pstats.dump_stats, for snakeviz and co"""
+        return marshal.dumps(self.stats)
+
+
+profiles: deque[Profile] = deque(maxlen=PROFILE_KEEP)
+_ids = itertools.count(1)
+_running = False
+
+
+def enabled() -> bool:
+    return PROFILE_SAMPLE_RATE > 0 or bool(PROFILE_TOKEN)
+
+
+def get(id: int) -> Profile | None:
+    return next((profile for profile in profiles if profile.id == id), None)
+
+
+def before_execute(conn, cursor, statement, parameters, context, executemany):
+    if _statements.get() is not None:
+        conn.info.setdefault("profile_start", []).append(time.perf_counter())
+
+
+def after_execute(conn, cursor, statement, parameters, context, executemany):
+    statements = _statements.get()
+    if statements is not None:
+        start = conn.info["profile_start"].pop()
+        statements.append((statement, time.perf_counter() - start))
+
+
+def wanted(scope) -> bool:
+    if PROFILE_TOKEN:
+        for name, value in scope["headers"]:
+            if name == PROFILE_HEADER:
+                return value.decode() == PROFILE_TOKEN
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+class ProfilingMiddleware:
+    """asgi middleware profiling the requests picked by wanted()"""
+
+    def __init__(self, app):
+        self.app = app
+        if not event.contains(Engine, "before_cursor_execute", before_execute):
+            event.listen(Engine, "before_cursor_execute", before_execute)
+            event.listen(Engine, "after_cursor_execute", after_execute)
+
+    async def __call__(self, scope, receive, send):
+        global _running
+        if scope["type"] != "http" or _running or not wanted(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile = Profile(next(_ids), scope["method"], scope["path"])
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+            await send(message)
+
+        _running = True
+        token = _statements.set(profile.statements)
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            profiler.disable()
+            profile.seconds = time.perf_counter() - start
+            _statements.reset(token)
+            _running = False
+            profiler.create_stats()
+            profile.stats = profiler.stats
+            profiles.append(profile)
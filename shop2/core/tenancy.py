@@ -0,0 +1,74 @@
+"""Routing of requests to the database of their shop.
+
+A request names its tenant with the X-Tenant header or a /t/<tenant> path
+prefix, /t/north/sales is /sales of the north shop. Everything below the
+middleware, handlers, jobs they submit and commits they make, then runs
+against that tenant's database through get_engine(). Requests without a
+tenant are served from the default database, a single shop deployment
+does not change.
+"""
+
+import json
+
+from starlette._utils import get_route_path
+
+from models.model import UnknownTenant, current_tenant, tenants
+
+TENANT_HEADER = b"x-tenant"
+TENANT_PREFIX = "/t/"
+
+
+def resolve(scope) -> tuple[str | None, dict]:
+    """tenant of a request and the scope its routes are matched with"""
+    tenant = None
+    for name, value in scope["headers"]:
+        if name == TENANT_HEADER:
+            tenant = value.decode()
+            break
+    path = get_route_path(scope)
+    if path.startswith(TENANT_PREFIX):
+        prefixed = path[len(TENANT_PREFIX) :].split("/", 1)[0]
+        if tenant is not None and tenant != prefixed:
+            raise ValueError(f"header tenant {tenant} and path tenant {prefixed}")
+        tenant = prefixed
+        # like a mount, the prefix moves to root_path and routing skips it
+        root_path = scope.get("root_path", "") + TENANT_PREFIX + tenant
+        scope = {**scope, "root_path": root_path}
+    return tenant, scope
+
+
+class TenancyMiddleware:
+    """asgi middleware setting current_tenant for the request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        try:
+            tenant, scope = resolve(scope)
+            if tenant is not None and not tenants.exists(tenant):
+                raise UnknownTenant(tenant)
+        except (UnknownTenant, ValueError) as exc:
+            status = 404 if isinstance(exc, UnknownTenant) else 400
+            detail = f"unknown tenant {exc}" if status == 404 else str(exc)
+            body = json.dumps({"detail": detail}).encode()
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": status,
+                    "headers": [
+                        (b"content-type", b"application/json"),
+                        (b"content-length", str(len(body)).encode()),
+                    ],
+                }
+            )
+            await send({"type": "http.response.body", "body": body})
+            return
+        token = current_tenant.set(tenant)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_tenant.reset(token)
@@ -0,0 +1,128 @@
+"""Call counts and latencies of the controller methods.
+
+BaseControler wraps the public classmethods of every controller with
+timed(). A call adds to the totals of its (endpoint, controller, method)
+key, the endpoint is the route template of the request being served, None
+for calls from jobs and scripts. Times are inclusive, a method calling
+another controller method counts that call in both.
+
+rows is the number of models a method returned: the length of a list, one
+for a single model.
+"""
+
+import functools
+import threading
+import time
+from contextvars import ContextVar
+
+from sqlmodel import SQLModel
+
+from models.model import ControlerTiming
+
+# asgi scope of the request being served, routing adds the route to it
+_scope: ContextVar[dict | None] = ContextVar("timing_scope", default=None)
+
+# (endpoint, controler, method) -> [calls, total, max, rows]
+_totals: dict[tuple, list] = {}
+# job threads run controllers too, the totals are only touched under the lock
+_lock = threading.Lock()
+# (controler, method) pairs running in the current thread
+_running = threading.local()
+
+
+def endpoint() -> str | None:
+    scope = _scope.get()
+    route = scope.get("route") if scope else None
+    return f"{scope['method']} {route.path}" if route else None
+
+
+def count_rows(result) -> int:
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    return 1 if isinstance(result, SQLModel) else 0
+
+
+def timed(name: str, func):
+    """wrap the function of a classmethod, stats go under the calling class"""
+
+    @functools.wraps(func)
+    def wrapper(cls, *args, **kwargs):
+        running = _running.__dict__.setdefault("methods", set())
+        method = (cls.__name__, name)
+        if method in running:
+            # an override calling super() is one call of the method
+            return func(cls, *args, **kwargs)
+        running.add(method)
+        start = time.perf_counter()
+        try:
+            result = func(cls, *args, **kwargs)
+        finally:
+            running.discard(method)
+        elapsed = time.perf_counter() - start
+        key = (endpoint(), *method)
+        rows = count_rows(result)
+        with _lock:
+            totals = _totals.get(key)
+            if totals is None:
+                totals = _totals[key] = [0, 0.0, 0.0, 0]
+            totals[0] += 1
+            totals[1] += elapsed
+            if elapsed > totals[2]:
+                totals[2] = elapsed
+            totals[3] += rows
+        return result
+
+    wrapper.timed = True
+    return wrapper
+
+
+def instrument(cls):
+    """time the public classmethods defined on cls itself"""
+    for name, attr in list(vars(cls).items()):
+        if name.startswith("_") or not isinstance(attr, classmethod):
+            continue
+        if not getattr(attr.__func__, "timed", False):
+            setattr(cls, name, classmethod(timed(name, attr.__func__)))
+
+
+def stats() -> list[ControlerTiming]:
+    """totals per endpoint, the most expensive methods first"""
+    with _lock:
+        snapshot = [(key, tuple(totals)) for key, totals in _totals.items()]
+    rows = [
+        ControlerTiming(
+            endpoint=endpoint,
+            controler=controler,
+            method=method,
+            calls=calls,
+            total_seconds=total,
+            max_seconds=longest,
+            mean_seconds=total / calls,
+            rows=rows,
+        )
+        for (endpoint, controler, method), (calls, total, longest, rows) in snapshot
+    ]
+    rows.sort(key=lambda row: (row.endpoint or "", -row.total_seconds))
+    return rows
+
+
+def reset():
+    with _lock:
+        _totals.clear()
+
+
+class TimingMiddleware:
+    """asgi middleware that lets controller calls see their endpoint"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = _scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _scope.reset(token)
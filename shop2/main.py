@@ -1,18 +1,49 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import (
+    FastAPI,
+    APIRouter,
+    Body,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    status,
+)
 from sqlmodel import Session, select
 from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
 from fastapi.middleware.cors import CORSMiddleware
-from datetime import datetime, timezone
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from datetime import date, datetime, timedelta, timezone
+import hashlib
+from typing import Any, Literal
+from pydantic import ValidationError
+import os
 
 
 from models.model import *
 from controlers.controler import *
+from controlers.reports import ReportControler
+from controlers.valuation import ValuationControler
+from controlers.inventory import InventoryControler
+from controlers.forecast import ForecastControler
+from controlers.charts import ChartControler
+from controlers.sync import SyncControler
+from controlers.archive import ArchiveControler
+from controlers.analytics import AnalyticsControler
+from controlers import tasks  # registers the job kinds
+from core import admission, backup, changelog, profiling, tenancy, timing
+from core.cache import cache
+from core.events import TOPICS, bus
+from core.jobs import JOB_KINDS, JobQueueFull, runner
 from models.model import AdminPub, User
+
 # from models.model import
 
 
 def get_session():
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         yield session
 
 
@@ -24,26 +55,153 @@ def create_sale(session: Session):
     return sale
 
 
-create_db_and_tables()
+def publish_stock(product_ids, session: Session):
+    """publish the committed stock of products, skipped when nobody listens"""
+    if not bus.subscribers:
+        return
+    for product in ProductControler.get_many(set(product_ids), session):
+        bus.publish("stock", {"product_id": product.id, "stock": product.stock})
 
-app = FastAPI()
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Allows all origins
-    allow_credentials=False,
-    allow_methods=["*"],  # Allows all methods (GET, POST, PUT, DELETE, etc.)
-    allow_headers=["*"],  # Allows all headers
-)
+def recover_jobs(tenant: str, engine):
+    with Session(engine) as session:
+        runner.recover(session)
+
 
+def job_pub(job: Job) -> JobPub:
+    return JobPub.model_validate(job, update={"has_result": bool(job.result_path)})
 
-@app.post("/admin/", response_model=AdminPub)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the schema check is a single catalog query once the tables exist
+    create_db_and_tables()
+    with Session(get_engine()) as session:
+        runner.recover(session)
+    tenants.on_open.append(recover_jobs)
+    scheduled = None
+    if backup.BACKUP_INTERVAL_HOURS > 0:
+        scheduled = asyncio.create_task(
+            backup.schedule(lambda session: runner.submit("backup", {}, session))
+        )
+    yield
+    if scheduled:
+        scheduled.cancel()
+    tenants.on_open.remove(recover_jobs)
+    runner.shutdown()
+    ChartControler.shutdown()
+    tenants.dispose()
+    get_engine().dispose()
+
+
+router = APIRouter()
+
+
+def create_app() -> FastAPI:
+    app = FastAPI(lifespan=lifespan)
+
+    app.add_middleware(timing.TimingMiddleware)
+    if profiling.enabled():
+        # inside admission control, time spent queued is not profiled
+        app.add_middleware(profiling.ProfilingMiddleware)
+    # added before CORS so that rejected requests still get its headers
+    app.add_middleware(admission.AdmissionMiddleware)
+    # outside admission control, writes queue at the gate of their tenant
+    app.add_middleware(tenancy.TenancyMiddleware)
+    app.add_exception_handler(OperationalError, admission.database_busy)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # Allows all origins
+        allow_credentials=False,
+        allow_methods=["*"],  # Allows all methods (GET, POST, PUT, DELETE, etc.)
+        allow_headers=["*"],  # Allows all headers
+    )
+    app.include_router(router)
+    return app
+
+
+def __getattr__(name: str):
+    # `main:app` is built on first access so importing this module stays cheap
+    if name == "app":
+        app = create_app()
+        globals()["app"] = app
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@router.post("/admin/", response_model=AdminPub)
 async def add_admin(user: User, session: Session = Depends(get_session)):
     user = AdminControler.save(user, session)
     return user
 
 
-@app.get("/admin/{id}/", response_model=AdminPub)
+@router.post(
+    "/admin/backup", response_model=JobPub, status_code=status.HTTP_202_ACCEPTED
+)
+async def start_backup(session: Session = Depends(get_session)):
+    try:
+        job = runner.submit("backup", {}, session)
+    except JobQueueFull as exc:
+        raise HTTPException(
+            status.HTTP_503_SERVICE_UNAVAILABLE, str(exc), {"Retry-After": "30"}
+        )
+    return job_pub(job)
+
+
+@router.get("/admin/backups", response_model=list[Backup])
+async def get_backups(session: Session = Depends(get_session)):
+    return session.exec(select(Backup).order_by(Backup.id.desc())).all()
+
+
+@router.get("/admin/profiles", response_model=list[ProfilePub])
+async def get_profiles():
+    return [profile.pub() for profile in reversed(profiling.profiles)]
+
+
+@router.get("/admin/profiles/{id}", response_model=ProfileDetail)
+async def get_profile(id: int):
+    profile = profiling.get(id)
+    if not profile:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND, f"profile with id {id} was not found"
+        )
+    return profile.detail()
+
+
+@router.get("/admin/profiles/{id}/download")
+async def download_profile(id: int):
+    profile = profiling.get(id)
+    if not profile:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND, f"profile with id {id} was not found"
+        )
+    return Response(
+        profile.dump(),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="profile-{id}.prof"'},
+    )
+
+
+@router.get("/admin/controlers", response_model=list[ControlerTiming])
+async def get_controler_timings(endpoint: str | None = None):
+    timings = timing.stats()
+    if endpoint:
+        timings = [row for row in timings if row.endpoint == endpoint]
+    return timings
+
+
+@router.delete("/admin/controlers")
+async def reset_controler_timings():
+    timing.reset()
+    return "successful"
+
+
+@router.get("/admin/tenants")
+async def get_tenants():
+    return tenants.stats()
+
+
+@router.get("/admin/{id}/", response_model=AdminPub)
 async def get_admin(id: int, session: Session = Depends(get_session)):
     user = AdminControler.get_one(id, session)
     if user:
@@ -51,7 +209,7 @@ async def get_admin(id: int, session: Session = Depends(get_session)):
     raise HTTPException(status.HTTP_404_NOT_FOUND, "user with such id was not found")
 
 
-@app.get("/admin/", response_model=list[AdminPub])
+@router.get("/admin/", response_model=list[AdminPub])
 async def get_admins(
     offset: int = 0, limit: int = 2, session: Session = Depends(get_session)
 ):
@@ -61,7 +219,7 @@ async def get_admins(
     raise HTTPException(status.HTTP_404_NOT_FOUND, "there is no admin found")
 
 
-@app.delete("/admin/{id}/")
+@router.delete("/admin/{id}/")
 async def delete_admin(id: int, session: Session = Depends(get_session)):
     message = AdminControler.delete(id, session)
     if message:
@@ -69,13 +227,27 @@ async def delete_admin(id: int, session: Session = Depends(get_session)):
     return "admin was not deleted"
 
 
-@app.post("/customer/")
+@router.get("/customer/bulk/", response_model=list[CustomerPub])
+async def get_customers_bulk(
+    ids: list[int] = Query(), session: Session = Depends(get_session)
+):
+    return CustomerControler.get_many(ids, session)
+
+
+@router.post("/customer/bulk/", response_model=list[CustomerPub])
+async def add_customers_bulk(
+    users: list[User], session: Session = Depends(get_session)
+):
+    return CustomerControler.save_many(users, session)
+
+
+@router.post("/customer/")
 async def add_customer(user: User, session: Session = Depends(get_session)):
     user = CustomerControler.save(user, session)
     return user
 
 
-@app.get("/customer/{id}/")
+@router.get("/customer/{id}/")
 async def get_customer(id: int, session: Session = Depends(get_session)):
     customer = CustomerControler.get_one(id, session)
     if customer:
@@ -85,7 +257,7 @@ async def get_customer(id: int, session: Session = Depends(get_session)):
     )
 
 
-@app.get("/customer/", response_model=list[CustomerPub])
+@router.get("/customer/", response_model=list[CustomerPub])
 async def get_customers(
     offset: int = 0, limit: int = 30, session: Session = Depends(get_session)
 ):
@@ -95,7 +267,7 @@ async def get_customers(
     raise HTTPException(status.HTTP_404_NOT_FOUND, "customers were not found")
 
 
-@app.delete("/customer/{id}/")
+@router.delete("/customer/{id}/")
 async def delete_customer(id: int, session: Session = Depends(get_session)):
     message = CustomerControler.delete(id, session)
     if message:
@@ -103,7 +275,7 @@ async def delete_customer(id: int, session: Session = Depends(get_session)):
     return "customer was not deleted"
 
 
-@app.post("/customer/{id}/loan/", response_model=LoanPub)
+@router.post("/customer/{id}/loan/", response_model=LoanPub)
 async def add_loan(id: int, session: Session = Depends(get_session)):
     customer = CustomerControler.get_one(id, session)
     if not customer:
@@ -121,18 +293,23 @@ async def add_loan(id: int, session: Session = Depends(get_session)):
     return loan2
 
 
-@app.get("/customer/{id}/loan", response_model=LoanPub)
+@router.get("/customer/{id}/loan", response_model=LoanPub)
 async def get_customer_loan(id: int, session: Session = Depends(get_session)):
-    customer = CustomerControler.get_one(id, session)
-    if customer:
-        return customer.loan
-    raise HTTPException(
-        status.HTTP_404_NOT_FOUND, f"no customer with id {id} was not found"
+    def compute():
+        customer = CustomerControler.get_one(id, session)
+        if customer:
+            return customer.loan
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND, f"no customer with id {id} was not found"
+        )
+
+    return cache.response(
+        ("customer_loan", id), ("customer", "loan"), compute, session, LoanPub
     )
 
 
 # endpoints for Invoices
-@app.post("/invoices/", response_model=InvoicePub)
+@router.post("/invoices/", response_model=InvoicePub)
 async def add_invoice(data: InvoiceInputData, session: Session = Depends(get_session)):
     # loan_id = data.customer_id
     customer = CustomerControler.get_one(data.customer_id, session)
@@ -159,12 +336,24 @@ async def add_invoice(data: InvoiceInputData, session: Session = Depends(get_ses
             raise HTTPException(
                 status.HTTP_404_NOT_FOUND, "some products were not found"
             )
-        cogs += product.buying_price * item.quantity
+        # an invoice sells on credit, the goods leave the shop all the same
+        if product.stock > item.quantity:
+            product.stock = product.stock - item.quantity
+        else:
+            raise HTTPException(
+                status.HTTP_406_NOT_ACCEPTABLE,
+                "you can not perform this opperation cause you have low stock",
+            )
+        cost = ValuationControler.consume(product, item.quantity, session)
+        itemin.capture(product)
+        itemin.unit_cost = cost / item.quantity if item.quantity else 0
+        cogs += cost
         itemin.sale = sale
         salesitems.append(itemin)
         invoice_amount += item.amount * item.quantity
     sale.revenue += invoice_amount
     sale.cost_of_goods += cogs
+    sale.updated_at = datetime.now(timezone.utc)
     loan = customer.loan
 
     if not loan:
@@ -181,24 +370,41 @@ async def add_invoice(data: InvoiceInputData, session: Session = Depends(get_ses
     invoicein = Invoice(loan=loan, salesitems=salesitems)
     invoicein.invoice_amount = invoice_amount
     invoice = InvoiceControler.save(invoicein, session)
+    bus.publish(
+        "invoices",
+        {
+            "invoice_id": invoice.id,
+            "customer_id": customer.id,
+            "invoice_amount": invoice.invoice_amount,
+        },
+    )
+    bus.publish("sales", {"sale_id": sale.id, "revenue": sale.revenue})
+    publish_stock([item.product_id for item in data.salesitems], session)
     return invoice
 
 
-@app.get("/invoices/{id}", response_model=InvoicePub)
+@router.get("/invoices/{id}", response_model=InvoicePub)
 async def get_invoice(id: int, session: Session = Depends(get_session)):
     invoices = InvoiceControler.get_one(id, session)
+    if not invoices:
+        invoices = ArchiveControler.get_invoice(id, session)
     return invoices
 
 
-@app.get("/invoices/")
+@router.get("/invoices/")
 async def get_invoices(
     offset: int, limit: int, session: Session = Depends(get_session)
 ):
-    invoice = InvoiceControler.get_all(offset=offset, limit=limit, session=session)
-    return invoice
+    return cache.response(
+        ("invoices", offset, limit),
+        ("invoice",),
+        lambda: InvoiceControler.get_all(offset=offset, limit=limit, session=session),
+        session,
+        list[Invoice],
+    )
 
 
-@app.patch("/invoices/{id}", response_model=InvoicePub)
+@router.patch("/invoices/{id}", response_model=InvoicePub)
 async def patch_invoices(
     id: int, amount: float, session: Session = Depends(get_session)
 ):
@@ -212,17 +418,22 @@ async def patch_invoices(
     return invoice
 
 
-@app.get("/invoices/{id}/salesitems/", response_model=list[SaleItemPub])
+@router.get("/invoices/{id}/salesitems/", response_model=list[SaleItemPub])
 async def get_invoice_salesitems(id: int, session: Session = Depends(get_session)):
-    invoice = InvoiceControler.get_one(id, session)
-    if not invoice:
+    salesitems = SaleItemControler.get_by_invoice(id, session)
+    if salesitems:
+        return salesitems
+    if InvoiceControler.get_one(id, session):
+        return []
+    salesitems = ArchiveControler.get_invoice_salesitems(id, session)
+    if not salesitems and not ArchiveControler.get_invoice(id, session):
         raise HTTPException(
             status.HTTP_404_NOT_FOUND, "no invoice with such id was found"
         )
-    return invoice.salesitems
+    return salesitems
 
 
-@app.delete("/invoices/{id}/")
+@router.delete("/invoices/{id}/")
 async def delete_invoice(id: int, session: Session = Depends(get_session)):
     invoice = InvoiceControler.get_one(id, session)
     if not invoice:
@@ -233,12 +444,13 @@ async def delete_invoice(id: int, session: Session = Depends(get_session)):
     loan.total -= invoice.invoice_amount
     loan.paid_amount -= invoice.paid_amount
     session.add(loan)
-    session.commit()
     session.delete(invoice)
+    InvoiceControler.tombstone([id], session)
+    session.commit()
 
 
 # sales endpoints
-@app.post("/sales/")
+@router.post("/sales/")
 async def add_sale(session: Session = Depends(get_session)):
     date = datetime.now(timezone.utc).date()
 
@@ -252,25 +464,47 @@ async def add_sale(session: Session = Depends(get_session)):
     return sale
 
 
-@app.get("/sales", response_model=list[SalePub])
+@router.get("/sales", response_model=list[SalePub])
 async def get_all_sales(
     offset: int = 0, limit: int = 40, session: Session = Depends(get_session)
 ):
-    sales = SaleControler.get_all(offset, limit, session)
-    if sales:
-        return sales
-    raise HTTPException(status.HTTP_404_NOT_FOUND, "no sales was found")
+    def compute():
+        sales = SaleControler.get_all(offset, limit, session)
+        if sales:
+            return sales
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "no sales was found")
+
+    return cache.response(
+        ("sales", offset, limit), ("sale",), compute, session, list[SalePub]
+    )
+
 
+@router.get("/sales/today", response_model=SalePub)
+async def get_today_sale(session: Session = Depends(get_session)):
+    def compute():
+        sale = SaleControler.get_today_sale(session)
+        if sale:
+            return sale
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "no sale was made today")
 
-@app.get("/sales/{id}/", response_model=SalePub)
+    today = datetime.now(timezone.utc).date()
+    return cache.response(("sales_today", today), ("sale",), compute, session, SalePub)
+
+
+@router.get("/sales/{id}/", response_model=SalePub)
 async def get_sale(id: int, session: Session = Depends(get_session)):
-    sale = SaleControler.get_one(id, session)
-    if sale:
-        return sale
-    raise HTTPException(status.HTTP_404_NOT_FOUND, f"sale with id {id} was not found")
+    def compute():
+        sale = SaleControler.get_one(id, session)
+        if sale:
+            return sale
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND, f"sale with id {id} was not found"
+        )
+
+    return cache.response(("sale", id), ("sale",), compute, session, SalePub)
 
 
-@app.post("/sales/{id}/saleitems", response_model=list[SaleItemPub])
+@router.post("/sales/{id}/saleitems", response_model=list[SaleItemPub])
 async def add_sale_items(
     sale_items: list[SaleItemIn], id: int, session: Session = Depends(get_session)
 ):
@@ -292,31 +526,81 @@ async def add_sale_items(
                 )
             item = SaleItem.model_validate(item)
             item.sale_id = sale.id
+            item.capture(product)
+            cost = ValuationControler.consume(product, item.quantity, session)
+            item.unit_cost = cost / item.quantity if item.quantity else 0
             sale.revenue += item.quantity * item.amount
+            sale.cost_of_goods += cost
             items.append(item)
         sitems = sale.saleitems
         items.extend(sitems)
         sale.saleitems = items
+        sale.updated_at = datetime.now(timezone.utc)
         session.add(sale)
         session.commit()
         session.refresh(sale)
+        bus.publish("sales", {"sale_id": sale.id, "revenue": sale.revenue})
+        publish_stock([item.product_id for item in sale_items], session)
         return sale.saleitems
     raise HTTPException(status.HTTP_404_NOT_FOUND, f"sale with id {id} was not found ")
 
 
-@app.get("/sales/{id}/saleitems/", response_model=list[SaleItemPub])
+@router.get("/sales/{id}/saleitems/", response_model=list[SaleItemPub])
 async def get_all_sale_saleitem(id: int, session: Session = Depends(get_session)):
-    sale = SaleControler.get_one(id, session)
-    if sale:
-        if sale.saleitems:
-            return sale.saleitems
+    # the cutoff of an archive run can fall inside a day, a sale may have
+    # items in both files
+    saleitems = ArchiveControler.get_sale_salesitems(id, session)
+    saleitems.extend(SaleItemControler.get_by_sale(id, session))
+    if saleitems:
+        return saleitems
+    if SaleControler.get_one(id, session):
         raise HTTPException(
             status.HTTP_404_NOT_FOUND, f"sale with id {id} has no sale items"
         )
     raise HTTPException(status.HTTP_404_NOT_FOUND, f"sale with id {id} was not found")
 
 
-@app.post("/products/", response_model=ProductPub)
+@router.get("/products/bulk/", response_model=list[ProductPub])
+async def get_products_bulk(
+    ids: list[int] = Query(), session: Session = Depends(get_session)
+):
+    return ProductControler.get_many(ids, session)
+
+
+@router.post("/products/bulk/", response_model=list[ProductPub])
+async def add_products_bulk(
+    products: list[ProductsIn], session: Session = Depends(get_session)
+):
+    names = [product.name for product in products]
+    existing = session.exec(select(Product.name).where(Product.name.in_(names))).all()
+    repeated = {name for name in names if names.count(name) > 1}
+    conflicts = sorted(set(existing) | repeated)
+    if conflicts:
+        raise HTTPException(
+            status.HTTP_409_CONFLICT,
+            detail=f"can not create products {conflicts} cause they already exist",
+        )
+    return ProductControler.save_many(products, session)
+
+
+@router.patch("/products/bulk/")
+async def update_products_bulk(
+    data: ProductBulkUpdate, session: Session = Depends(get_session)
+):
+    values = data.model_dump(exclude_unset=True, exclude={"ids"})
+    if not values:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "there is nothing to update")
+    updated = ProductControler.update_many(data.ids, values, session)
+    return {"updated": updated}
+
+
+@router.delete("/products/bulk/")
+async def delete_products_bulk(data: BulkIds, session: Session = Depends(get_session)):
+    deleted = ProductControler.delete_many(data.ids, session)
+    return {"deleted": deleted}
+
+
+@router.post("/products/", response_model=ProductPub)
 async def add_product(products: ProductsIn, session: Session = Depends(get_session)):
     product = session.exec(select(Product).where(Product.name == products.name)).all()
     if product:
@@ -326,11 +610,12 @@ async def add_product(products: ProductsIn, session: Session = Depends(get_sessi
         )
     product = ProductControler.save(products, session)
     if product:
+        bus.publish("products", {"product_id": product.id, "action": "created"})
         return product
     raise HTTPException(status.HTTP_304_NOT_MODIFIED, "product was not created")
 
 
-@app.get("/products/", response_model=list[ProductPub])
+@router.get("/products/", response_model=list[ProductPub])
 async def get_all_products(
     offset: int = 0, limit: int = 30, session: Session = Depends(get_session)
 ):
@@ -340,7 +625,7 @@ async def get_all_products(
     raise HTTPException(status.HTTP_404_NOT_FOUND, detail="no products were found")
 
 
-@app.get("/products/{id}/", response_model=ProductPub)
+@router.get("/products/{id}/", response_model=ProductPub)
 async def get_product(id: int, session: Session = Depends(get_session)):
     product = ProductControler.get_one(id, session)
     if product:
@@ -350,47 +635,61 @@ async def get_product(id: int, session: Session = Depends(get_session)):
     )
 
 
-@app.put("/products/{id}/", response_model=ProductPub)
+@router.put("/products/{id}/", response_model=ProductPub)
 async def update_product(
     id: int, product: ProductsIn, session: Session = Depends(get_session)
 ):
-    productdb = ProductControler.update(product, id, session)
+    productdb = ProductControler.update(id, product, session)
     if productdb:
+        bus.publish("products", {"product_id": id, "action": "updated"})
+        bus.publish("stock", {"product_id": id, "stock": productdb.stock})
         return productdb
     raise HTTPException(
         status.HTTP_404_NOT_FOUND, f"product with id {id} was not found"
     )
 
 
-@app.delete("/products/{id}/")
+@router.delete("/products/{id}/")
 async def delete_product(id: int, session: Session = Depends(get_session)):
     product = ProductControler.get_one(id, session)
     if product:
         session.delete(product)
+        ProductControler.tombstone([id], session)
+        session.commit()
+        bus.publish("products", {"product_id": id, "action": "deleted"})
         return f"product {product.name} was deleted succesfull"
     raise HTTPException(
         status.HTTP_404_NOT_FOUND, f"product with id {id} was not found"
     )
 
 
-@app.get("/loan/", response_model=list[LoanPub])
+@router.get("/loan/", response_model=list[LoanPub])
 async def get_all_loan(
     offset: int = 0, limit: int = 30, session: Session = Depends(get_session)
 ):
-    loans = LoanControler.get_all(offset, limit, session)
-    return loans
+    return cache.response(
+        ("loans", offset, limit),
+        ("loan", "customer"),
+        lambda: LoanControler.get_all(offset, limit, session),
+        session,
+        list[LoanPub],
+    )
 
 
-@app.get("/loan/{id}/invoices", response_model=list[InvoicePub])
-async def get_sell_items(id: int, session: Session = Depends(get_session)):
+@router.get("/loan/{id}/invoices", response_model=list[InvoicePub])
+async def get_sell_items(
+    id: int, archived: bool = True, session: Session = Depends(get_session)
+):
     loan = LoanControler.get_one(id, session)
     if loan:
+        if archived:
+            return ArchiveControler.get_loan_invoices(id, session) + loan.invoices
         return loan.invoices
     raise HTTPException(status.HTTP_404_NOT_FOUND, f"loan with id {id} was not found")
 
 
 # this endpoint should take the paid amount and iterate over all the loan's invoices and pay them accordingly
-@app.post("/loan/{id}/pay/", response_model=list[InvoicePub])
+@router.post("/loan/{id}/pay/", response_model=list[InvoicePub])
 async def add_payitem(
     id: int, payitem: PayItemIn, session: Session = Depends(get_session)
 ):
@@ -449,19 +748,27 @@ async def add_payitem(
     session.add(loan)
     session.commit()
     session.refresh(loan)
+    bus.publish(
+        "payments",
+        {"loan_id": loan.id, "amount": used_amount, "paid_amount": loan.paid_amount},
+    )
     return loan.invoices
 
 
 # this should be modifyied to only return a single pay item
-@app.get("/loan/{id}/pay/", response_model=list[PayItemPub])
-async def get_payitems(id: int, session: Session = Depends(get_session)):
+@router.get("/loan/{id}/pay/", response_model=list[PayItemPub])
+async def get_payitems(
+    id: int, archived: bool = True, session: Session = Depends(get_session)
+):
     loan = LoanControler.get_one(id, session)
     if loan:
+        if archived:
+            return ArchiveControler.get_payitems(id, session) + loan.payitems
         return loan.payitems
     raise HTTPException(status.HTTP_404_NOT_FOUND, f"loan with id {id} was not found")
 
 
-@app.delete("/pay/{id}/")
+@router.delete("/pay/{id}/")
 async def delete_pay_item(id: int, session: Session = Depends(get_session)):
     pay = PayItemControler.get_one(id, session)
     if pay:
@@ -472,7 +779,7 @@ async def delete_pay_item(id: int, session: Session = Depends(get_session)):
     )
 
 
-@app.put("/pay/{id}/", response_model=PayItemPub)
+@router.put("/pay/{id}/", response_model=PayItemPub)
 async def update_pay_item(
     id: int, model: PayItemIn, session: Session = Depends(get_session)
 ):
@@ -480,13 +787,13 @@ async def update_pay_item(
     return pay
 
 
-@app.post("/purchase/", response_model=PurchasePub)
+@router.post("/purchase/", response_model=PurchasePub)
 async def add_purchase(model: ParchaseIn, session: Session = Depends(get_session)):
     purchase = PurchaseControler.save(model, session)
     return purchase
 
 
-@app.get("/purchase/", response_model=list[PurchasePub])
+@router.get("/purchase/", response_model=list[PurchasePub])
 async def get_all_purchase(
     offset: int = 0, limit: int = 30, session: Session = Depends(get_session)
 ):
@@ -494,13 +801,13 @@ async def get_all_purchase(
     return purchases
 
 
-@app.get("/purchase/{id}/", response_model=PurchasePub)
+@router.get("/purchase/{id}/", response_model=PurchasePub)
 async def get_purchase(id: int, session: Session = Depends(get_session)):
     purchase = PurchaseControler.get_one(id, session)
     return purchase
 
 
-@app.put("/purchase/{id}/", response_model=PurchasePub)
+@router.put("/purchase/{id}/", response_model=PurchasePub)
 async def update_purchase(
     id: int, model: ParchaseIn, session: Session = Depends(get_session)
 ):
@@ -510,7 +817,7 @@ async def update_purchase(
     raise HTTPException(status.HTTP_404_NOT_FOUND, "there is no purchase found")
 
 
-@app.delete("/purchase/{id}/")
+@router.delete("/purchase/{id}/")
 async def delete_purchase(id: int, session: Session = Depends(get_session)):
     purchase = PurchaseControler.get_one(id, session)
     if purchase:
@@ -521,31 +828,33 @@ async def delete_purchase(id: int, session: Session = Depends(get_session)):
     )
 
 
-@app.post("/purchase/{id}/purchaseitem/", response_model=PurchaseItemPub)
+@router.post("/purchase/{id}/purchaseitem/", response_model=list[PurchaseItemPub])
 async def add_purchase_items(
     id: int, items: list[PurchaseItemIn], session: Session = Depends(get_session)
 ):
     try:
         purchase_items = PurchaseItemControler.save_list(id, items, session)
-        if not purchase_items:
-            raise HTTPException(
-                status.HTTP_404_NOT_FOUND, f"purchase with id {id} was not found"
-            )
-    except NotFound as e:
-        raise HTTPException(status.HTTP_404_NOT_FOUND, "some products were not found")
+    except InvalidLines as e:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, e.errors)
+    if purchase_items is None:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND, f"purchase with id {id} was not found"
+        )
+    publish_stock([item.product_id for item in items], session)
+    return purchase_items
 
 
-@app.get("/purchase/{id}/purchaseitem/")
+@router.get("/purchase/{id}/purchaseitem/")
 async def get_purchase_items(id: int, session: Session = Depends(get_session)):
-    items = PurchaseControler.get_one(id, session)
-    if items:
-        return items.purchaseitems
+    items = PurchaseItemControler.get_by_purchase(id, session)
+    if items or PurchaseControler.get_one(id, session):
+        return items
     raise HTTPException(
         status.HTTP_404_NOT_FOUND, f"purchase with id {id} was not found"
     )
 
 
-@app.get("/purchaseitem/{id}", response_model=PurchaseItemPub)
+@router.get("/purchaseitem/{id}", response_model=PurchaseItemPub)
 async def get_purchase_item(id: int, session: Session = Depends(get_session)):
     item = PurchaseItemControler.get_one(id, session)
     if item:
@@ -556,7 +865,13 @@ async def get_purchase_item(id: int, session: Session = Depends(get_session)):
 # endpoints for expenses
 
 
-@app.post("/expenses/", response_model=list[ExpensePub])
+@router.delete("/expenses/bulk/")
+async def delete_expenses_bulk(data: BulkIds, session: Session = Depends(get_session)):
+    deleted = ExpenseControler.delete_many(data.ids, session)
+    return {"deleted": deleted}
+
+
+@router.post("/expenses/", response_model=list[ExpensePub])
 async def add_expenses(
     expenses: list[ExpenseIn], session: Session = Depends(get_session)
 ):
@@ -564,23 +879,54 @@ async def add_expenses(
     return items
 
 
-@app.get("/expenses/", response_model=list[ExpensePub])
+@router.get("/expenses/", response_model=list[ExpensePub])
 async def get_expenses(
     offset: int = 0, limit: int = 30, session: Session = Depends(get_session)
 ):
-    expenses = ExpenseControler.get_all(offset, limit, session)
-    return expenses
+    return cache.response(
+        ("expenses", offset, limit),
+        ("expense",),
+        lambda: ExpenseControler.get_all(offset, limit, session),
+        session,
+        list[ExpensePub],
+    )
+
+
+@router.get("/expenses/summary", response_model=ExpenseSummary)
+async def get_expense_summary(
+    since: date | None = Query(None, alias="from"),
+    until: date | None = Query(None, alias="to"),
+    period: Literal["day", "week", "month"] = "month",
+    top: int = Query(5, gt=0),
+    category: str | None = None,
+    session: Session = Depends(get_session),
+):
+    until = until or datetime.now(timezone.utc).date()
+    since = since or until - timedelta(days=365)
+    if since > until:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "from is after to")
+    return cache.response(
+        ("expense_summary", since, until, period, top, category),
+        ("expense",),
+        lambda: ReportControler.expense_summary(
+            session, since, until, period, top, category
+        ),
+        session,
+        ExpenseSummary,
+    )
 
 
-@app.get("/expenses/{id}/", response_model=ExpensePub)
+@router.get("/expenses/{id}/", response_model=ExpensePub)
 async def get_expense(id: int, session: Session = Depends(get_session)):
-    expense = ExpenseControler.get_one(id, session)
+    expense = ExpenseControler.get_one(id, session) or ArchiveControler.get_expense(
+        id, session
+    )
     if expense:
         return expense
     raise HTTPException(status.HTTP_404_NOT_FOUND, "expense with that id was not found")
 
 
-@app.put("/expenses/{id}/")
+@router.put("/expenses/{id}/")
 async def update_expense(id: int, expense: ExpenseIn, session):
     expensedb = ExpenseControler.get_one(id, session)
     if not expensedb:
@@ -593,9 +939,379 @@ async def update_expense(id: int, expense: ExpenseIn, session):
     return expensedb
 
 
-@app.delete("/expenses/{id}/")
+@router.delete("/expenses/{id}/")
 async def delete_expense(id: int, session: Session = Depends(get_session)):
     expense = ExpenseControler.delete(id, session)
     if expense:
         return expense
     raise HTTPException(status.HTTP_404_NOT_FOUND, "expense with such id was not found")
+
+
+# inventory endpoints
+
+
+@router.get("/inventory/valuation", response_model=list[ProductValuationPub])
+async def get_inventory_valuation(
+    offset: int = 0, limit: int = 100, session: Session = Depends(get_session)
+):
+    return ValuationControler.stock_value(session, offset, limit)
+
+
+@router.get("/inventory/reorder", response_model=list[ReorderRow])
+async def get_inventory_reorder(
+    window_days: int = Query(30, gt=0),
+    lead_time_days: float = Query(7, ge=0),
+    cover_days: float = Query(14, ge=0),
+    only_low: bool = True,
+    session: Session = Depends(get_session),
+):
+    return InventoryControler.reorder(
+        session,
+        window_days=window_days,
+        lead_time_days=lead_time_days,
+        cover_days=cover_days,
+        only_low=only_low,
+    )
+
+
+@router.get("/products/{id}/valuation", response_model=ProductValuationPub)
+async def get_product_valuation(id: int, session: Session = Depends(get_session)):
+    valuation = ValuationControler.stock_value(session, product_id=id)
+    if valuation:
+        return valuation[0]
+    raise HTTPException(
+        status.HTTP_404_NOT_FOUND, f"product with id {id} was not found"
+    )
+
+
+# forecast endpoints
+
+
+@router.get("/forecast", response_model=list[ForecastRow])
+async def get_forecast(
+    horizon: int = Query(7, gt=0),
+    method: Literal["ses", "moving_average"] = "ses",
+    alpha: float = Query(0.3, gt=0, le=1),
+    history_days: int = Query(730, gt=0),
+    window: int = Query(28, gt=0),
+    offset: int = 0,
+    limit: int = 100,
+    session: Session = Depends(get_session),
+):
+    return ForecastControler.forecast(
+        session,
+        horizon=horizon,
+        method=method,
+        alpha=alpha,
+        history_days=history_days,
+        window=window,
+        offset=offset,
+        limit=limit,
+    )
+
+
+# report endpoints
+
+
+@router.get("/reports/aging", response_model=AgingReport)
+async def get_aging_report(
+    as_of: datetime | None = None,
+    offset: int = 0,
+    limit: int = 100,
+    session: Session = Depends(get_session),
+):
+    # the default report date moves with the clock, it is taken per minute so
+    # that refreshes within the minute share an entry
+    as_of = as_of or datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    return cache.response(
+        ("aging", as_of, offset, limit),
+        ("invoice", "loan", "customer"),
+        lambda: ReportControler.aging(session, as_of, offset, limit),
+        session,
+        AgingReport,
+    )
+
+
+# analytics endpoints
+
+
+@router.get("/analytics/margin-by-product", response_model=list[ProductMargin])
+async def get_margin_by_product(
+    since: date | None = Query(None, alias="from"),
+    until: date | None = Query(None, alias="to"),
+    limit: int = Query(50, gt=0),
+    session: Session = Depends(get_session),
+):
+    return AnalyticsControler.margin_by_product(session, since, until, limit)
+
+
+@router.get("/analytics/sales-by-weekday", response_model=list[WeekdaySales])
+async def get_sales_by_weekday(
+    since: date | None = Query(None, alias="from"),
+    until: date | None = Query(None, alias="to"),
+    session: Session = Depends(get_session),
+):
+    return AnalyticsControler.sales_by_weekday(session, since, until)
+
+
+@router.get("/analytics/top-debtors", response_model=list[Debtor])
+async def get_top_debtors(
+    limit: int = Query(20, gt=0), session: Session = Depends(get_session)
+):
+    return AnalyticsControler.top_debtors(session, limit)
+
+
+@router.get("/analytics/expenses-by-category", response_model=list[CategoryExpense])
+async def get_expenses_by_category(
+    since: date | None = Query(None, alias="from"),
+    until: date | None = Query(None, alias="to"),
+    session: Session = Depends(get_session),
+):
+    return AnalyticsControler.expenses_by_category(session, since, until)
+
+
+@router.get("/analytics/stats")
+async def get_analytics_stats(session: Session = Depends(get_session)):
+    return AnalyticsControler.stats(session)
+
+
+@router.get("/cache/stats")
+async def get_cache_stats():
+    return cache.stats()
+
+
+@router.get("/admission/stats")
+async def get_admission_stats():
+    return admission.stats()
+
+
+# live event endpoints
+
+
+@router.get("/events")
+async def stream_events(topics: str | None = None):
+    wanted = [topic for topic in (topics or "").split(",") if topic]
+    unknown = set(wanted) - set(TOPICS)
+    if unknown:
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST,
+            f"unknown topics {sorted(unknown)}, use some of {list(TOPICS)}",
+        )
+    subscriber = bus.subscribe(wanted)
+    return StreamingResponse(
+        bus.stream(subscriber),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/events/stats")
+async def get_event_stats():
+    return bus.stats()
+
+
+# background job endpoints
+
+
+@router.post(
+    "/jobs/{kind}", response_model=JobPub, status_code=status.HTTP_202_ACCEPTED
+)
+async def submit_job(
+    kind: str,
+    params: dict[str, Any] = Body(default_factory=dict),
+    session: Session = Depends(get_session),
+):
+    if kind not in JOB_KINDS:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND,
+            f"job kind {kind} was not found, use one of {sorted(JOB_KINDS)}",
+        )
+    try:
+        job = runner.submit(kind, params, session)
+    except (TypeError, ValueError) as exc:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, str(exc))
+    except JobQueueFull as exc:
+        raise HTTPException(
+            status.HTTP_503_SERVICE_UNAVAILABLE, str(exc), {"Retry-After": "30"}
+        )
+    return job_pub(job)
+
+
+@router.get("/jobs", response_model=list[JobPub])
+async def get_jobs(
+    offset: int = 0, limit: int = 50, session: Session = Depends(get_session)
+):
+    jobs = session.exec(
+        select(Job).order_by(Job.id.desc()).offset(offset).limit(limit)
+    ).all()
+    return [job_pub(job) for job in jobs]
+
+
+@router.get("/jobs/stats")
+async def get_job_stats():
+    return runner.stats()
+
+
+@router.get("/jobs/{id}", response_model=JobPub)
+async def get_job(id: int, session: Session = Depends(get_session)):
+    job = session.get(Job, id)
+    if not job:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND, f"job with id {id} was not found"
+        )
+    return job_pub(job)
+
+
+@router.delete("/jobs/{id}", response_model=JobPub)
+async def cancel_job(id: int, session: Session = Depends(get_session)):
+    job = runner.cancel(id, session)
+    if not job:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND, f"job with id {id} was not found"
+        )
+    return job_pub(job)
+
+
+@router.get("/jobs/{id}/result")
+async def get_job_result(id: int, session: Session = Depends(get_session)):
+    job = session.get(Job, id)
+    if not job:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND, f"job with id {id} was not found"
+        )
+    if job.status != JobStatus.done or not job.result_path:
+        raise HTTPException(
+            status.HTTP_409_CONFLICT, f"job {id} has no result, it is {job.status}"
+        )
+    if not os.path.exists(job.result_path):
+        raise HTTPException(status.HTTP_410_GONE, f"result of job {id} was removed")
+    return FileResponse(
+        job.result_path,
+        media_type=job.media_type,
+        filename=os.path.basename(job.result_path),
+    )
+
+
+# chart endpoints
+
+
+@router.get("/charts/{kind}.png", response_class=Response)
+async def get_chart(
+    kind: Literal["revenue", "expenses", "margin", "receivables"],
+    since: date | None = Query(None, alias="from"),
+    until: date | None = Query(None, alias="to"),
+    if_none_match: str | None = Header(None),
+    session: Session = Depends(get_session),
+):
+    until = until or datetime.now(timezone.utc).date()
+    since = since or until - timedelta(days=29)
+    if since > until or (until - since).days > 366:
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            "from must be before to and at most a year apart",
+        )
+    png, key = await ChartControler.render(kind, since, until, session)
+    etag = '"' + hashlib.sha1(repr(key).encode()).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if if_none_match == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(png, media_type="image/png", headers=headers)
+
+
+# sync endpoints
+
+
+async def sync_customer(data: User, session: Session):
+    customer = await add_customer(data, session)
+    return {"customer_id": customer.id}
+
+
+async def sync_invoice(data: InvoiceInputData, session: Session):
+    invoice = await add_invoice(data, session)
+    return {"invoice_id": invoice.id}
+
+
+async def sync_sale(data: SyncSale, session: Session):
+    sale = SaleControler.get_today_sale(session) or create_sale(session)
+    await add_sale_items(data.salesitems, sale.id, session)
+    return {"sale_id": sale.id}
+
+
+async def sync_payment(data: SyncPayment, session: Session):
+    await add_payitem(data.loan_id, PayItemIn(amount=data.amount), session)
+    return {"loan_id": data.loan_id}
+
+
+SYNC_OPS = {
+    "customer": (User, sync_customer),
+    "invoice": (InvoiceInputData, sync_invoice),
+    "sale": (SyncSale, sync_sale),
+    "payment": (SyncPayment, sync_payment),
+}
+
+
+@router.get("/sync", response_model=SyncChanges)
+async def get_sync(since: str | None = None, session: Session = Depends(get_session)):
+    try:
+        return SyncControler.changes(session, since)
+    except (ValueError, OverflowError):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, f"invalid sync token {since}")
+
+
+@router.post("/sync", response_model=SyncResult)
+async def post_sync(batch: SyncBatchIn):
+    """apply queued offline operations in order, all of them or none"""
+    # the handlers commit with flushes only, their events wait for commit_batch
+    with SyncControler.batch_session() as session, bus.deferred():
+        if batch.batch_id:
+            results = SyncControler.get_batch(batch.batch_id, session)
+            if results is not None:
+                return SyncResult(
+                    batch_id=batch.batch_id, replayed=True, results=results
+                )
+        results = []
+        for index, op in enumerate(batch.ops):
+            model, apply = SYNC_OPS[op.op]
+            try:
+                results.append(await apply(model.model_validate(op.data), session))
+            except ValidationError as exc:
+                session.rollback()
+                raise HTTPException(
+                    status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    {"op": index, "detail": exc.errors(include_url=False)},
+                )
+            except HTTPException as exc:
+                session.rollback()
+                raise HTTPException(
+                    exc.status_code, {"op": index, "detail": exc.detail}
+                )
+        if batch.batch_id:
+            SyncControler.save_batch(batch.batch_id, results, session)
+        session.commit_batch()
+    return SyncResult(batch_id=batch.batch_id, replayed=False, results=results)
+
+
+# change log endpoints
+
+
+@router.get("/changes", response_model=ChangePage)
+async def get_changes(
+    after: int = 0,
+    limit: int = Query(1000, ge=1, le=10000),
+    tables: str | None = None,
+    session: Session = Depends(get_session),
+):
+    wanted = [table for table in (tables or "").split(",") if table]
+    changes = changelog.read(session, after, limit, wanted)
+    return ChangePage(changes=changes, next=changes[-1].seq if changes else after)
+
+
+@router.get("/changes/cursors/{name}", response_model=ChangeCursor)
+async def get_change_cursor(name: str, session: Session = Depends(get_session)):
+    return session.get(ChangeCursor, name) or ChangeCursor(name=name)
+
+
+@router.put("/changes/cursors/{name}", response_model=ChangeCursor)
+async def ack_changes(name: str, seq: int, session: Session = Depends(get_session)):
+    changelog.ChangeReader(name).ack(session, seq)
+    return session.get(ChangeCursor, name)
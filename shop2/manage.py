@@ -0,0 +1,108 @@
+"""Maintenance commands for the shop2 database.
+
+    python manage.py rebuild-valuation
+    python manage.py purge-sync
+    python manage.py purge-changes
+    python manage.py backup
+    python manage.py archive [--days 730]
+    python manage.py create-tenant north
+
+Every command takes --tenant to run against a tenant's database instead
+of the default one.
+"""
+
+import argparse
+import time
+
+from sqlmodel import Session
+
+from models.model import create_db_and_tables, current_tenant, get_engine, tenants
+from controlers.valuation import ValuationControler
+from controlers.sync import SyncControler
+from controlers.archive import ARCHIVE_DAYS, ArchiveControler
+from core import backup as backups
+from core import changelog
+
+
+def rebuild_valuation(args):
+    with Session(get_engine()) as session:
+        return ValuationControler.rebuild(session)
+
+
+def purge_sync(args):
+    with Session(get_engine()) as session:
+        return SyncControler.purge(session)
+
+
+def purge_changes(args):
+    with Session(get_engine()) as session:
+        return changelog.purge(session)
+
+
+def backup(args):
+    with Session(get_engine()) as session:
+        record = backups.backup(session)
+        return f"{record.path}, {record.bytes} bytes"
+
+
+def archive(args):
+    with Session(get_engine()) as session:
+        return ArchiveControler.run(session, args.days)
+
+
+def create_tenant(args):
+    if tenants.exists(args.name):
+        return f"{args.name} already exists"
+    tenants.create(args.name)
+    return tenants.path(args.name)
+
+
+COMMANDS = {
+    "rebuild-valuation": rebuild_valuation,
+    "purge-sync": purge_sync,
+    "purge-changes": purge_changes,
+    "backup": backup,
+    "archive": archive,
+    "create-tenant": create_tenant,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="shop2 maintenance commands")
+    parser.add_argument("--tenant", help="database of this tenant")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser(
+        "rebuild-valuation",
+        help="replay purchases and sales into fresh inventory cost layers",
+    )
+    commands.add_parser(
+        "purge-sync",
+        help="drop tombstones and sync batch records past the sync horizon",
+    )
+    commands.add_parser(
+        "purge-changes",
+        help="drop change log rows that every change cursor has read",
+    )
+    commands.add_parser(
+        "backup", help="copy a snapshot of the live database into BACKUP_DIR"
+    )
+    archive_parser = commands.add_parser(
+        "archive", help="move settled history into the archive database"
+    )
+    archive_parser.add_argument("--days", type=int, default=ARCHIVE_DAYS)
+    tenant_parser = commands.add_parser(
+        "create-tenant", help="create the database of a new tenant in TENANT_DIR"
+    )
+    tenant_parser.add_argument("name")
+    args = parser.parse_args(argv)
+
+    current_tenant.set(args.tenant)
+    get_engine().echo = False
+    create_db_and_tables()
+    start = time.perf_counter()
+    result = COMMANDS[args.command](args)
+    print(f"{args.command}: {result} in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,15 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextvars import ContextVar
 from annotated_types import Timezone
-from sqlmodel import SQLModel, Relationship, Field, create_engine
-from datetime import datetime, timezone
-from typing import Optional
+from pydantic import computed_field
+from sqlmodel import Session, SQLModel, Relationship, Field, create_engine
+from sqlalchemy import Column, Index, MetaData, Table, event, text
+from functools import cache
+from datetime import date, datetime, timezone
+from typing import Any, Literal, Optional
 from enum import StrEnum
 
 
@@ -11,6 +19,15 @@ class Status(StrEnum):
     partial = "Partial"
 
 
+class JobStatus(StrEnum):
+    queued = "Queued"
+    running = "Running"
+    cancelling = "Cancelling"
+    cancelled = "Cancelled"
+    done = "Done"
+    failed = "Failed"
+
+
 # Admin model
 
 
@@ -22,8 +39,8 @@ class User(SQLModel):
 
 class Admin(User, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    created_at: datetime = Field(default=datetime.now(timezone.utc))
-    updated_at: datetime = Field(default=datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     password: str
 
 
@@ -36,8 +53,13 @@ class AdminPub(User):
 
 class Customer(User, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    created_at: datetime = Field(default=datetime.now(timezone.utc))
-    updated_at: datetime = Field(default=datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # bumped on every update, delta sync reads changes by it
+    updated_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_column_kwargs={"onupdate": lambda: datetime.now(timezone.utc)},
+        index=True,
+    )
     loan: Optional["Loan"] = Relationship(
         back_populates="customer", sa_relationship_kwargs={"uselist": False}
     )
@@ -54,8 +76,8 @@ class CustomerLoan(SQLModel):
 # Sale model
 class Sale(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    created_at: datetime = Field(default=datetime.now(timezone.utc))
-    updated_at: datetime = Field(default=datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     saleitems: list["SaleItem"] = Relationship(back_populates="sale")
     revenue: float = Field(default=0)
     cost_of_goods: float = Field(default=0)
@@ -75,22 +97,49 @@ class SaleItemIn(SQLModel):
     amount: float
 
 
-class SaleItem(SaleItemIn, table=True):
+class ProductSale(SQLModel):
+    name: str
+
+
+# the product as it was when a line item was written, receipts and purchase
+# lists read it from the line and do not change when the product does
+class ProductSnapshot(SQLModel):
+    product_name: str | None = None
+    units: str | None = None
+
+    def capture(self, product: "Product"):
+        self.product_name = product.name
+        self.units = product.units
+
+
+class SaleItem(SaleItemIn, ProductSnapshot, table=True):
+    # covers the sales history scans of the inventory reports
+    __table_args__ = (
+        Index("ix_saleitem_history", "created_at", "product_id", "quantity"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
-    created_at: datetime = Field(default=datetime.now(timezone.utc))
-    updated_at: datetime = Field(default=datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     sale_id: int | None = Field(default=None, foreign_key="sale.id")
     product_id: int | None = Field(default=None, foreign_key="product.id")
     sale: Sale | None = Relationship(back_populates="saleitems")
     product: Optional["Product"] = Relationship(back_populates="saleitems")
     invoice_id: int | None = Field(default=None, foreign_key="invoice.id")
     invoice: "Invoice" = Relationship(back_populates="salesitems")
+    # cost of goods of one unit, as charged when the item was sold
+    unit_cost: float | None = None
 
 
 class SaleItemPub(SaleItemIn):
     id: int
     created_at: datetime
-    product: "ProductSale"
+    product_name: str | None = Field(default=None, exclude=True)
+
+    @computed_field
+    @property
+    def product(self) -> ProductSale:
+        return ProductSale(name=self.product_name or "")
 
 
 # Product model
@@ -104,16 +153,17 @@ class ProductsIn(SQLModel):
 
 class Product(ProductsIn, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    created_at: datetime = Field(default=datetime.now(timezone.utc))
-    updated_at: datetime = Field(default=datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # bumped on every update, delta sync reads changes by it
+    updated_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_column_kwargs={"onupdate": lambda: datetime.now(timezone.utc)},
+        index=True,
+    )
     saleitems: list[SaleItem] = Relationship(back_populates="product")
     purchases: list["PurchaseItem"] = Relationship(back_populates="product")
 
 
-class ProductSale(SQLModel):
-    name: str
-
-
 class ProductPub(ProductsIn):
     id: int
     created_at: datetime
@@ -127,8 +177,13 @@ class LoanIn(SQLModel):
 
 class Loan(LoanIn, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    created_at: datetime = Field(default=datetime.now(timezone.utc))
-    updated_at: datetime = Field(default=datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # bumped on every update, delta sync reads changes by it
+    updated_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_column_kwargs={"onupdate": lambda: datetime.now(timezone.utc)},
+        index=True,
+    )
     customer_id: int | None = Field(default=None, foreign_key="customer.id")
     payitems: list["PayItem"] = Relationship(back_populates="loan")
     customer: Customer | None = Relationship(back_populates="loan")
@@ -152,9 +207,26 @@ class InvoiceIn(SQLModel):
 
 
 class Invoice(InvoiceIn, table=True):
+    # covers the aging report: open invoices per loan with their amounts
+    __table_args__ = (
+        Index(
+            "ix_invoice_aging",
+            "loan_id",
+            "status",
+            "created_at",
+            "invoice_amount",
+            "paid_amount",
+        ),
+        Index("ix_invoice_updated", "updated_at"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
-    created_at: datetime = Field(default=datetime.now(timezone.utc))
-    updated_at: datetime = Field(default=datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # bumped on every update, delta sync reads changes by it
+    updated_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_column_kwargs={"onupdate": lambda: datetime.now(timezone.utc)},
+    )
     salesitems: list[SaleItem] = Relationship(back_populates="invoice")
     loan_id: int | None = Field(default=None, foreign_key="loan.id")
     loan: Loan = Relationship(back_populates="invoices")
@@ -186,8 +258,8 @@ class PayItemIn(SQLModel):
 
 class PayItem(PayItemIn, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    created_at: datetime = Field(default=datetime.now(timezone.utc))
-    updated_at: datetime = Field(default=datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     loan_id: int | None = Field(default=None, foreign_key="loan.id")
     loan: Optional["Loan"] = Relationship(back_populates="payitems")
 
@@ -204,8 +276,8 @@ class ParchaseIn(SQLModel):
 
 class Purchase(ParchaseIn, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    created_at: datetime = Field(default=datetime.now(timezone.utc))
-    updated_at: datetime = Field(default=datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     purchaseitems: list["PurchaseItem"] = Relationship(back_populates="purchase")
 
 
@@ -223,10 +295,10 @@ class PurchaseItemIn(SQLModel):
     quantity: float
 
 
-class PurchaseItem(PurchaseItemIn, table=True):
+class PurchaseItem(PurchaseItemIn, ProductSnapshot, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    created_at: datetime = Field(default=datetime.now(timezone.utc))
-    updated_at: datetime = Field(default=datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     purchase_id: int | None = Field(default=None, foreign_key="purchase.id")
     purchase: Optional[Purchase] = Relationship(back_populates="purchaseitems")
     product_id: int | None = Field(default=None, foreign_key="product.id")
@@ -235,8 +307,13 @@ class PurchaseItem(PurchaseItemIn, table=True):
 
 class PurchaseItemPub(PurchaseItemIn):
     id: int
-    product: ProductSale
     created_at: datetime
+    product_name: str | None = Field(default=None, exclude=True)
+
+    @computed_field
+    @property
+    def product(self) -> ProductSale:
+        return ProductSale(name=self.product_name or "")
 
 
 # Expenses model
@@ -247,9 +324,15 @@ class ExpenseIn(SQLModel):
 
 
 class Expense(ExpenseIn, table=True):
+    __table_args__ = (
+        Index("ix_expense_updated", "updated_at"),
+        # covers the summaries, they are read from the index alone
+        Index("ix_expense_category", "category", "created_at", "amount"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
-    created_at: datetime = Field(default=datetime.now(timezone.utc))
-    updated_at: datetime = Field(default=datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 
 class ExpensePub(ExpenseIn):
@@ -257,16 +340,609 @@ class ExpensePub(ExpenseIn):
     created_at: datetime
 
 
+# inventory valuation models
+class CostLayer(SQLModel, table=True):
+    """a received quantity of a product at the unit cost it was bought for"""
+
+    # only layers with stock left are indexed so selling walks just those
+    __table_args__ = (
+        Index(
+            "ix_costlayer_open",
+            "product_id",
+            "id",
+            sqlite_where=text("remaining > 0"),
+        ),
+    )
+
+    id: int | None = Field(default=None, primary_key=True)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    product_id: int = Field(foreign_key="product.id")
+    purchase_item_id: int | None = Field(default=None, foreign_key="purchaseitem.id")
+    quantity: float
+    remaining: float
+    unit_cost: float
+
+
+class InventoryValuation(SQLModel, table=True):
+    """running weighted average cost of the stock on hand of a product"""
+
+    product_id: int = Field(foreign_key="product.id", primary_key=True)
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    quantity: float = Field(default=0)
+    value: float = Field(default=0)
+
+
+class ProductValuationPub(SQLModel):
+    product_id: int
+    name: str
+    quantity: float
+    fifo_value: float
+    average_cost: float
+    average_value: float
+
+
+class ReorderRow(SQLModel):
+    product_id: int
+    name: str
+    stock: float
+    daily_velocity: float
+    reorder_point: float
+    days_of_cover: float | None
+    order_quantity: float
+    needs_reorder: bool
+
+
+class ForecastRow(SQLModel):
+    product_id: int
+    name: str
+    daily: float
+    total: float
+
+
+# report models
+class AgingBuckets(SQLModel):
+    current: float = 0
+    days_30: float = 0
+    days_60: float = 0
+    days_90_plus: float = 0
+    total: float = 0
+
+
+class AgingRow(AgingBuckets):
+    customer_id: int
+    name: str
+
+
+class AgingReport(SQLModel):
+    as_of: datetime
+    customers_count: int
+    totals: AgingBuckets
+    customers: list[AgingRow]
+
+
+# analytics models
+class ProductMargin(SQLModel):
+    product_id: int
+    name: str
+    quantity: float
+    revenue: float
+    cost: float
+    margin: float
+
+
+class WeekdaySales(SQLModel):
+    weekday: int
+    name: str
+    lines: int
+    quantity: float
+    revenue: float
+
+
+class Debtor(SQLModel):
+    loan_id: int
+    customer_id: int | None
+    name: str
+    open_invoices: int
+    due: float
+
+
+class CategoryExpense(SQLModel):
+    category: str
+    count: int
+    amount: float
+
+
+class ExpensePeriod(SQLModel):
+    category: str
+    period: date
+    count: int
+    amount: float
+
+
+class ExpenseSummary(SQLModel):
+    since: date
+    until: date
+    period: Literal["day", "week", "month"]
+    total: float
+    categories: list[CategoryExpense]
+    periods: list[ExpensePeriod]
+
+
+# bulk operation models
+class BulkIds(SQLModel):
+    ids: list[int]
+
+
+class ProductBulkUpdate(BulkIds):
+    # the columns are not nullable: a field is either left out or set, an
+    # explicit null fails validation with a 422
+    buying_price: float = None
+    selling_price: float = None
+    units: str = None
+
+
+# change log models
+class ChangeLog(SQLModel, table=True):
+    # autoincrement keeps seq growing even after the newest rows are purged
+    __table_args__ = (
+        Index("ix_changelog_table", "table_name", "seq"),
+        {"sqlite_autoincrement": True},
+    )
+
+    seq: int | None = Field(default=None, primary_key=True)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    table_name: str
+    row_id: int
+    op: str
+    # changed columns of an update, comma separated
+    columns: str | None = None
+
+
+class ChangeCursor(SQLModel, table=True):
+    name: str = Field(primary_key=True)
+    seq: int = 0
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class ChangePub(SQLModel):
+    seq: int
+    created_at: datetime
+    table_name: str
+    row_id: int
+    op: str
+    columns: str | None
+
+
+class ChangePage(SQLModel):
+    changes: list[ChangePub]
+    next: int
+
+
+# sync models
+class Tombstone(SQLModel, table=True):
+    id: int | None = Field(default=None, primary_key=True)
+    deleted_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc), index=True
+    )
+    table_name: str
+    row_id: int
+
+
+class SyncBatch(SQLModel, table=True):
+    id: str = Field(primary_key=True)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    result: str
+
+
+class SyncLoan(LoanIn):
+    id: int
+    customer_id: int | None
+
+
+class SyncInvoice(SQLModel):
+    id: int
+    created_at: datetime
+    loan_id: int | None
+    paid_amount: float
+    invoice_amount: float
+    status: Status
+
+
+class SyncChanges(SQLModel):
+    token: str
+    reset: bool
+    products: list[ProductPub]
+    customers: list[CustomerPub]
+    loans: list[SyncLoan]
+    invoices: list[SyncInvoice]
+    deleted: dict[str, list[int]]
+
+
+class SyncSale(SQLModel):
+    salesitems: list[SaleItemIn]
+
+
+class SyncPayment(PayItemIn):
+    loan_id: int
+
+
+class SyncOp(SQLModel):
+    op: Literal["customer", "invoice", "sale", "payment"]
+    data: dict[str, Any]
+
+
+class SyncBatchIn(SQLModel):
+    batch_id: str | None = None
+    ops: list[SyncOp]
+
+
+class SyncResult(SQLModel):
+    batch_id: str | None
+    replayed: bool
+    results: list[dict[str, int]]
+
+
+# backup models
+class Backup(SQLModel, table=True):
+    id: int | None = Field(default=None, primary_key=True)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    path: str
+    bytes: int
+    pages: int
+    seconds: float
+    # the archive database is copied alongside, None when it did not exist
+    archive_path: str | None = None
+    archive_bytes: int | None = None
+
+
+# request profile models, profiles live in memory only
+class ProfileQuery(SQLModel):
+    statement: str
+    seconds: float
+
+
+class ProfilePub(SQLModel):
+    id: int
+    created_at: datetime
+    method: str
+    path: str
+    status: int | None
+    seconds: float
+    queries: int
+    sql_seconds: float
+
+
+class ProfileDetail(ProfilePub):
+    sql: list[ProfileQuery]
+    functions: str
+
+
+# controller timing models
+class ControlerTiming(SQLModel):
+    endpoint: str | None
+    controler: str
+    method: str
+    calls: int
+    total_seconds: float
+    max_seconds: float
+    mean_seconds: float
+    rows: int
+
+
+# job models
+class Job(SQLModel, table=True):
+    id: int | None = Field(default=None, primary_key=True)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    finished_at: datetime | None = None
+    kind: str
+    params: str = "{}"
+    status: JobStatus = JobStatus.queued
+    progress: float = 0
+    message: str | None = None
+    result_path: str | None = None
+    media_type: str | None = None
+    # pid of the web worker that queued it
+    worker: int | None = None
+
+    __table_args__ = (Index("ix_job_status", "status", "id"),)
+
+
+class JobPub(SQLModel):
+    id: int
+    created_at: datetime
+    updated_at: datetime
+    finished_at: datetime | None
+    kind: str
+    params: str
+    status: JobStatus
+    progress: float
+    message: str | None
+    has_result: bool
+
+
 # fuction for initializing database
 
-sqlite_file_name = "database.db"
+sqlite_file_name = os.getenv("SQLITE_FILE", "database.db")
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 
-engine = create_engine(sqlite_url, echo=True)
+
+def archive_path(path: str) -> str:
+    """file of the archive that belongs to the database at path"""
+    root, ext = os.path.splitext(path)
+    return f"{root}-archive{ext}"
+
+
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # every worker process opens its own connections, so the pragmas are
+    # applied per connection: WAL lets readers run alongside the single writer
+    # and busy_timeout makes a writer wait for the lock instead of failing
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    # settled history is moved to a second file next to the database, every
+    # connection sees it as the "archive" schema
+    path = cursor.execute("PRAGMA database_list").fetchone()[2]
+    if path:
+        cursor.execute("ATTACH DATABASE ? AS archive", (archive_path(path),))
+        cursor.execute("PRAGMA archive.journal_mode=WAL")
+    cursor.close()
+
+
+def make_engine(url: str):
+    engine = create_engine(
+        url,
+        echo=True,
+        connect_args={"check_same_thread": False, "timeout": 30},
+    )
+    event.listen(engine, "connect", set_sqlite_pragma)
+    return engine
+
+
+@cache
+def default_engine():
+    """engine of the database served outside of a tenant"""
+    return make_engine(sqlite_url)
+
+
+# every shop has its own database file in TENANT_DIR, named after the tenant
+TENANT_DIR = os.path.abspath(os.getenv("TENANT_DIR", "tenants"))
+TENANT_ENGINES = int(os.getenv("TENANT_ENGINES", "32"))
+TENANT_NAME = re.compile(r"[a-z0-9][a-z0-9_-]{0,62}")
+
+# tenant of the request or job being served, None for the default database
+current_tenant: ContextVar[str | None] = ContextVar("tenant", default=None)
+
+
+class UnknownTenant(Exception):
+    pass
+
+
+class EngineRegistry:
+    """Engines of the tenant databases, opened on first use.
+
+    At most size engines stay open, past that the least recently used ones
+    without a checked out connection are disposed. An engine in use is never
+    closed, with all of them busy the registry grows beyond size until they
+    are idle again. The first time a tenant database opens in the process
+    its schema is brought up to date and the on_open hooks run.
+    """
+
+    def __init__(self, directory: str = TENANT_DIR, size: int = TENANT_ENGINES):
+        self.directory = directory
+        self.size = size
+        self.engines: OrderedDict[str, Any] = OrderedDict()
+        # hook(tenant, engine), once per tenant and process
+        self.on_open: list = []
+        self.seen: set[str] = set()
+        self.opened = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+    def path(self, tenant: str) -> str:
+        if not TENANT_NAME.fullmatch(tenant):
+            raise UnknownTenant(tenant)
+        return os.path.join(self.directory, f"{tenant}.db")
+
+    def exists(self, tenant: str) -> bool:
+        return os.path.exists(self.path(tenant))
+
+    def names(self) -> list[str]:
+        """tenants with a database in the directory"""
+        if not os.path.isdir(self.directory):
+            return []
+        files = set(os.listdir(self.directory))
+        names = []
+        for file in sorted(files):
+            name, ext = os.path.splitext(file)
+            if ext != ".db" or not TENANT_NAME.fullmatch(name):
+                continue
+            # the archive of a tenant sits next to its database
+            if name.endswith("-archive") and f"{name[:-8]}.db" in files:
+                continue
+            names.append(name)
+        return names
+
+    def engine(self, tenant: str):
+        with self._lock:
+            engine = self.engines.get(tenant)
+            if engine is not None:
+                self.engines.move_to_end(tenant)
+                return engine
+            if not self.exists(tenant):
+                raise UnknownTenant(tenant)
+            engine = make_engine(f"sqlite:///{self.path(tenant)}")
+            if tenant not in self.seen:
+                create_db_and_tables(engine)
+                for hook in self.on_open:
+                    hook(tenant, engine)
+                self.seen.add(tenant)
+            self.engines[tenant] = engine
+            self.opened += 1
+            self._evict()
+            return engine
+
+    def _evict(self):
+        for tenant, engine in list(self.engines.items()):
+            if len(self.engines) <= self.size:
+                return
+            if engine.pool.checkedout():
+                continue
+            del self.engines[tenant]
+            engine.dispose()
+            self.evicted += 1
+
+    def create(self, tenant: str):
+        """create the database of a new tenant"""
+        os.makedirs(self.directory, exist_ok=True)
+        engine = make_engine(f"sqlite:///{self.path(tenant)}")
+        create_db_and_tables(engine)
+        engine.dispose()
+
+    def dispose(self):
+        with self._lock:
+            for engine in self.engines.values():
+                engine.dispose()
+            self.engines.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "open": len(self.engines),
+            "size": self.size,
+            "opened": self.opened,
+            "evicted": self.evicted,
+        }
+
+
+tenants = EngineRegistry()
+
+
+def get_engine():
+    """engine of the current tenant, the default database outside of one"""
+    tenant = current_tenant.get()
+    if tenant is None:
+        return default_engine()
+    return tenants.engine(tenant)
+
+
+def create_session(tenant: str | None = None) -> Session:
+    """session on a tenant's database, the current one when not given"""
+    if tenant is None:
+        return Session(get_engine())
+    return Session(tenants.engine(tenant))
+
+
+# archive tables: the columns of the hot table without its foreign keys,
+# plus the indexes the historical lookups need
+archive_metadata = MetaData()
+
+
+def archive_table(model, *indexed: str) -> Table:
+    table = model.__table__
+    return Table(
+        table.name,
+        archive_metadata,
+        *(Column(c.name, c.type, primary_key=c.primary_key) for c in table.columns),
+        *(Index(f"ix_archive_{table.name}_{name}", name) for name in indexed),
+        schema="archive",
+    )
+
+
+archive_tables = {
+    Invoice: archive_table(Invoice, "loan_id"),
+    SaleItem: archive_table(SaleItem, "invoice_id", "sale_id"),
+    PayItem: archive_table(PayItem, "loan_id"),
+    Expense: archive_table(Expense, "created_at"),
+}
+
+
+# columns added to existing tables after their first release, filled in for
+# the rows written before them when the column is added
+BACKFILLS = {
+    ("saleitem", "product_name"): (
+        "UPDATE {table} SET product_name = product.name, units = product.units"
+        " FROM main.product WHERE product.id = {table}.product_id"
+    ),
+    # the cost sales were charged is not kept per item, the buying price is
+    # what the margin reports used for them until now
+    ("saleitem", "unit_cost"): (
+        "UPDATE {table} SET unit_cost = product.buying_price"
+        " FROM main.product WHERE product.id = {table}.product_id"
+    ),
+    ("purchaseitem", "product_name"): (
+        "UPDATE {table} SET product_name = product.name, units = product.units"
+        " FROM main.product WHERE product.id = {table}.product_id"
+    ),
+}
+
+
+def catalog(conn) -> set[str]:
+    """names of the tables, their columns and the indexes in both schemas"""
+    return set(
+        conn.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type IN ('table', 'index')"
+            " UNION ALL SELECT m.name || '.' || c.name FROM sqlite_master m"
+            " JOIN pragma_table_info(m.name) c WHERE m.type = 'table'"
+            " UNION ALL SELECT 'archive.' || name FROM archive.sqlite_master"
+            " WHERE type IN ('table', 'index')"
+            " UNION ALL SELECT 'archive.' || m.name || '.' || c.name"
+            " FROM archive.sqlite_master m"
+            " JOIN pragma_table_info(m.name, 'archive') c WHERE m.type = 'table'"
+        ).scalars()
+    )
 
 
-def create_db_and_tables():
+def all_tables() -> list[Table]:
+    return SQLModel.metadata.sorted_tables + archive_metadata.sorted_tables
+
+
+def schema_is_current(engine) -> bool:
+    """check with a single catalog query that every table, column and index
+    exists"""
+    with engine.connect() as conn:
+        names = catalog(conn)
+    for table in all_tables():
+        if table.fullname not in names:
+            return False
+        if any(f"{table.fullname}.{column.name}" not in names for column in table.c):
+            return False
+        prefix = "archive." if table.schema else ""
+        if any(f"{prefix}{index.name}" not in names for index in table.indexes):
+            return False
+    return True
+
+
+def add_columns(engine):
+    """add the columns existing tables miss and backfill them"""
+    with engine.begin() as conn:
+        names = catalog(conn)
+        for table in all_tables():
+            if table.fullname not in names:
+                continue
+            missing = [c for c in table.c if f"{table.fullname}.{c.name}" not in names]
+            for column in missing:
+                kind = column.type.compile(engine.dialect)
+                conn.exec_driver_sql(
+                    f"ALTER TABLE {table.fullname} ADD COLUMN {column.name} {kind}"
+                )
+            for column in missing:
+                backfill = BACKFILLS.get((table.name, column.name))
+                if backfill:
+                    conn.exec_driver_sql(backfill.format(table=table.fullname))
+
+
+def create_db_and_tables(engine=None):
+    engine = engine or get_engine()
+    if schema_is_current(engine):
+        return
+    add_columns(engine)
     SQLModel.metadata.create_all(engine)
+    archive_metadata.create_all(engine)
+    # create_all skips the indexes of tables that already exist
+    for table in all_tables():
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,83 @@
+"""Fixtures for the shop2 tests.
+
+Every test runs the app against fresh database files in its own temporary
+directory, tenant databases and backups included:
+
+    cd shop2 && python -m pytest tests
+"""
+
+import os
+import sys
+import tempfile
+
+# the settings below are read when the app modules are imported
+os.environ.setdefault("SQLITE_FILE", os.path.join(tempfile.mkdtemp(), "shop.db"))
+os.environ.setdefault("BACKUP_INTERVAL_HOURS", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlmodel import Session
+
+import main
+from controlers import analytics, charts, forecast, inventory
+from core import backup
+from core.cache import cache
+from models import model
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    model.tenants.dispose()
+    model.tenants.seen.clear()
+    model.default_engine().dispose()
+    model.default_engine.cache_clear()
+    monkeypatch.setattr(model, "sqlite_url", f"sqlite:///{tmp_path / 'shop.db'}")
+    monkeypatch.setattr(model.tenants, "directory", str(tmp_path / "tenants"))
+    monkeypatch.setattr(backup, "BACKUP_DIR", str(tmp_path / "backups"))
+    # the in-process caches outlive a database, a new one starts them empty
+    cache.clear()
+    inventory._reorder_cache.clear()
+    forecast._forecast_cache.clear()
+    charts._chart_cache.clear()
+    analytics._snapshots.clear()
+    model.default_engine().echo = False
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture
+def session(client):
+    with Session(model.get_engine()) as session:
+        yield session
+
+
+@pytest.fixture
+def add_product(client):
+    def add(name="soap", stock=100, buying_price=2, selling_price=3):
+        response = client.post(
+            "/products/",
+            json={
+                "name": name,
+                "stock": stock,
+                "buying_price": buying_price,
+                "selling_price": selling_price,
+                "units": "pc",
+            },
+        )
+        assert response.status_code == 200, response.text
+        return response.json()
+
+    return add
+
+
+@pytest.fixture
+def add_customer(client):
+    def add(name="amina"):
+        response = client.post(
+            "/customer/", json={"name": name, "phone": None, "password": None}
+        )
+        assert response.status_code == 200, response.text
+        return response.json()
+
+    return add
@@ -0,0 +1,41 @@
+import pytest
+
+from core import admission
+from models.model import tenants
+
+
+@pytest.fixture
+def full_gates(monkeypatch):
+    """gates without room, every request they see is turned away"""
+    monkeypatch.setattr(admission, "read_gate", admission.Gate("read", 0, 0, 0))
+    monkeypatch.setattr(
+        admission, "write_gates", {None: admission.Gate("write", 0, 0, 0)}
+    )
+
+
+def test_full_gate_answers_503_with_retry_after(client, full_gates):
+    read = client.get("/products/")
+    write = client.post("/expenses/", json=[])
+
+    assert read.status_code == write.status_code == 503
+    assert read.headers["retry-after"] == str(admission.RETRY_AFTER)
+
+
+def test_exempt_paths_skip_the_gates(client, full_gates):
+    response = client.get("/admission/stats")
+
+    assert response.status_code == 200
+    assert response.json()["read"]["rejected"] == 0
+
+
+def test_every_tenant_has_a_write_gate_of_its_own(client, monkeypatch):
+    tenants.create("north")
+    monkeypatch.setattr(
+        admission, "write_gates", {None: admission.Gate("write", 0, 0, 0)}
+    )
+
+    default = client.post("/expenses/", json=[])
+    north = client.post("/t/north/expenses/", json=[])
+
+    assert default.status_code == 503
+    assert north.status_code == 200, north.text
@@ -0,0 +1,145 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlmodel import func, select, update
+
+from controlers import analytics
+from controlers.analytics import AnalyticsControler
+from controlers.archive import ArchiveControler
+from core import changelog
+from models.model import Expense, SaleItem
+
+
+def sell(client, product_id, quantity, amount=3):
+    sale = client.post("/sales/").json()
+    response = client.post(
+        f"/sales/{sale['id']}/saleitems",
+        json=[{"product_id": product_id, "quantity": quantity, "amount": amount}],
+    )
+    assert response.status_code == 200, response.text
+
+
+def expense(client, category, amount):
+    response = client.post(
+        "/expenses/",
+        json=[{"category": category, "description": "", "amount": amount}],
+    )
+    assert response.status_code == 200, response.text
+
+
+def expenses(client, **amounts):
+    for category, amount in amounts.items():
+        expense(client, category, amount)
+
+
+def from_sql(session):
+    """expenses per category by a plain group by"""
+    rows = session.exec(
+        select(Expense.category, func.count(), func.sum(Expense.amount)).group_by(
+            Expense.category
+        )
+    ).all()
+    return {category: (count, amount) for category, count, amount in rows}
+
+
+def from_snapshot(session):
+    rows = AnalyticsControler.expenses_by_category(session)
+    return {row.category: (row.count, row.amount) for row in rows}
+
+
+def table(session):
+    return AnalyticsControler.snapshot(session).tables["expense"]
+
+
+def totals(client):
+    margins = client.get("/analytics/margin-by-product").json()
+    expenses = client.get("/analytics/expenses-by-category").json()
+    return (
+        {row["product_id"]: row["quantity"] for row in margins},
+        {row["category"]: row["amount"] for row in expenses},
+    )
+
+
+def test_archived_history_stays_in_the_snapshot(client, session, add_product):
+    soap, salt = add_product("soap"), add_product("salt")
+    sell(client, soap["id"], 2)
+    sell(client, salt["id"], 1)
+    expense(client, "rent", 5)
+    expense(client, "fuel", 2)
+    old = datetime.now(timezone.utc) - timedelta(days=1000)
+    for model in (SaleItem, Expense):
+        session.exec(update(model).values(created_at=old))
+    session.commit()
+    assert totals(client) == ({soap["id"]: 2, salt["id"]: 1}, {"rent": 5, "fuel": 2})
+
+    moved = ArchiveControler.run(session)
+    sell(client, soap["id"], 4)
+
+    # the newest row of a table stays hot, the rest moved
+    assert (moved["saleitem"], moved["expense"]) == (1, 1)
+    expected = ({soap["id"]: 6, salt["id"]: 1}, {"rent": 5, "fuel": 2})
+    assert totals(client) == expected
+    # a snapshot loaded from scratch reads the archive too
+    analytics._snapshots.clear()
+    assert totals(client) == expected
+
+
+def test_updated_rows_are_read_again(client, session):
+    expenses(client, rent=5, fuel=2, food=1)
+    assert from_snapshot(session) == from_sql(session)
+
+    rent, fuel = session.get(Expense, 1), session.get(Expense, 2)
+    rent.amount = 7
+    # a new category lands in the dictionary of the encoded column
+    fuel.category = "transport"
+    session.add_all([rent, fuel])
+    session.commit()
+
+    assert from_snapshot(session) == from_sql(session)
+    assert from_sql(session)["transport"] == (1, 2)
+    assert table(session).dead == 0
+
+
+def test_deleted_rows_die_and_inserts_after_them_append(client, session):
+    expenses(client, rent=5, fuel=2, food=1, water=3, power=4)
+    from_snapshot(session)
+
+    client.delete("/expenses/2/")
+    expenses(client, fuel=6)
+
+    assert from_snapshot(session) == from_sql(session)
+    assert (table(session).size, table(session).dead) == (6, 1)
+
+
+def test_purged_changes_load_the_snapshot_again(client, session):
+    expenses(client, rent=5, fuel=2, food=1)
+    before = AnalyticsControler.snapshot(session)
+    client.delete("/expenses/1/")
+    food = session.get(Expense, 3)
+    food.category = "rent"
+    session.add(food)
+    session.commit()
+    expenses(client, water=3)
+    client.put("/changes/cursors/everyone", params={"seq": changelog.latest(session)})
+
+    # the delete and the update are gone from the log, only the newest
+    # change of the table stays
+    assert changelog.purge(session) > 0
+    assert not changelog.complete(session, before.seq, changelog.latest(session))
+    assert from_snapshot(session) == from_sql(session)
+    assert (table(session).size, table(session).dead) == (3, 0)
+
+
+def test_compaction_keeps_the_live_rows(client, session):
+    expenses(client, **{f"c{i}": i for i in range(1, 9)})
+    from_snapshot(session)
+
+    for id in (2, 4, 6):
+        client.delete(f"/expenses/{id}/")
+
+    # 3 of 8 rows dead is past the ratio, they are squeezed out
+    assert from_snapshot(session) == from_sql(session)
+    assert (table(session).size, table(session).dead) == (5, 0)
+    assert table(session).column("id").tolist() == [1, 3, 5, 7, 8]
+    expenses(client, c9=9)
+    assert from_snapshot(session) == from_sql(session)
+    assert table(session).max_id() == 9
@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlmodel import update
+
+from controlers.archive import ArchiveControler
+from models.model import SaleItem
+
+
+def sell(client, product_id, sale=None):
+    """sell on the given sale or a new one, returns the sale"""
+    sale = sale or client.post("/sales/").json()
+    response = client.post(
+        f"/sales/{sale['id']}/saleitems",
+        json=[{"product_id": product_id, "quantity": 2, "amount": 3}],
+    )
+    assert response.status_code == 200, response.text
+    return sale
+
+
+def backdate(session, model, days=1000):
+    """move the rows of a table past the archive cutoff"""
+    old = datetime.now(timezone.utc) - timedelta(days=days)
+    session.exec(update(model).values(created_at=old))
+    session.commit()
+
+
+def test_archived_cash_sale_keeps_its_items(client, session, add_product):
+    soap = add_product()
+    sale = sell(client, soap["id"])
+    backdate(session, SaleItem)
+    before = client.get(f"/sales/{sale['id']}/saleitems/").json()
+    sell(client, soap["id"])
+
+    moved = ArchiveControler.run(session)
+
+    assert moved["saleitem"] == 1
+    response = client.get(f"/sales/{sale['id']}/saleitems/")
+    assert response.status_code == 200, response.text
+    # the new item went on the same sale, today's
+    assert response.json()[:1] == before
+    assert client.get(f"/sales/{sale['id']}/").json()["revenue"] == 12
+
+
+def test_newest_row_stays_so_its_id_is_not_reused(client, session, add_product):
+    soap = add_product()
+    sale = sell(client, soap["id"])
+    sell(client, soap["id"], sale)
+    backdate(session, SaleItem)
+
+    assert ArchiveControler.run(session)["saleitem"] == 1
+    sell(client, soap["id"], sale)
+
+    items = client.get(f"/sales/{sale['id']}/saleitems/").json()
+    # the archived half of the sale is listed with the hot one
+    assert [row["id"] for row in items] == [1, 2, 3]
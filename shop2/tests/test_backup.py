@@ -0,0 +1,38 @@
+import os
+import sqlite3
+
+from sqlmodel import text
+
+from core import backup
+from models.model import archive_path
+
+
+def test_backup_copies_the_archive_alongside(client, session):
+    session.exec(
+        text(
+            "INSERT INTO archive.expense"
+            " (id, category, description, amount, created_at, updated_at)"
+            " VALUES (1, 'rent', 'may', 5, '2020-05-01', '2020-05-01')"
+        )
+    )
+    session.commit()
+
+    record = backup.backup(session)
+
+    assert record.archive_path == archive_path(record.path)
+    assert record.archive_bytes == os.path.getsize(record.archive_path)
+    # restored side by side the pair attaches like the live files
+    with sqlite3.connect(record.path) as conn:
+        conn.execute("ATTACH DATABASE ? AS archive", (record.archive_path,))
+        rows = conn.execute("SELECT description FROM archive.expense").fetchall()
+    conn.close()
+    assert rows == [("may",)]
+
+
+def test_prune_removes_both_files(client, session):
+    first = backup.backup(session)
+
+    backup.prune(session, keep=0)
+
+    assert not os.path.exists(first.path)
+    assert not os.path.exists(first.archive_path)
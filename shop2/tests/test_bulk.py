@@ -0,0 +1,34 @@
+import pytest
+
+
+def test_bulk_update_sets_only_the_given_fields(client, add_product):
+    soap, salt = add_product("soap"), add_product("salt")
+
+    response = client.patch(
+        "/products/bulk/", json={"ids": [soap["id"], salt["id"]], "selling_price": 4}
+    )
+
+    assert response.json() == {"updated": 2}
+    for product in (soap, salt):
+        row = client.get(f"/products/{product['id']}/").json()
+        assert (row["selling_price"], row["buying_price"]) == (4, 2)
+
+
+@pytest.mark.parametrize("field", ["buying_price", "selling_price", "units"])
+def test_bulk_update_rejects_null(client, add_product, field):
+    soap = add_product("soap")
+
+    response = client.patch("/products/bulk/", json={"ids": [soap["id"]], field: None})
+
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"] == ["body", field]
+
+
+def test_product_update_adds_to_the_stock(client, add_product):
+    soap = add_product("soap", stock=10)
+    body = {**soap, "stock": 5, "buying_price": 3}
+
+    response = client.put(f"/products/{soap['id']}/", json=body)
+
+    assert response.status_code == 200, response.text
+    assert (response.json()["stock"], response.json()["buying_price"]) == (15, 3)
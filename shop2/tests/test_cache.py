@@ -0,0 +1,51 @@
+import sqlite3
+
+from models import model
+
+
+def expense(client, description, amount=10):
+    response = client.post(
+        "/expenses/",
+        json=[{"category": "rent", "description": description, "amount": amount}],
+    )
+    assert response.status_code == 200, response.text
+
+
+def listing(client):
+    return [row["amount"] for row in client.get("/expenses/").json()]
+
+
+def test_repeated_read_is_served_from_the_cache(client):
+    expense(client, "june")
+    listing(client)
+    hits = client.get("/cache/stats").json()["hits"]
+
+    assert listing(client) == [10]
+    assert client.get("/cache/stats").json()["hits"] == hits + 1
+
+
+def test_commit_in_this_process_drops_the_entry(client):
+    expense(client, "june")
+    assert listing(client) == [10]
+
+    expense(client, "july", 20)
+
+    assert listing(client) == [10, 20]
+
+
+def test_write_of_another_worker_is_seen_through_the_change_log(client):
+    expense(client, "june")
+    assert listing(client) == [10]
+
+    # another worker writes the row and its change log entry, this process
+    # gets no commit event for it
+    path = model.get_engine().url.database
+    with sqlite3.connect(path) as conn:
+        conn.execute("UPDATE expense SET amount = 15 WHERE id = 1")
+        conn.execute(
+            "INSERT INTO changelog (table_name, row_id, op, columns, created_at)"
+            " VALUES ('expense', 1, 'update', 'amount', datetime('now'))"
+        )
+    conn.close()
+
+    assert listing(client) == [15]
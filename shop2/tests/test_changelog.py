@@ -0,0 +1,45 @@
+from sqlmodel import select
+
+from core import changelog
+from models.model import ChangeLog
+
+
+def expense(client, description):
+    response = client.post(
+        "/expenses/",
+        json=[{"category": "rent", "description": description, "amount": 1}],
+    )
+    assert response.status_code == 200, response.text
+
+
+def seqs(session):
+    return session.exec(select(ChangeLog.seq).order_by(ChangeLog.seq)).all()
+
+
+def test_purge_needs_a_cursor(client, session):
+    expense(client, "june")
+
+    assert changelog.purge(session) == 0
+    assert seqs(session)
+
+
+def test_purge_stops_at_the_slowest_cursor(client, session, add_product):
+    for month in ("may", "june", "july"):
+        expense(client, month)
+    add_product()
+    top = changelog.latest(session)
+    latest = {
+        table: changelog.latest(session, table) for table in ("expense", "product")
+    }
+    client.put("/changes/cursors/fast", params={"seq": top})
+    client.put("/changes/cursors/slow", params={"seq": 2})
+
+    deleted = changelog.purge(session)
+
+    assert deleted == 2
+    assert seqs(session)[0] == 3
+    # the newest change of every table stays, latest() does not move back
+    for table, seq in latest.items():
+        assert changelog.latest(session, table) == seq
+    assert not changelog.complete(session, 0, top)
+    assert changelog.complete(session, 2, top)
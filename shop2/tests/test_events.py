@@ -0,0 +1,86 @@
+import asyncio
+import threading
+
+import pytest
+
+from core.events import EventBus
+from models.model import current_tenant
+
+
+def drain(subscriber):
+    events = []
+    while not subscriber.queue.empty():
+        events.append(subscriber.queue.get_nowait())
+    return events
+
+
+def test_slow_subscriber_is_dropped_when_its_buffer_overflows():
+    async def scenario():
+        bus = EventBus(buffer_size=2)
+        slow, other = bus.subscribe(), bus.subscribe(["stock"])
+        for n in range(3):
+            bus.publish("sales", {"n": n})
+        stream = [chunk async for chunk in bus.stream(slow)]
+        return bus, slow, other, stream
+
+    bus, slow, other, stream = asyncio.run(scenario())
+
+    assert slow.dropped and not other.dropped
+    # the buffered events make room for the end of the stream
+    assert stream == ["retry: 3000\n\n", "event: dropped\ndata: {}\n\n"]
+    assert bus.stats() == {"subscribers": 1, "published": 3, "dropped": 1}
+
+
+def test_subscribers_only_see_their_tenant_and_topics():
+    async def scenario():
+        bus = EventBus()
+        default = bus.subscribe()
+        stock = bus.subscribe(["stock"])
+        token = current_tenant.set("north")
+        try:
+            north = bus.subscribe()
+            bus.publish("sales", {"tenant": "north"})
+        finally:
+            current_tenant.reset(token)
+        bus.publish("sales", {"tenant": None})
+        bus.publish("stock", {"tenant": None})
+        return drain(default), drain(stock), drain(north)
+
+    default, stock, north = asyncio.run(scenario())
+
+    assert default == [("sales", {"tenant": None}), ("stock", {"tenant": None})]
+    assert stock == [("stock", {"tenant": None})]
+    assert north == [("sales", {"tenant": "north"})]
+
+
+def test_events_published_from_a_thread_reach_the_loop():
+    async def scenario():
+        bus = EventBus()
+        subscriber = bus.subscribe()
+        thread = threading.Thread(target=bus.publish, args=("stock", {"id": 1}))
+        thread.start()
+        thread.join()
+        return await asyncio.wait_for(subscriber.queue.get(), 1)
+
+    assert asyncio.run(scenario()) == ("stock", {"id": 1})
+
+
+def test_deferred_events_wait_for_the_block_and_die_with_it():
+    async def scenario():
+        bus = EventBus()
+        subscriber = bus.subscribe()
+        with bus.deferred():
+            bus.publish("sales", {"n": 1})
+            held = drain(subscriber)
+        committed = drain(subscriber)
+        with pytest.raises(RuntimeError):
+            with bus.deferred():
+                bus.publish("sales", {"n": 2})
+                raise RuntimeError("rolled back")
+        return held, committed, drain(subscriber)
+
+    held, committed, rolled_back = asyncio.run(scenario())
+
+    assert held == []
+    assert committed == [("sales", {"n": 1})]
+    assert rolled_back == []
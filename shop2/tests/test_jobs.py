@@ -0,0 +1,142 @@
+import csv
+import io
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+from sqlmodel import select
+
+from core import jobs
+from models.model import Job, JobStatus
+
+
+@pytest.fixture(autouse=True)
+def job_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_DIR", str(tmp_path / "jobs"))
+
+
+@pytest.fixture
+def release(monkeypatch):
+    """registers a "wait" job that reports progress until the event is set"""
+    event = threading.Event()
+
+    def wait_for_release(ctx, session):
+        for _ in range(500):
+            if event.wait(0.01):
+                return "released"
+            ctx.progress(0, "waiting")
+        return "timed out"
+
+    monkeypatch.setitem(jobs.JOB_KINDS, "wait", (wait_for_release, False))
+    monkeypatch.setattr(jobs, "PROGRESS_INTERVAL", 0)
+    yield event
+    event.set()
+
+
+def submit(client, kind, **params):
+    response = client.post(f"/jobs/{kind}", json=params)
+    assert response.status_code == 202, response.text
+    return response.json()["id"]
+
+
+def wait(client, id, until=("Done", "Failed", "Cancelled"), timeout=10):
+    """the job once it reached one of the statuses, by default a final one"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = client.get(f"/jobs/{id}").json()
+        if job["status"] in until:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"job {id} is still {job['status']}")
+
+
+def sell(client, product_id, quantity):
+    sale = client.post("/sales/").json()
+    response = client.post(
+        f"/sales/{sale['id']}/saleitems",
+        json=[{"product_id": product_id, "quantity": quantity, "amount": 3}],
+    )
+    assert response.status_code == 200, response.text
+
+
+def test_archive_rejects_negative_days(client):
+    response = client.post("/jobs/archive", json={"days": -1})
+
+    assert response.status_code == 422
+    assert client.get("/jobs").json() == []
+
+
+def test_sales_export_includes_archived_items(client, add_product):
+    soap = add_product()
+    for quantity in (1, 2, 3):
+        sell(client, soap["id"], quantity)
+
+    # days=0 is not the default, everything but the newest row goes
+    archive = wait(client, submit(client, "archive", days=0))
+    export = wait(client, submit(client, "sales-export"))
+
+    assert archive["status"] == "Done", archive["message"]
+    assert archive["message"].startswith("0 invoice, 2 saleitem")
+    assert export["status"] == "Done", export["message"]
+    rows = list(
+        csv.DictReader(io.StringIO(client.get(f"/jobs/{export['id']}/result").text))
+    )
+    assert [(row["id"], row["quantity"]) for row in rows] == [
+        ("1", "1.0"),
+        ("2", "2.0"),
+        ("3", "3.0"),
+    ]
+
+
+def test_full_queue_turns_jobs_away(client, release, monkeypatch):
+    monkeypatch.setattr(jobs.runner, "queue_limit", 1)
+    first = submit(client, "wait")
+
+    refused = client.post("/jobs/wait", json={})
+
+    assert refused.status_code == 503
+    assert refused.headers["retry-after"] == "30"
+    release.set()
+    assert wait(client, first)["message"] == "released"
+    # the finished job left the queue, its slot is free again
+    deadline = time.monotonic() + 5
+    while jobs.runner.stats()["queued_or_running"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    submit(client, "wait")
+
+
+def test_running_job_stops_at_its_next_progress_report(client, release):
+    id = submit(client, "wait")
+    wait(client, id, until=("Running",))
+
+    cancelling = client.delete(f"/jobs/{id}").json()
+
+    assert cancelling["status"] == "Cancelling"
+    job = wait(client, id)
+    assert (job["status"], job["message"]) == ("Cancelled", "cancelled")
+
+
+def test_recover_fails_the_jobs_of_dead_workers(client, session):
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    alive = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        for worker in (dead.pid, alive.pid):
+            session.add(Job(kind="backup", params="{}", worker=worker))
+        session.add(
+            Job(kind="backup", params="{}", worker=dead.pid, status=JobStatus.done)
+        )
+        session.commit()
+
+        assert jobs.runner.recover(session) == 1
+    finally:
+        alive.kill()
+        alive.wait()
+
+    statuses = {
+        job.worker: job.status
+        for job in session.exec(select(Job).where(Job.status != JobStatus.done))
+    }
+    assert statuses == {dead.pid: JobStatus.failed, alive.pid: JobStatus.queued}
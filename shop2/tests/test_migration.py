@@ -0,0 +1,70 @@
+import sqlite3
+
+from fastapi.testclient import TestClient
+
+import main
+from models import model
+from models.model import archive_path
+
+# columns the baseline schema did not have yet
+ADDED = {
+    "main.saleitem": ("product_name", "units", "unit_cost"),
+    "archive.saleitem": ("product_name", "units", "unit_cost"),
+    "main.purchaseitem": ("product_name", "units"),
+}
+
+
+def baseline(path):
+    """take the added columns off the tables, as an old database has them"""
+    with sqlite3.connect(path) as conn:
+        conn.execute("ATTACH DATABASE ? AS archive", (archive_path(path),))
+        for table, columns in ADDED.items():
+            for column in columns:
+                conn.execute(f"ALTER TABLE {table} DROP COLUMN {column}")
+        conn.execute(
+            "INSERT INTO archive.saleitem"
+            " (id, created_at, updated_at, product_id, quantity, amount)"
+            " VALUES (100, '2020-05-01', '2020-05-01', 1, 1, 3)"
+        )
+    conn.close()
+
+
+def rows(path, sql):
+    with sqlite3.connect(path) as conn:
+        conn.execute("ATTACH DATABASE ? AS archive", (archive_path(path),))
+        found = conn.execute(sql).fetchall()
+    conn.close()
+    return found
+
+
+def test_startup_adds_and_backfills_the_new_columns(client, add_product):
+    soap = add_product("soap", buying_price=2)
+    sale = client.post("/sales/").json()
+    client.post(
+        f"/sales/{sale['id']}/saleitems",
+        json=[{"product_id": soap["id"], "quantity": 1, "amount": 3}],
+    )
+    purchase = client.post("/purchase/", json={"amount": 0}).json()
+    client.post(
+        f"/purchase/{purchase['id']}/purchaseitem/",
+        json=[{"product_id": soap["id"], "quantity": 4, "amount": 2}],
+    )
+    path = model.get_engine().url.database
+    model.get_engine().dispose()
+    baseline(path)
+    assert not model.schema_is_current(model.get_engine())
+    model.get_engine().dispose()
+
+    with TestClient(main.app) as restarted:
+        items = restarted.get(f"/sales/{sale['id']}/saleitems/").json()
+
+    assert model.schema_is_current(model.get_engine())
+    assert [item["product"]["name"] for item in items] == ["soap"]
+    assert rows(
+        path,
+        "SELECT product_name, units, unit_cost FROM saleitem"
+        " UNION ALL SELECT product_name, units, unit_cost FROM archive.saleitem",
+    ) == [("soap", "pc", 2.0), ("soap", "pc", 2.0)]
+    assert rows(path, "SELECT product_name, units FROM purchaseitem") == [
+        ("soap", "pc")
+    ]
@@ -0,0 +1,42 @@
+def deliver(client, lines):
+    purchase = client.post("/purchase/", json={"amount": 0}).json()
+    response = client.post(f"/purchase/{purchase['id']}/purchaseitem/", json=lines)
+    return purchase["id"], response
+
+
+def test_delivery_raises_stock_and_totals_the_purchase(client, add_product):
+    soap, salt = add_product("soap", stock=10), add_product("salt", stock=0)
+    lines = [
+        {"product_id": soap["id"], "quantity": 5, "amount": 2},
+        {"product_id": salt["id"], "quantity": 3, "amount": 4},
+        {"product_id": soap["id"], "quantity": 1, "amount": 3},
+    ]
+
+    id, response = deliver(client, lines)
+
+    assert response.status_code == 200, response.text
+    assert [item["quantity"] for item in response.json()] == [5, 3, 1]
+    assert client.get(f"/products/{soap['id']}/").json()["stock"] == 16
+    assert client.get(f"/products/{salt['id']}/").json()["stock"] == 3
+    purchases = client.get("/purchase/").json()
+    assert [p["amount"] for p in purchases if p["id"] == id] == [5 * 2 + 3 * 4 + 3]
+
+
+def test_invalid_lines_reject_the_whole_delivery(client, add_product):
+    soap = add_product("soap", stock=10)
+    lines = [
+        {"product_id": soap["id"], "quantity": 5, "amount": 2},
+        {"product_id": 99, "quantity": 1, "amount": 2},
+        {"product_id": soap["id"], "quantity": 0, "amount": 2},
+    ]
+
+    id, response = deliver(client, lines)
+
+    assert response.status_code == 422
+    errors = response.json()["detail"]
+    assert [(error["line"], error["product_id"]) for error in errors] == [
+        (1, 99),
+        (2, soap["id"]),
+    ]
+    assert client.get(f"/products/{soap['id']}/").json()["stock"] == 10
+    assert client.get(f"/purchase/{id}/purchaseitem/").json() == []
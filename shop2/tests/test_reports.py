@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlmodel import update
+
+from models.model import Invoice, Status
+
+AS_OF = datetime(2026, 6, 30, 12, tzinfo=timezone.utc)
+
+
+def invoice(client, customer_id, product_id, amount):
+    response = client.post(
+        "/invoices/",
+        json={
+            "customer_id": customer_id,
+            "salesitems": [{"product_id": product_id, "quantity": 1, "amount": amount}],
+        },
+    )
+    assert response.status_code == 200, response.text
+    return response.json()["id"]
+
+
+def backdate(session, id, days, **values):
+    created = AS_OF - timedelta(days=days)
+    session.exec(
+        update(Invoice).where(Invoice.id == id).values(created_at=created, **values)
+    )
+    session.commit()
+
+
+def aging(client, **params):
+    response = client.get(
+        "/reports/aging", params={"as_of": AS_OF.isoformat(), **params}
+    )
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_aging_buckets_by_invoice_age(client, session, add_product, add_customer):
+    product = add_product(stock=1000)
+    amina, musa = add_customer("amina"), add_customer("musa")
+    ages = {10: 100, 30: 200, 45: 300, 75: 400, 90: 500, 200: 600}
+    for days, amount in ages.items():
+        backdate(session, invoice(client, amina["id"], product["id"], amount), days)
+    backdate(session, invoice(client, musa["id"], product["id"], 50), 5)
+
+    report = aging(client)
+
+    # a bucket holds invoices older than its lower bound, up to and with its
+    # upper one: 30 days old is in days_30, 90 days old in days_90_plus
+    assert report["customers_count"] == 2
+    first = report["customers"][0]
+    assert first["name"] == "amina"
+    assert first["current"] == 100
+    assert first["days_30"] == 200 + 300
+    assert first["days_60"] == 400
+    assert first["days_90_plus"] == 500 + 600
+    assert first["total"] == sum(ages.values())
+    assert report["totals"]["current"] == 150
+    assert report["totals"]["total"] == sum(ages.values()) + 50
+
+
+def test_aging_counts_what_is_still_due(client, session, add_product, add_customer):
+    product = add_product(stock=1000)
+    customer = add_customer()
+    paid = invoice(client, customer["id"], product["id"], 100)
+    partial = invoice(client, customer["id"], product["id"], 100)
+    backdate(session, paid, 40, status=Status.paid, paid_amount=100)
+    backdate(session, partial, 40, status=Status.partial, paid_amount=60)
+
+    report = aging(client)
+
+    assert report["totals"]["days_30"] == 40
+    assert report["totals"]["total"] == 40
+
+
+def test_aging_totals_cover_every_page(client, session, add_product, add_customer):
+    product = add_product(stock=1000)
+    for i in range(3):
+        customer = add_customer(f"customer {i}")
+        backdate(
+            session, invoice(client, customer["id"], product["id"], 10 * (i + 1)), 1
+        )
+
+    report = aging(client, limit=1, offset=1)
+
+    assert [row["total"] for row in report["customers"]] == [20]
+    assert report["customers_count"] == 3
+    assert report["totals"]["total"] == 60
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+from core.events import bus
+from models.model import SyncBatchIn
+
+
+def sale_op(product_id, quantity):
+    items = [{"product_id": product_id, "quantity": quantity, "amount": 3}]
+    return {"op": "sale", "data": {"salesitems": items}}
+
+
+def test_failed_batch_rolls_back_every_op(client, add_product, add_customer):
+    product = add_product(stock=50)
+    add_customer()
+    batch = {
+        "ops": [
+            {
+                "op": "customer",
+                "data": {"name": "musa", "phone": None, "password": None},
+            },
+            sale_op(product["id"], 5),
+            {"op": "payment", "data": {"loan_id": 99, "amount": 1}},
+        ]
+    }
+
+    response = client.post("/sync", json=batch)
+
+    assert response.status_code == 404
+    assert response.json()["detail"]["op"] == 2
+    assert len(client.get("/customer/").json()) == 1
+    assert client.get(f"/products/{product['id']}/").json()["stock"] == 50
+
+
+def test_batch_is_applied_once(client, add_product):
+    product = add_product(stock=50)
+    batch = {"batch_id": "till-1", "ops": [sale_op(product["id"], 5)]}
+
+    first = client.post("/sync", json=batch).json()
+    again = client.post("/sync", json=batch).json()
+
+    assert not first["replayed"] and again["replayed"]
+    assert again["results"] == first["results"]
+    assert client.get(f"/products/{product['id']}/").json()["stock"] == 45
+
+
+def test_events_wait_for_the_batch_to_commit(client, add_product):
+    product = add_product(stock=50)
+    good = SyncBatchIn.model_validate({"ops": [sale_op(product["id"], 5)]})
+    bad = SyncBatchIn.model_validate(
+        {
+            "ops": [
+                sale_op(product["id"], 5),
+                {"op": "payment", "data": {"loan_id": 99, "amount": 1}},
+            ]
+        }
+    )
+
+    async def run():
+        subscriber = bus.subscribe(["sales", "stock"])
+        try:
+            with pytest.raises(HTTPException):
+                await main.post_sync(bad)
+            await asyncio.sleep(0)
+            rolled_back = subscriber.queue.qsize()
+            await main.post_sync(good)
+            await asyncio.sleep(0)
+            events = [
+                subscriber.queue.get_nowait() for _ in range(subscriber.queue.qsize())
+            ]
+        finally:
+            bus.unsubscribe(subscriber)
+        return rolled_back, events
+
+    rolled_back, events = asyncio.run(run())
+
+    assert rolled_back == 0
+    assert [topic for topic, _ in events] == ["sales", "stock"]
+    assert events[1][1] == {"product_id": product["id"], "stock": 45}
@@ -0,0 +1,105 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from sqlmodel import Session, update
+
+from core import admission
+from models.model import Product, tenants
+
+
+@pytest.fixture
+def shops(client):
+    for name in ("north", "south"):
+        tenants.create(name)
+    return client
+
+
+def add(client, prefix, name, stock=5):
+    response = client.post(
+        f"{prefix}/products/",
+        json={
+            "name": name,
+            "stock": stock,
+            "buying_price": 2,
+            "selling_price": 3,
+            "units": "pc",
+        },
+    )
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def names(response):
+    assert response.status_code == 200, response.text
+    return [row["name"] for row in response.json()]
+
+
+def test_requests_are_routed_to_their_shop(shops):
+    add(shops, "/t/north", "soap")
+    add(shops, "", "salt")
+
+    assert names(shops.get("/t/north/products/")) == ["soap"]
+    assert names(shops.get("/products/", headers={"X-Tenant": "north"})) == ["soap"]
+    # an empty catalog is a 404 in this api
+    assert shops.get("/t/south/products/").status_code == 404
+    assert names(shops.get("/products/")) == ["salt"]
+
+
+def test_unknown_and_conflicting_tenants_are_rejected(shops):
+    assert shops.get("/t/east/products/").status_code == 404
+    response = shops.get("/t/north/products/", headers={"X-Tenant": "south"})
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize(
+    "path", ["/inventory/reorder?only_low=false", "/forecast", "/expenses/"]
+)
+def test_caches_do_not_leak_between_shops(shops, path):
+    # the same history in both shops leaves them with equal watermarks
+    for prefix, name in (("/t/north", "soap"), ("/t/south", "salt")):
+        add(shops, prefix, name)
+        response = shops.post(
+            f"{prefix}/expenses/",
+            json=[{"category": name, "description": name, "amount": 1}],
+        )
+        assert response.status_code == 200, response.text
+    moment = datetime(2026, 1, 1)
+    for tenant in ("north", "south"):
+        with Session(tenants.engine(tenant)) as session:
+            session.exec(update(Product).values(updated_at=moment))
+            session.commit()
+
+    north = shops.get(f"/t/north{path}").json()
+    south = shops.get(f"/t/south{path}").json()
+
+    key = "category" if path == "/expenses/" else "name"
+    assert [row[key] for row in north] == ["soap"]
+    assert [row[key] for row in south] == ["salt"]
+
+
+def test_tenant_event_streams_are_exempt_from_admission(monkeypatch):
+    # a read gate without room turns away every read it sees
+    monkeypatch.setattr(admission, "read_gate", admission.Gate("read", 0, 0, 0))
+    seen = []
+
+    async def app(scope, receive, send):
+        seen.append(scope["path"])
+
+    async def send(message):
+        seen.append(message.get("status"))
+
+    async def call(path, root_path=""):
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": path,
+            "root_path": root_path,
+            "headers": [],
+        }
+        await admission.AdmissionMiddleware(app)(scope, None, send)
+
+    asyncio.run(call("/t/north/events", root_path="/t/north"))
+    asyncio.run(call("/t/north/products/", root_path="/t/north"))
+
+    assert seen == ["/t/north/events", 503, None]
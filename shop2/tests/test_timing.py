@@ -0,0 +1,49 @@
+import pytest
+
+from controlers.controler import ProductControler
+from core import timing
+
+
+@pytest.fixture(autouse=True)
+def fresh_totals(client):
+    client.delete("/admin/controlers")
+
+
+def timings(client, endpoint):
+    rows = client.get("/admin/controlers", params={"endpoint": endpoint}).json()
+    return {(row["controler"], row["method"]): row for row in rows}
+
+
+def test_override_calling_super_counts_once(client, add_product):
+    add_product("soap")
+    add_product("salt")
+
+    rows = timings(client, "POST /products/")
+
+    # ProductControler.save runs BaseControler.save through super()
+    save = rows[("ProductControler", "save")]
+    assert (save["calls"], save["rows"]) == (2, 2)
+    assert ("BaseControler", "save") not in rows
+
+
+def test_inherited_method_counts_under_the_subclass(client):
+    client.post(
+        "/expenses/", json=[{"category": "rent", "description": "", "amount": 1}]
+    )
+
+    client.delete("/expenses/1/")
+
+    rows = timings(client, "DELETE /expenses/{id}/")
+    # delete looks the row up with get_one, a call of its own
+    assert sorted(rows) == [
+        ("ExpenseControler", "delete"),
+        ("ExpenseControler", "get_one"),
+    ]
+    assert [row["calls"] for row in rows.values()] == [1, 1]
+
+
+def test_calls_outside_a_request_have_no_endpoint(client, session):
+    ProductControler.get_all(0, 10, session)
+
+    rows = {(row.controler, row.method): row for row in timing.stats()}
+    assert rows[("ProductControler", "get_all")].endpoint is None
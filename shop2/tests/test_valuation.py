@@ -0,0 +1,113 @@
+import pytest
+from sqlmodel import func, update
+
+from controlers.archive import ArchiveControler
+from controlers.valuation import ValuationControler
+from models.model import PurchaseItem, SaleItem
+
+
+def purchase(client, product_id, quantity, unit_cost):
+    purchase = client.post("/purchase/", json={"amount": 0}).json()
+    response = client.post(
+        f"/purchase/{purchase['id']}/purchaseitem/",
+        json=[{"product_id": product_id, "quantity": quantity, "amount": unit_cost}],
+    )
+    assert response.status_code == 200, response.text
+
+
+def sell(client, product_id, quantity, amount=10):
+    """sell on a new sale, returns the sale"""
+    sale = client.post("/sales/").json()
+    response = client.post(
+        f"/sales/{sale['id']}/saleitems",
+        json=[{"product_id": product_id, "quantity": quantity, "amount": amount}],
+    )
+    assert response.status_code == 200, response.text
+    return client.get(f"/sales/{sale['id']}").json()
+
+
+def valuation(client, product_id):
+    response = client.get(f"/products/{product_id}/valuation")
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_sale_consumes_the_oldest_layers_first(client, add_product):
+    product = add_product(stock=10, buying_price=2)
+    purchase(client, product["id"], 10, 5)
+
+    sale = sell(client, product["id"], 15)
+
+    # 10 from the opening layer at 2, 5 from the purchase at 5
+    assert sale["cost_of_goods"] == pytest.approx(10 * 2 + 5 * 5)
+    value = valuation(client, product["id"])
+    assert value["quantity"] == 5
+    assert value["fifo_value"] == pytest.approx(25)
+    assert value["average_cost"] == pytest.approx(3.5)
+
+
+def test_invoice_lowers_stock_like_a_sale(client, add_product, add_customer):
+    product = add_product(stock=20, buying_price=2)
+    customer = add_customer()
+
+    response = client.post(
+        "/invoices/",
+        json={
+            "customer_id": customer["id"],
+            "salesitems": [{"product_id": product["id"], "quantity": 2, "amount": 3}],
+        },
+    )
+
+    assert response.status_code == 200, response.text
+    assert client.get(f"/products/{product['id']}/").json()["stock"] == 18
+    assert valuation(client, product["id"])["quantity"] == 18
+
+
+def test_rebuild_matches_the_consumed_layers(
+    client, session, add_product, add_customer
+):
+    first = add_product("soap", stock=10, buying_price=2)
+    second = add_product("salt", stock=4, buying_price=1)
+    customer = add_customer()
+    purchase(client, first["id"], 6, 4)
+    sell(client, first["id"], 12)
+    purchase(client, first["id"], 5, 6)
+    purchase(client, second["id"], 10, 1.5)
+    client.post(
+        "/invoices/",
+        json={
+            "customer_id": customer["id"],
+            "salesitems": [
+                {"product_id": first["id"], "quantity": 3, "amount": 9},
+                {"product_id": second["id"], "quantity": 7, "amount": 3},
+            ],
+        },
+    )
+    consumed = client.get("/inventory/valuation").json()
+
+    ValuationControler.rebuild(session)
+
+    assert client.get("/inventory/valuation").json() == pytest.approx(consumed)
+    for row in consumed:
+        stock = client.get(f"/products/{row['product_id']}/").json()["stock"]
+        assert row["quantity"] == stock
+
+
+def test_rebuild_replays_archived_sales(client, session, add_product):
+    product = add_product(stock=2, buying_price=2)
+    purchase(client, product["id"], 10, 5)
+    sell(client, product["id"], 6)
+    # the history so far goes past the archive cutoff, in the same order
+    for model in (PurchaseItem, SaleItem):
+        shifted = func.strftime("%Y-%m-%d %H:%M:%f", model.created_at, "-1000 days")
+        session.exec(update(model).values(created_at=shifted))
+    session.commit()
+    sell(client, product["id"], 1)
+    assert ArchiveControler.run(session)["saleitem"] == 1
+    consumed = valuation(client, product["id"])
+
+    ValuationControler.rebuild(session)
+
+    assert valuation(client, product["id"]) == pytest.approx(consumed)
+    assert consumed["quantity"] == 5
+    assert consumed["fifo_value"] == pytest.approx(25)